@@ -0,0 +1,537 @@
+# Benchmark for the Formation parser and mstore auto-indexing
+# Runs without a SQL Server or a Formation drop, so every performance change can be measured the same way:
+#   - generates a synthetic Formation drop - form types of form folders, each with a JSON file shaped like
+#     FTP/GMP Audit - Production Area.json and a dummy PDF
+#   - runs formation_parser.run_process() end to end, against a SQLite database standing in for mstore
+#   - replays synthetic MRContents pages through MAutoIndex - batch (run_batch) and/or one job at a time
+#   - optionally, times mstorematch.LiteralMatcher with a substring search and with its automaton, for
+#     increasing numbers of values - to check the n_AUTOMATON_MIN_VALUES threshold
+# Reports forms/s, pages/s, the number of SQL statements by type, peak RSS and the stage metrics
+# The results can be saved as JSON and compared against an earlier (baseline) run
+# The synthetic data comes from a seeded random generator, so the same options give the same work each time
+
+# Run with: python formation_benchmark.py [--form-types 4] [--forms 50] [--documents 200] [--pages 3]
+#                                         [--output results.json] [--baseline baseline.json]
+
+# Note that SQLite is not SQL Server - the figures are for comparing runs of this benchmark, not for sizing
+# The SQL Server statements used by mstore.py are translated where SQLite has no equivalent (see translate_sql())
+
+import sys                                  # System functions
+import os                                   # OS functions, such as directory scanning
+import time                                 # for timing the runs
+import json                                 # for the synthetic forms and the results file
+import random                               # for the synthetic data - seeded, so runs are repeatable
+import re                                   # for translating SQL statements
+import sqlite3                              # the stand-in mstore database
+import threading                            # the statement counts are shared by the pipeline threads
+import collections                          # named tuple rows, like pyodbc rows
+import tempfile                             # for the synthetic drop and database
+import shutil                               # for removing them again
+import argparse                             # command line options
+try:
+    import resource                         # for peak memory use - not available on Windows
+except ImportError:
+    resource = None
+import mstore                               # mstore database and auto-index classes
+import mstorematch                          # literal matcher, for the LiteralMatcher timings
+import mstoremetrics as M                   # stage timings and event counts
+import formation_parser as FP               # the form processing functions
+import mstoreenvironment as ENV             # mstore environment parameters for this system
+
+MODULE_NAME = 'formation_benchmark.py'
+
+RESULTS_VERSION = 1
+FORM_TYPE_BASE_ID = 10000                   # form type Ids are FORM_TYPE_BASE_ID + 1, 2, ...
+CLASSIFIER_MAF_LIST = 901                   # MAF list for the synthetic fixed text classifier rules
+REF_RULES_MAF_LIST = 902                    # MAF list for the synthetic reference extract rules
+CABINET_ID = '1'                            # cabinet holding the synthetic documents
+LOOKUP_TABLE = 'zBenchLookup'               # cross-reference table for the reference extract rules
+LITERAL_PAGES = 50                          # pages searched for each LiteralMatcher timing
+
+# target fields in zFormationData, in the order they are given to form fields
+TARGET_FIELDS = ['CB_CREF1', 'CB_CREF2', 'CB_CREF3', 'CB_CREF4', 'CB_CREF5',
+                 'CB_DREF1', 'CB_DREF2', 'CB_DREF3', 'CB_DREF4', 'CB_DREF5',
+                 'CB_DREF6', 'CB_DREF7', 'CB_DREF8', 'CB_DREF9', 'CB_DREF10']
+
+# JSON tags for the form fields - including a nested one, as with '31|31[Issue_2_Fault_description]'
+FIELD_TAGS = ['1', '2', '4', '6', '12', '14', '22', '24', '25', '31|31[Issue_2_Fault_description]',
+              '3', '5', '7', '9', '11']
+
+WORDS = ['production', 'area', 'audit', 'door', 'hygiene', 'pest', 'issues', 'line', 'seal', 'clean', 'floor',
+         'waste', 'glass', 'control', 'check', 'sample', 'batch', 'label', 'storage', 'temperature']
+NAMES = ['Laura', 'Adrian Fitzpatrick', 'Sam Jones', 'Priya Patel', 'Chris Murphy', 'Hannah Lee', 'Tom Ward']
+COMPANIES = ['ACME LTD', 'GLOBEX PLC', 'INITECH LTD', 'UMBRELLA PLC', 'HOOLI LTD', 'STARK INDUSTRIES',
+             'WAYNE ENTERPRISES', 'TYRELL CORP', 'CYBERDYNE SYSTEMS', 'SOYLENT LTD']
+DOC_TYPES = ['PURCHASE INVOICE', 'CREDIT NOTE', 'DELIVERY NOTE', 'STATEMENT', 'REMITTANCE ADVICE',
+             'PURCHASE ORDER', 'QUOTATION', 'PRO FORMA INVOICE']
+
+SQL_TOP = re.compile(r'^(\s*select\s+)top\s+(\(\?\)|\(\d+\)|\d+)\s+(.*)$', re.IGNORECASE | re.DOTALL)
+SQL_MERGE = re.compile(r'^merge into (\S+) as t using \(values (.*)\) as s \(RowSeq, .*?\) on 1 = 0 '
+                       r'when not matched then insert \((.*?)\) values \(.*?\) '
+                       r'output s\.RowSeq, inserted\.(\w+);$', re.DOTALL)
+SQL_ROW_SEQ = re.compile(r'\(\d+, ')
+
+# translate a SQL Server statement, as used by mstore.py, for SQLite
+# returns (statement, parameters, True if the statement is a MERGE ... OUTPUT turned into INSERT ... RETURNING)
+def translate_sql(sSQL, params):
+    m = SQL_TOP.match(sSQL)
+    if m:
+        sLimit = m.group(2).strip('()')
+        if sLimit == '?':
+            # the row count is the first parameter, but a limit clause comes last
+            params = list(params[1:]) + [params[0]]
+        sSQL = m.group(1) + m.group(3) + ' limit ' + sLimit
+    m = SQL_MERGE.match(sSQL)
+    if m:
+        # MERGE is only used for inserts which return the new Ids in row order (see MDatabase.insert_rows())
+        sValues = SQL_ROW_SEQ.sub('(', m.group(2))
+        sSQL = 'insert into ' + m.group(1) + ' (' + m.group(3) + ') values ' + sValues + ' returning ' + m.group(4)
+        return sSQL, params, True
+    return sSQL, params, False
+
+# Count of SQL statements run, by type (select, insert, update, merge...) - across all connections
+class StatementCounter:
+
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def count(self, sSQL):
+        words = sSQL.split(None, 1)
+        sType = words[0].lower() if words else ''
+        with self.lock:
+            self.counts[sType] = self.counts.get(sType, 0) + 1
+
+    def reset(self):
+        with self.lock:
+            self.counts = {}
+
+    def snapshot(self):
+        with self.lock:
+            counts = dict(sorted(self.counts.items()))
+        counts['total'] = sum(counts.values())
+        return counts
+
+STATEMENTS = StatementCounter()
+
+# row classes for the stand-in database, one per set of column names - rows have attributes, as with pyodbc
+row_classes = {}
+
+def row_factory(cursor, row):
+    names = tuple([d[0] for d in cursor.description])
+    row_class = row_classes.get(names)
+    if row_class is None:
+        row_class = collections.namedtuple('Row', names, rename=True)
+        row_classes[names] = row_class
+    return row_class(*row)
+
+# SQLite cursor which behaves enough like a pyodbc cursor for mstore.py
+class BenchCursor(sqlite3.Cursor):
+
+    fast_executemany = False                # pyodbc setting, ignored
+    seq_rows = None                         # (row position, new Id) results of a translated MERGE ... OUTPUT
+
+    def execute(self, sSQL, params=()):
+        STATEMENTS.count(sSQL)
+        self.seq_rows = None
+        sSQL, params, fMerge = translate_sql(sSQL, params)
+        super().execute(sSQL, params)
+        if fMerge:
+            # the Ids of a single multi-row insert are allocated in row order
+            ids = sorted([r[0] for r in super().fetchall()])
+            self.seq_rows = list(enumerate(ids))
+        return self
+
+    def executemany(self, sSQL, param_rows):
+        STATEMENTS.count(sSQL)
+        self.seq_rows = None
+        return super().executemany(sSQL, param_rows)
+
+    def fetchall(self):
+        if self.seq_rows is not None:
+            rows = self.seq_rows
+            self.seq_rows = None
+            return rows
+        return super().fetchall()
+
+    # pyodbc cursors can commit, for the connection they belong to
+    def commit(self):
+        self.connection.commit()
+
+class BenchConnection(sqlite3.Connection):
+
+    def cursor(self, factory=BenchCursor):
+        return super().cursor(factory)
+
+# The stand-in mstore database - a SQLite file, so the pipeline writers and the log writer can each have their
+# own connection to it, as they would with SQL Server
+class BenchDatabase:
+
+    def __init__(self, s_file):
+        self.s_file = s_file
+        with sqlite3.connect(s_file) as c:
+            c.execute('pragma journal_mode = wal')
+
+    # replacement for pyodbc.connect, for MDatabase and MDatabasePool - the connection string is ignored
+    def connect(self, sConnectionString):
+        c = sqlite3.connect(self.s_file, timeout=60, check_same_thread=False, factory=BenchConnection)
+        c.create_function('IsNull', 2, lambda value, replacement: replacement if value is None else value)
+        c.row_factory = row_factory
+        return c
+
+    def open(self):
+        return mstore.MDatabase('benchmark', 'benchmark', 'benchmark', '', encrypted=False, connect=self.connect)
+
+    def open_pool(self):
+        return mstore.MDatabasePool('benchmark', 'benchmark', 'benchmark', '', ENV.DB_POOL_MIN_SIZE,
+                                    ENV.DB_POOL_MAX_SIZE, ENV.DB_POOL_IDLE_SECONDS, ENV.DB_POOL_VALIDATE_SECONDS,
+                                    connect=self.connect)
+
+    # run a script or a statement for many rows on a plain connection - set up is not counted as benchmark work
+    def run_script(self, sScript):
+        with sqlite3.connect(self.s_file, timeout=60) as c:
+            c.executescript(sScript)
+
+    def insert_many(self, sSQL, rows):
+        with sqlite3.connect(self.s_file, timeout=60) as c:
+            c.executemany(sSQL, rows)
+
+    def query_value(self, sSQL):
+        with sqlite3.connect(self.s_file, timeout=60) as c:
+            return c.execute(sSQL).fetchone()[0]
+
+    # create the mstore tables used by the parser and auto-index
+    def create_tables(self):
+        self.run_script('create table ' + ENV.FORMATION_DATA_TABLE + ' (ID integer primary key autoincrement, '
+                        + 'filename text, JSON text, originalpath text, '
+                        + ', '.join([f + ' text' for f in TARGET_FIELDS])
+                        + ", CB_DOCDATE text default (date('now')), formtype text, formref text);"
+                        + 'create table AFListItem (LS_ListID int, LS_Item1, LS_Item2, LS_Item3, LS_Item4, '
+                        + 'LS_Item5, LS_Item6, LS_Item7, LS_Item8, LS_Item9, LS_Item10);'
+                        + 'create index AFListItem_ListID on AFListItem (LS_ListID);'
+                        + 'create table MICAB' + CABINET_ID + ' (CB_DOCID int primary key, CB_PAGES int, '
+                        + 'CB_DTID int, CB_FILETYPE text);'
+                        + 'create table MRContents' + CABINET_ID + ' (MT_DocId int, MT_Page int, MT_Contents text, '
+                        + 'MT_Status int, primary key (MT_DocId, MT_Page));'
+                        + 'create table AIJobs (AJ_JobID int primary key, AJ_OCRComplete, AJ_OCRError, '
+                        + 'AJ_ClassFound, AJ_TargetDTID, AJ_KeyRefFound, AJ_KeyRefValue);'
+                        + 'create table AILog (AL_JobID, AL_Source, AL_Description, AL_CabinetID, AL_DocID);'
+                        + 'create table ' + LOOKUP_TABLE + ' (Account text primary key, Name text, Town text);')
+
+    # add a MAF list - items is a list of up to 10 values for each row
+    def add_MAF_list(self, nMAFListID, items):
+        rows = []
+        for item in items:
+            rows += [[nMAFListID] + [str(i) for i in item] + [''] * (10 - len(item))]
+        self.insert_many('insert into AFListItem values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+# generate a synthetic form, shaped like FTP/GMP Audit - Production Area.json
+# padding_kb adds a block of photo data, as for forms with pictures attached
+def make_form_JSON(rng, padding_kb=0):
+    data = {'submitted': 'true'}
+    for i in range(1, 34):
+        data[str(i)] = rng.choice(['Yes', 'No', '1', '0', '', ' '.join(rng.choices(WORDS, k=3))])
+    data['1'] = '%02d/%02d/2018 %02d:%02d' % (rng.randint(1, 28), rng.randint(1, 12), rng.randint(0, 23),
+                                              rng.randint(0, 59))
+    data['2'] = rng.choice(NAMES)
+    data['4'] = rng.choice(NAMES)
+    data['12'] = [rng.randint(100000, 999999)]
+    data['17'] = '%.2f' % rng.random()
+    data['22'] = rng.randint(100000, 999999)
+    data['24'] = [' '.join(rng.choices(WORDS, k=3))]
+    data['31'] = {'31[Issue_2_Fault_description]': ' '.join(rng.choices(WORDS, k=6))}
+    if padding_kb > 0:
+        data['photos'] = [rng.randbytes(768).hex() for i in range(padding_kb)]
+    return data
+
+# generate the synthetic Formation drop - form_types directories of forms form folders, each with a JSON file
+# and a PDF, and the MAF list configuration for each form type
+def make_formation_drop(bench, s_base, rng, form_types, forms, fields, pdf_kb, json_padding_kb):
+    target_items = []
+    field_items = []
+    nField = 0
+    for t in range(1, form_types + 1):
+        nFormId = FORM_TYPE_BASE_ID + t
+        s_type_dir = os.path.join(s_base, 'Synthetic audit ' + str(t) + '-' + str(nFormId))
+        os.makedirs(s_type_dir)
+        target_items += [[nFormId, 'type' + str(t)]]
+        for i in range(min(fields, len(TARGET_FIELDS))):
+            nField += 1
+            field_items += [[nField, nFormId, FIELD_TAGS[i], TARGET_FIELDS[i]]]
+        for f in range(1, forms + 1):
+            s_form_dir = os.path.join(s_type_dir, 'Form-' + str(f))
+            os.makedirs(s_form_dir)
+            with open(os.path.join(s_form_dir, 'Synthetic audit.json'), 'w') as fJSON:
+                json.dump(make_form_JSON(rng, json_padding_kb), fJSON)
+            with open(os.path.join(s_form_dir, 'Synthetic audit.pdf'), 'wb') as fPDF:
+                fPDF.write(b'%PDF-1.4\n' + rng.randbytes(pdf_kb * 1024) + b'\n%%EOF\n')
+    bench.add_MAF_list(ENV.FORM_TARGET_MAF_LIST, target_items)
+    bench.add_MAF_list(ENV.FORM_FIELD_MAF_LIST, field_items)
+
+# generate the synthetic documents for auto-indexing - OCR text for each page, with a document type marker and
+# an account reference (with its company name, for the cross-check) on some of the pages
+# returns the jobs, as (JobID, CabinetID, DocID)
+def make_documents(bench, rng, documents, pages, words_per_page):
+    # classifier rules - a plain text marker and a regex for each document type
+    rules = []
+    for nDTID, sDocType in enumerate(DOC_TYPES, 1):
+        rules += [[len(rules) + 1, nDTID, sDocType + ' REF']]
+        rules += [[len(rules) + 1, nDTID, sDocType + r' NO[.:]?\s*\d{4,}']]
+    bench.add_MAF_list(CLASSIFIER_MAF_LIST, rules)
+
+    # reference rules - an account number, checked against the company name, for each document type
+    ref_rules = []
+    for nDTID in range(1, len(DOC_TYPES) + 1):
+        ref_rules += [[nDTID, nDTID, r'ACC\d{6}', LOOKUP_TABLE, 'Account', 'Name', 'Town']]
+    bench.add_MAF_list(REF_RULES_MAF_LIST, ref_rules)
+
+    accounts = []
+    for i in range(max(documents // 4, 10)):
+        accounts += [('ACC%06d' % (i + 1), rng.choice(COMPANIES), rng.choice(WORDS).upper())]
+    bench.insert_many('insert into ' + LOOKUP_TABLE + ' values (?, ?, ?)', accounts)
+
+    documents_rows = []
+    page_rows = []
+    jobs = []
+    for nDocID in range(1, documents + 1):
+        nDTID = rng.randint(1, len(DOC_TYPES))
+        sDocType = DOC_TYPES[nDTID - 1]
+        account = rng.choice(accounts)
+        nMarkerPage = rng.randint(1, pages)
+        for nPage in range(1, pages + 1):
+            words = [w.upper() for w in rng.choices(WORDS + COMPANIES, k=words_per_page)]
+            if nPage == nMarkerPage:
+                if rng.random() < 0.9:
+                    words.insert(rng.randint(0, len(words)), sDocType + ' NO: ' + str(rng.randint(1000, 99999)))
+                if rng.random() < 0.8:
+                    words.insert(rng.randint(0, len(words)), account[0])
+                    words.insert(rng.randint(0, len(words)), account[1])
+            page_rows += [(nDocID, nPage, ' '.join(words), 3)]
+        documents_rows += [(nDocID, pages, nDTID, 'pdf')]
+        jobs += [(nDocID, CABINET_ID, nDocID)]
+    bench.insert_many('insert into MICAB' + CABINET_ID + ' values (?, ?, ?, ?)', documents_rows)
+    bench.insert_many('insert into MRContents' + CABINET_ID + ' values (?, ?, ?, ?)', page_rows)
+    return jobs
+
+# (re)create the AIJobs records, so each run starts with nothing classified
+def reset_jobs(bench, jobs):
+    bench.run_script('delete from AIJobs; delete from AILog;')
+    bench.insert_many('insert into AIJobs (AJ_JobID, AJ_OCRComplete) values (?, 1)', [[j[0]] for j in jobs])
+
+# empty the process-wide caches, so each run starts cold
+def clear_caches():
+    mstore.PAGE_TEXT_CACHE.clear()
+    mstore.REF_CACHE.clear()
+    mstore.MAF_LIST_CACHE.invalidate()
+
+# point the environment at the synthetic drop - the forms are removed once processed, as in production
+def set_environment(s_root):
+    ENV.DEBUG = False
+    ENV.FORMATION_BASE = os.path.join(s_root, 'drop')
+    ENV.SWEEP_BASE = os.path.join(s_root, 'sweep')
+    ENV.SCAN_INDEX_FILE = os.path.join(s_root, 'formation_scan_index.p')
+    ENV.AILOG_SPILL_FILE = os.path.join(s_root, 'ailog_spill.txt')
+    ENV.METRICS_FILE = ''
+    # binary_checksum() is SQL Server only, so cached MAF lists are not checked for changes
+    ENV.MAF_CACHE_CHECK_CHANGES = False
+    mstore.MAF_LIST_CACHE.fCheckChanges = False
+
+# peak resident set size of this process so far, in MB - None if not known
+def get_peak_rss_mb():
+    if resource is None:
+        return None
+    nPeak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return nPeak / (1024.0 * 1024.0)          # bytes on macOS
+    return nPeak / 1024.0                         # KB on Linux
+
+# run one timed phase of the benchmark - fn does the work and returns the number of items done
+def run_phase(sName, sUnit, fn):
+    STATEMENTS.reset()
+    M.METRICS.reset()
+    start = time.perf_counter()
+    nItems = fn()
+    seconds = time.perf_counter() - start
+    metrics = M.METRICS.snapshot()
+    stages = {}
+    for sStage, h in metrics['stages'].items():
+        stages[sStage] = {'count': h['count'], 'sum': h['sum'], 'p95': h['p95'], 'max': h['max']}
+    return {'name': sName, 'unit': sUnit, 'items': nItems, 'seconds': seconds,
+            'rate': nItems / seconds if seconds > 0 else 0.0, 'statements': STATEMENTS.snapshot(),
+            'stages': stages, 'counters': metrics['counters'], 'metrics_text': M.METRICS.dump_text(),
+            'peak_rss_mb': get_peak_rss_mb()}
+
+# run the Formation parser over the synthetic drop
+def run_parser_phase(bench, md, pool, nForms):
+    def run():
+        FP.run_process(md, pool)
+        return nForms
+    phase = run_phase('formation_parser', 'forms', run)
+    phase['forms_written'] = bench.query_value('select count(*) from ' + ENV.FORMATION_DATA_TABLE)
+    nHandedOff = 0
+    for root, dirs, files in os.walk(ENV.SWEEP_BASE):
+        nHandedOff += len([f for f in files if f.upper().endswith('.PDF')])
+    phase['forms_handed_off'] = nHandedOff
+    return phase
+
+# replay the synthetic documents through MAutoIndex - sMode is 'batch' (run_batch) or 'single' (one job at a time)
+def run_autoindex_phase(bench, md, jobs, nPages, sMode, nProcesses):
+    reset_jobs(bench, jobs)
+    clear_caches()
+    AI = mstore.MAutoIndex(md)
+
+    def run():
+        if sMode == 'batch':
+            AI.run_batch(jobs, nRulesList=CLASSIFIER_MAF_LIST, nRefRulesList=REF_RULES_MAF_LIST,
+                         nProcesses=nProcesses)
+        else:
+            for nJobID, sCabinetID, nDocID in jobs:
+                AI.run_fixed_text_classifier(nJobID, sCabinetID, nDocID, CLASSIFIER_MAF_LIST)
+                AI.run_reference_extract(nJobID, sCabinetID, nDocID, REF_RULES_MAF_LIST)
+        return len(jobs) * nPages
+    phase = run_phase('autoindex_' + sMode, 'pages', run)
+    phase['documents'] = len(jobs)
+    phase['classified'] = bench.query_value('select count(*) from AIJobs where AJ_ClassFound = 1')
+    phase['references_found'] = bench.query_value('select count(*) from AIJobs where AJ_KeyRefFound = 1')
+    return phase
+
+# time LiteralMatcher finding values on synthetic pages, with a substring search for each value and with the
+# automaton, for each number of values in counts - the values are names and numbers, as for cross-checks
+def run_literal_phase(rng, counts, nWords):
+    pages = []
+    for i in range(LITERAL_PAGES):
+        pages += [' '.join([w.upper() for w in rng.choices(WORDS + COMPANIES, k=nWords)])]
+    timings = []
+    for nValues in counts:
+        values = []
+        for i in range(nValues):
+            if i % 10 == 0:
+                values += [rng.choice(COMPANIES)]               # some values are on the pages
+            else:
+                values += [rng.choice(COMPANIES) + ' ' + str(rng.randint(1, 999999))]
+        timing = {'values': nValues, 'automaton_used': nValues >= mstorematch.n_AUTOMATON_MIN_VALUES}
+        for sMethod, nAutomatonMin in (('scan', sys.maxsize), ('automaton', 0)):
+            start = time.perf_counter()
+            matcher = mstorematch.LiteralMatcher(values, nAutomatonMin)
+            for page in pages:
+                matcher.find_values(page)
+            timing[sMethod + '_ms'] = (time.perf_counter() - start) * 1000.0
+        timings += [timing]
+    return timings
+
+# run the whole benchmark, returns the results as a dictionary
+def run_benchmark(options):
+    s_root = tempfile.mkdtemp(prefix='formation_benchmark_', dir=options.dir)
+    try:
+        set_environment(s_root)
+        rng = random.Random(options.seed)
+        bench = BenchDatabase(os.path.join(s_root, 'mstore.db'))
+        bench.create_tables()
+        make_formation_drop(bench, ENV.FORMATION_BASE, rng, options.form_types, options.forms, options.fields,
+                            options.pdf_kb, options.json_padding_kb)
+        jobs = make_documents(bench, rng, options.documents, options.pages, options.words)
+        if options.serial:
+            ENV.PIPELINE_WRITE_WORKERS = 0
+
+        md = bench.open()
+        pool = None
+        if ENV.PIPELINE_WRITE_WORKERS > 0:
+            pool = bench.open_pool()
+        phases = [run_parser_phase(bench, md, pool, options.form_types * options.forms)]
+        if pool is not None:
+            pool.close()
+        for sMode in options.autoindex:
+            phases += [run_autoindex_phase(bench, md, jobs, options.pages, sMode, options.processes)]
+        md.close()
+        literals = run_literal_phase(rng, options.literals, options.words)
+
+        return {'version': RESULTS_VERSION, 'time': time.time(), 'python': sys.version.split()[0],
+                'sqlite': sqlite3.sqlite_version, 'options': vars(options), 'phases': phases,
+                'literal_matcher': literals, 'peak_rss_mb': get_peak_rss_mb()}
+    finally:
+        if options.keep:
+            print('Benchmark files kept in ' + s_root)
+        else:
+            shutil.rmtree(s_root, ignore_errors=True)
+
+# print the results, compared with the baseline results if given
+def print_results(results, baseline=None, fMetrics=False):
+    base_phases = {}
+    if baseline is not None:
+        for phase in baseline.get('phases', []):
+            base_phases[phase['name']] = phase
+    for phase in results['phases']:
+        print('\n%s: %d %s in %.3fs, %.1f %s/s' % (phase['name'], phase['items'], phase['unit'], phase['seconds'],
+                                                   phase['rate'], phase['unit']))
+        base = base_phases.get(phase['name'])
+        if base is not None and base['rate'] > 0:
+            print('  baseline %.1f %s/s, %+.1f%%' % (base['rate'], phase['unit'],
+                                                    100.0 * (phase['rate'] - base['rate']) / base['rate']))
+        for sCheck in ('forms_written', 'forms_handed_off', 'documents', 'classified', 'references_found'):
+            if sCheck in phase:
+                sBase = ''
+                if base is not None and sCheck in base and base[sCheck] != phase[sCheck]:
+                    sBase = ' (baseline %d)' % base[sCheck]
+                print('  %-20s %8d%s' % (sCheck, phase[sCheck], sBase))
+        print('  SQL statements:')
+        for sType, n in phase['statements'].items():
+            sBase = ''
+            if base is not None:
+                sBase = ' (baseline %d)' % base['statements'].get(sType, 0)
+            print('    %-18s %8d%s' % (sType, n, sBase))
+        if fMetrics:
+            print()
+            print(phase['metrics_text'])
+    if results.get('literal_matcher'):
+        print('\nLiteralMatcher, %d pages (automaton used from %d values):' % (LITERAL_PAGES,
+                                                                             mstorematch.n_AUTOMATON_MIN_VALUES))
+        print('  %8s %12s %12s' % ('values', 'scan ms', 'automaton ms'))
+        for t in results['literal_matcher']:
+            print('  %8d %12.2f %12.2f%s' % (t['values'], t['scan_ms'], t['automaton_ms'],
+                                            ' *' if t['automaton_used'] else ''))
+    if results['peak_rss_mb'] is not None:
+        sBase = ''
+        if baseline is not None and baseline.get('peak_rss_mb'):
+            sBase = ' (baseline %.1f MB)' % baseline['peak_rss_mb']
+        print('\nPeak RSS: %.1f MB%s' % (results['peak_rss_mb'], sBase))
+
+def get_options(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Formation parser and mstore auto-indexing '
+                                                 'against synthetic data')
+    parser.add_argument('--form-types', type=int, default=4, help='number of form types in the drop')
+    parser.add_argument('--forms', type=int, default=50, help='number of form folders for each form type')
+    parser.add_argument('--fields', type=int, default=10, help='fields extracted from each form (max 15)')
+    parser.add_argument('--pdf-kb', type=int, default=64, help='size of each dummy PDF, in KB')
+    parser.add_argument('--json-padding-kb', type=int, default=0, help='extra photo data in each JSON file, in KB')
+    parser.add_argument('--documents', type=int, default=200, help='number of documents to auto-index')
+    parser.add_argument('--pages', type=int, default=3, help='number of pages for each document')
+    parser.add_argument('--words', type=int, default=300, help='number of words on each page')
+    parser.add_argument('--autoindex', nargs='*', choices=['batch', 'single'], default=['batch', 'single'],
+                        help='auto-index runs - run_batch() and/or one job at a time')
+    parser.add_argument('--processes', type=int, default=0, help='worker processes for run_batch() matching')
+    parser.add_argument('--literals', nargs='*', type=int, default=[],
+                        help='LiteralMatcher timings - numbers of values, e.g. 10 100 300 1000')
+    parser.add_argument('--serial', action='store_true', help='run the parser without the pipeline')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the synthetic data')
+    parser.add_argument('--dir', default=None, help='directory for the synthetic drop (default: system temp)')
+    parser.add_argument('--keep', action='store_true', help='keep the synthetic drop and database afterwards')
+    parser.add_argument('--output', default='', help='save the results to this JSON file')
+    parser.add_argument('--baseline', default='', help='compare with the results saved in this JSON file')
+    parser.add_argument('--metrics', action='store_true', help='print the stage metrics for each run')
+    return parser.parse_args(args)
+
+def main(args=None):
+    options = get_options(args)
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+    results = run_benchmark(options)
+    print_results(results, baseline, options.metrics)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+# Persistent scan index for the Formation forms drop
+# Records the state of each form folder, keyed by path, along with the folder modification time and inode
+# A folder which has not changed since the last scan is not opened again - so the cost of a scan pass
+# depends on the number of changed folders, not the size of the backlog
+# The index is saved to local disk with pickle, in the same way as the mstore credentials
+
+import os                                   # OS functions, such as directory scanning
+import time                                 # for retrying failed forms
+import pickle                               # for saving/loading the index
+import sys                                  # for the command line
+import shutil                               # for removing the unit test folders
+import tempfile                             # for the unit test folders
+
+MODULE_NAME = 'formation_index.py'
+
+# form folder states
+FORM_INCOMPLETE = 'incomplete'              # JSON and/or PDF still to arrive
+FORM_COMPLETE = 'complete'                  # ready to process
+FORM_PROCESSED = 'processed'                # written to mstore and handed off to Sweep (DEBUG mode leaves files)
+FORM_FAILED = 'failed'                      # processing failed - retried when the folder changes, or after a delay
+
+INDEX_VERSION = 2
+
+# a folder modified this close to the time it was scanned may have changed again within the same file system
+# timestamp tick (up to 2 seconds on FAT/SMB shares) without its mtime changing, so it is looked at again
+RECENT_MTIME_NS = 3 * 1000000000
+
+class FormScanIndex:
+
+    s_IndexFile = ''
+    fDirty = False
+    nRetrySeconds = 0
+
+    def __init__(self, s_index_file, retry_failed_seconds=600):
+        # entries are form type directory -> {form folder path -> [mtime_ns, inode, state, JSON file, PDF file,
+        #                                                            time of last state change, scan time_ns]}
+        self.s_IndexFile = s_index_file
+        self.nRetrySeconds = retry_failed_seconds
+        self.entries = {}
+        self.load()
+
+    # load a previously saved index - a missing or unreadable index just means a full scan
+    def load(self):
+        try:
+            with open(self.s_IndexFile, 'rb') as f:
+                data = pickle.load(f)
+            if data.get('version') == INDEX_VERSION:
+                self.entries = data['entries']
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, KeyError):
+            self.entries = {}
+
+    # save the index, if changed - written to a temporary file and swapped in, so a crash can't corrupt it
+    def save(self):
+        if not self.fDirty:
+            return True
+        s_tmp = self.s_IndexFile + '.tmp'
+        try:
+            with open(s_tmp, 'wb') as f:
+                pickle.dump({'version': INDEX_VERSION, 'entries': self.entries}, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(s_tmp, self.s_IndexFile)
+            self.fDirty = False
+            return True
+        except OSError:
+            return False
+
+    # get the entry for a form folder, None if not known
+    def get_entry(self, s_form_path):
+        return self.entries.get(os.path.dirname(s_form_path), {}).get(s_form_path)
+
+    # get the state for a form folder, '' if not known
+    def get_state(self, s_form_path):
+        entry = self.get_entry(s_form_path)
+        if entry:
+            return entry[2]
+        return ''
+
+    # set the state for a form folder - e.g. once processed or failed
+    def set_state(self, s_form_path, state):
+        entry = self.get_entry(s_form_path)
+        if entry and entry[2] != state:
+            entry[2] = state
+            entry[5] = time.time()
+            self.fDirty = True
+
+    # scan a form type directory, returning the complete forms as [folder, JSON file, PDF file]
+    def scan_form_type(self, s_dir):
+        forms_list = []
+        now = time.time()
+        old_entries = self.entries.get(s_dir, {})
+        new_entries = {}
+        with os.scandir(s_dir) as it:
+            for e in it:
+                if not e.is_dir():
+                    continue
+                st = e.stat()
+                entry = old_entries.get(e.path)
+                if entry is None or entry[0] != st.st_mtime_ns or entry[1] != st.st_ino:
+                    # new or changed folder - look inside it
+                    entry = self.scan_form(e.path, st)
+                elif entry[6] - entry[0] < RECENT_MTIME_NS:
+                    # a file may have arrived within the same mtime tick as the last scan
+                    entry = self.recheck_form(e.path, st, entry)
+                new_entries[e.path] = entry
+                if entry[2] == FORM_FAILED and now - entry[5] >= self.nRetrySeconds:
+                    # give a failed form another go, e.g. after the database was unavailable
+                    entry[2] = FORM_COMPLETE
+                if entry[2] == FORM_COMPLETE:
+                    forms_list += [[e.path, entry[3], entry[4]]]
+
+        # folders which have been removed (e.g. pruned after processing) are dropped from the index
+        if len(new_entries) != len(old_entries):
+            self.fDirty = True
+        self.entries[s_dir] = new_entries
+        return forms_list
+
+    # look at a single form folder now and record it in the index - e.g. one reported by the watcher, so that
+    # its outcome can be recorded with set_state() - raises FileNotFoundError if the folder has gone
+    def update_form(self, s_form_path):
+        entry = self.scan_form(s_form_path, os.stat(s_form_path))
+        self.entries.setdefault(os.path.dirname(s_form_path), {})[s_form_path] = entry
+        return entry
+
+    # read the contents of a single form folder and record its state
+    def scan_form(self, s_form_path, st):
+        f_JSON, f_PDF = get_form_files(s_form_path)
+        return self.new_entry(st, f_JSON, f_PDF)
+
+    # look again at a folder whose mtime can't be trusted - if the same files are there, it keeps its state
+    def recheck_form(self, s_form_path, st, entry):
+        f_JSON, f_PDF = get_form_files(s_form_path)
+        if [f_JSON, f_PDF] != entry[3:5]:
+            return self.new_entry(st, f_JSON, f_PDF)
+        now_ns = time.time_ns()
+        if entry[6] - entry[0] < RECENT_MTIME_NS <= now_ns - entry[0]:
+            # unchanged since well after its mtime, so the mtime can be trusted from now on
+            entry[6] = now_ns
+            self.fDirty = True
+        return entry
+
+    # create the entry for a form folder, from the files found in it
+    def new_entry(self, st, f_JSON, f_PDF):
+        if (f_JSON != '') and (f_PDF != ''):
+            state = FORM_COMPLETE
+        else:
+            state = FORM_INCOMPLETE
+        entry = [st.st_mtime_ns, st.st_ino, state, f_JSON, f_PDF, time.time(), time.time_ns()]
+        self.fDirty = True
+        return entry
+
+# find the JSON and PDF files in a form folder, '' if not there
+# used for all form folder listings (the scan index, a full scan without one, and the watcher)
+def get_form_files(s_form_path):
+    f_JSON = ''
+    f_PDF = ''
+    with os.scandir(s_form_path) as it:
+        for f in it:
+            s_upper = f.name.upper()
+            if s_upper.endswith('.JSON'):
+                f_JSON = f.name
+            elif s_upper.endswith('.PDF'):
+                f_PDF = f.name
+    return f_JSON, f_PDF
+
+def unit_tests():
+    # run the unit test process
+    n_pass = 0
+    n_fail = 0
+    print("\nRunning unit tests for " + MODULE_NAME)
+    global get_form_files
+
+    # count the form folders listed by each scan
+    listed = []
+    get_files = get_form_files
+    def counting_get_form_files(s_form_path):
+        listed.append(s_form_path)
+        return get_files(s_form_path)
+    get_form_files = counting_get_form_files
+
+    s_dir = tempfile.mkdtemp()
+    s_type_dir = os.path.join(s_dir, 'form-1')
+    os.mkdir(s_type_dir)
+    index = FormScanIndex(os.path.join(s_dir, 'index.pkl'))
+
+    # a folder with only the JSON file, last modified an hour ago
+    s_old = os.path.join(s_type_dir, 'old')
+    os.mkdir(s_old)
+    open(os.path.join(s_old, 'form.json'), 'w').close()
+    nOld = time.time() - 3600
+    os.utime(s_old, (nOld, nOld))
+
+    print("\n" + str(n_pass + n_fail+1) + ": Old, unchanged incomplete folder is not listed again")
+    try:
+        index.scan_form_type(s_type_dir)
+        fFirst = listed == [s_old] and index.get_state(s_old) == FORM_INCOMPLETE
+        del listed[:]
+        forms_list = index.scan_form_type(s_type_dir)
+        if fFirst and listed == [] and forms_list == [] and index.get_state(s_old) == FORM_INCOMPLETE:
+            print('Test passed')
+            n_pass += 1
+        else:
+            print('Listed: %s, forms: %s, state: %s' % (listed, forms_list, index.get_state(s_old)))
+            n_fail += 1
+    except:
+        print('Old incomplete folder test failed...')
+        n_fail += 1
+
+    print("\n" + str(n_pass + n_fail+1) + ": Recent folder is listed again, so a file in the same mtime tick is found")
+    try:
+        s_new = os.path.join(s_type_dir, 'new')
+        os.mkdir(s_new)
+        open(os.path.join(s_new, 'form.json'), 'w').close()
+        index.scan_form_type(s_type_dir)
+        # the PDF arrives without the folder mtime changing
+        st = os.stat(s_new)
+        open(os.path.join(s_new, 'form.pdf'), 'w').close()
+        os.utime(s_new, ns=(st.st_atime_ns, st.st_mtime_ns))
+        del listed[:]
+        forms_list = index.scan_form_type(s_type_dir)
+        if listed == [s_new] and forms_list == [[s_new, 'form.json', 'form.pdf']]:
+            print('Test passed')
+            n_pass += 1
+        else:
+            print('Listed: %s, forms: %s' % (listed, forms_list))
+            n_fail += 1
+    except:
+        print('Recent folder test failed...')
+        n_fail += 1
+
+    get_form_files = get_files
+    shutil.rmtree(s_dir, ignore_errors=True)
+
+    print('\nTotal tests :', n_pass + n_fail)
+    print('  %d tests passed' % n_pass)
+    print('  %d tests failed' % n_fail)
+    print('  %.2f%% success rate\n' % (100.0 * (n_pass / (n_pass + n_fail))))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'TEST':
+        print('Running in test mode...')
+        unit_tests()
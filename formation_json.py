@@ -0,0 +1,477 @@
+# Field extraction from Formation JSON submissions
+# Only a handful of fields are wanted from each form, but forms with photos or signatures embedded as base64
+# can be many MB of JSON. The field paths for a form type are compiled into a plan once, then each file is
+# stream-parsed a chunk at a time: only the values on a requested path are decoded, everything else is skipped
+# over without being built (long strings are skipped with a byte search, rather than character by character)
+# Small files are read with json.load, which is quicker when there is little to skip
+# Will have minimum dependencies - standard library only
+
+import os                                   # for the file size
+import re                                   # for scanning the JSON
+import json                                 # for decoding the wanted values, and for small files
+import threading                            # the compiled plans are shared by the pipeline threads
+import sys                                  # for the command line
+import tempfile                             # for the unit test files
+
+MODULE_NAME = 'formation_json.py'
+
+CHUNK_SIZE = 256 * 1024                     # bytes read from the file at a time
+NON_SPACE = re.compile(rb'[^ \t\r\n]')
+SCALAR_END = re.compile(rb'[,\]}\s]')
+# numbers, and the constants accepted by json.load (including its NaN and Infinity extensions)
+SCALAR = re.compile(rb'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?|true|false|null|NaN|-?Infinity')
+UTF8_BOM = b'\xef\xbb\xbf'                  # json.load skips this at the start of a file
+QUOTE = ord('"')
+BACKSLASH = ord('\\')
+COLON = ord(':')
+COMMA = ord(',')
+OPEN_OBJECT = ord('{')
+CLOSE_OBJECT = ord('}')
+OPEN_ARRAY = ord('[')
+CLOSE_ARRAY = ord(']')
+# the next token when skipping an object or array - group T_SCALAR is a complete number or constant, and
+# group T_STRING a string without escapes (any other string is matched by its opening quote)
+TOKEN = re.compile(rb'[ \t\r\n]*(?:(' + SCALAR.pattern + rb')(?=[,\]}\s]|\Z)|("[^"\\]*")|[{}\[\]",:])')
+T_SCALAR = 1
+T_STRING = 2
+# what can come next in an object or array being skipped
+VALUE = 0                                   # a value, after a : or a , in an array
+VALUE_OR_CLOSE = 1                          # a value or ], after a [
+KEY_OR_CLOSE = 2                            # a key or }, after a {
+KEY = 3                                     # a key, after a , in an object
+AFTER_KEY = 4                               # a :
+AFTER_VALUE = 5                             # a , or the closing bracket
+
+# A node in the trie of field paths - children are keyed on the next part of the path
+class PathNode:
+
+    def __init__(self):
+        self.children = {}                  # key -> PathNode
+        self.fields = []                    # indexes of the fields whose path ends here
+
+    def child(self, sKey):
+        node = self.children.get(sKey)
+        if node is None:
+            node = PathNode()
+            self.children[sKey] = node
+        return node
+
+# Compiled extraction plan for a form type - the fields to extract, with their paths in a trie, so a path
+# prefix shared by several fields (e.g. '31|...') is only looked up once for each form
+# field_list is a list of (tag, target field), where the tag is a pipe-delimited path, e.g. '31|31[Issue_2]'
+# The fields are kept in order of target column, so every form of the type gives its values in the same order
+# (whatever order the MAF list rows are read in) and is written with the same insert statement
+class FieldPlan:
+
+    def __init__(self, field_list, nFormId=0):
+        self.nFormId = nFormId
+        self.fields = sorted([(f[0], f[1]) for f in field_list], key=lambda f: f[1])
+        self.columns = tuple([f[1] for f in self.fields])
+        self.root = PathNode()
+        for i, (sTag, sTarget) in enumerate(self.fields):
+            node = self.root
+            for sKey in sTag.split('|'):
+                node = node.child(sKey)
+            node.fields += [i]
+
+    # iterates as the (tag, target field) list it was compiled from
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+# compiled plans, keyed on the form type - for field lists which are not already compiled
+# only the latest field list is kept for each form type, so a long-running watcher doesn't keep a plan for
+# every configuration it has seen - form type -> (field list, plan)
+compiled_plans = {}
+compiled_plans_lock = threading.Lock()
+
+def get_field_plan(field_list, nFormId=0):
+    if isinstance(field_list, FieldPlan):
+        return field_list
+    fields = tuple([(f[0], f[1]) for f in field_list])
+    compiled = compiled_plans.get(nFormId)
+    if compiled is not None and compiled[0] == fields:
+        return compiled[1]
+    plan = FieldPlan(fields, nFormId)
+    with compiled_plans_lock:
+        compiled_plans[nFormId] = (fields, plan)
+    return plan
+
+# find the fields under a path node in an already decoded value, into found (field index -> value)
+# a path can only go through objects - anything else means the fields below are not there
+def resolve(node, value, found):
+    for i in node.fields:
+        found[i] = value
+    if node.children and isinstance(value, dict):
+        for sKey, child in node.children.items():
+            if sKey in value:
+                resolve(child, value[sKey], found)
+
+# Stream parser for a JSON file - walks the objects on the requested paths and skips everything else
+# The file is read a chunk at a time and the buffer only holds the unread part of the current chunk, plus any
+# value being decoded. Skipped values are checked as by json.load, except for the contents of skipped strings
+# (control characters, escapes and UTF-8 encoding), which are only found by json.load if the value is wanted
+class JSONStream:
+
+    def __init__(self, f, nChunkSize=CHUNK_SIZE):
+        self.f = f
+        self.nChunkSize = nChunkSize
+        self.buf = bytearray()
+        self.pos = 0
+        self.keep = -1                      # start of a value being captured for decoding, -1 if none
+        self.fEOF = False
+
+    def error(self, sMessage):
+        return ValueError('Invalid JSON: ' + sMessage)
+
+    # read the next chunk of the file into the buffer, dropping what has been used
+    # returns False at the end of the file
+    def fill(self):
+        if self.fEOF:
+            return False
+        data = self.f.read(self.nChunkSize)
+        if not data:
+            self.fEOF = True
+            return False
+        nDrop = self.pos if self.keep < 0 else self.keep
+        if nDrop > 0:
+            del self.buf[:nDrop]
+            self.pos -= nDrop
+            if self.keep >= 0:
+                self.keep -= nDrop
+        self.buf += data
+        return True
+
+    # skip white space and return the next byte, without using it up - None at the end of the file
+    def next_byte(self):
+        while True:
+            m = NON_SPACE.search(self.buf, self.pos)
+            if m is not None:
+                self.pos = m.start()
+                return self.buf[self.pos]
+            self.pos = len(self.buf)
+            if not self.fill():
+                return None
+
+    def expect(self, c):
+        if self.next_byte() != c:
+            raise self.error('expected ' + chr(c))
+        self.pos += 1
+
+    # skip a string - the buffer position is at the opening quote
+    def skip_string(self):
+        self.pos += 1
+        while True:
+            j = self.buf.find(b'"', self.pos)
+            if j < 0:
+                # keep any backslashes at the end of the buffer, as the quote after them may be escaped
+                k = len(self.buf)
+                while k > self.pos and self.buf[k - 1] == BACKSLASH:
+                    k -= 1
+                self.pos = k
+                if not self.fill():
+                    raise self.error('unterminated string')
+                continue
+            k = j
+            while k > self.pos and self.buf[k - 1] == BACKSLASH:
+                k -= 1
+            self.pos = j + 1
+            if (j - k) % 2 == 0:
+                # not escaped - the end of the string
+                return
+
+    # skip a number, true, false or null
+    def skip_scalar(self):
+        while True:
+            m = SCALAR_END.search(self.buf, self.pos)
+            if m is not None:
+                self.pos = m.start()
+                return
+            self.pos = len(self.buf)
+            if not self.fill():
+                return
+
+    # skip an object or array - the buffer position is at the opening bracket
+    # the tokens are matched a run at a time and checked against the grammar with a stack of the open brackets
+    def skip_container(self):
+        stack = []
+        nState = VALUE
+        while True:
+            m = TOKEN.match(self.buf, self.pos)
+            if m is None or (m.end() == len(self.buf) and not self.fEOF):
+                # the token may run on into the next chunk - an invalid one is only reported once it is complete
+                if self.next_byte() is None:
+                    raise self.error('unexpected end of file')
+                if SCALAR_END.search(self.buf, self.pos) is None and self.fill():
+                    continue
+                m = TOKEN.match(self.buf, self.pos)
+                if m is None:
+                    raise self.error('unexpected value')
+            c = self.buf[m.end() - 1]
+            if m.lastindex == T_SCALAR:
+                if nState > VALUE_OR_CLOSE:
+                    raise self.error('unexpected value')
+                nState = AFTER_VALUE
+            elif c == QUOTE:
+                if m.lastindex != T_STRING:
+                    self.pos = m.end() - 1
+                    self.skip_string()
+                else:
+                    self.pos = m.end()
+                if nState <= VALUE_OR_CLOSE:
+                    nState = AFTER_VALUE
+                elif nState <= KEY:
+                    nState = AFTER_KEY
+                else:
+                    raise self.error('unexpected string')
+                continue
+            elif c == COMMA:
+                if nState != AFTER_VALUE:
+                    raise self.error('unexpected ,')
+                nState = KEY if stack[-1] == CLOSE_OBJECT else VALUE
+            elif c == COLON:
+                if nState != AFTER_KEY:
+                    raise self.error('unexpected :')
+                nState = VALUE
+            elif c == OPEN_OBJECT or c == OPEN_ARRAY:
+                if nState > VALUE_OR_CLOSE:
+                    raise self.error('unexpected ' + chr(c))
+                if c == OPEN_OBJECT:
+                    stack += [CLOSE_OBJECT]
+                    nState = KEY_OR_CLOSE
+                else:
+                    stack += [CLOSE_ARRAY]
+                    nState = VALUE_OR_CLOSE
+            else:
+                if c != stack[-1] or not (nState == AFTER_VALUE or nState == (VALUE_OR_CLOSE if c == CLOSE_ARRAY
+                                                                              else KEY_OR_CLOSE)):
+                    raise self.error('unexpected ' + chr(c))
+                stack.pop()
+                if not stack:
+                    self.pos = m.end()
+                    return
+                nState = AFTER_VALUE
+            self.pos = m.end()
+
+    # skip the next value
+    def skip_value(self):
+        c = self.next_byte()
+        if c is None:
+            raise self.error('unexpected end of file')
+        if c == QUOTE:
+            self.skip_string()
+        elif c == OPEN_OBJECT or c == OPEN_ARRAY:
+            self.skip_container()
+        else:
+            # the scalar is kept in the buffer until it has been checked - if a value is already being kept
+            # (i.e. this is inside a value being decoded), its start is found from the start of that value
+            fKeep = self.keep < 0
+            if fKeep:
+                self.keep = self.pos
+            nStart = self.pos - self.keep
+            self.skip_scalar()
+            fValid = SCALAR.fullmatch(self.buf, self.keep + nStart, self.pos) is not None
+            if fKeep:
+                self.keep = -1
+            if not fValid:
+                raise self.error('unexpected value')
+
+    # decode the next value
+    def read_value(self):
+        if self.next_byte() is None:
+            raise self.error('unexpected end of file')
+        self.keep = self.pos
+        self.skip_value()
+        value = json.loads(self.buf[self.keep:self.pos])
+        self.keep = -1
+        return value
+
+    # walk an object, finding the fields under a path node
+    def walk_object(self, node, found):
+        self.expect(OPEN_OBJECT)
+        if self.next_byte() == CLOSE_OBJECT:
+            self.pos += 1
+            return
+        while True:
+            if self.next_byte() != QUOTE:
+                raise self.error('expected a key')
+            sKey = self.read_value()
+            self.expect(COLON)
+            child = node.children.get(sKey)
+            if child is None:
+                self.skip_value()
+            elif child.fields:
+                # a field ends here - decode the value, along with anything below it
+                resolve(child, self.read_value(), found)
+            elif self.next_byte() == OPEN_OBJECT:
+                self.walk_object(child, found)
+            else:
+                self.skip_value()
+            c = self.next_byte()
+            if c == COMMA:
+                self.pos += 1
+            elif c == CLOSE_OBJECT:
+                self.pos += 1
+                return
+            else:
+                raise self.error('expected , or }')
+
+    # skip a UTF-8 byte order mark at the start of the file, as json.load does
+    def skip_bom(self):
+        while len(self.buf) - self.pos < len(UTF8_BOM) and self.fill():
+            pass
+        if self.buf.startswith(UTF8_BOM, self.pos):
+            self.pos += len(UTF8_BOM)
+
+    # walk the whole file, finding the fields under the root path node
+    def walk(self, root, found):
+        self.skip_bom()
+        c = self.next_byte()
+        if c == OPEN_OBJECT:
+            self.walk_object(root, found)
+        else:
+            self.skip_value()
+        if self.next_byte() is not None:
+            raise self.error('extra data after the end')
+
+# get the values of a plan's fields from a JSON file
+# files of nStreamMinBytes or more are stream-parsed, smaller ones read with json.load
+# returns (values, missing) - values is a list of [value, target field] in plan order, with None for any field
+# not in the file, and missing is a list of the tags of those fields
+# raises ValueError if the file is not valid JSON
+def extract_fields(s_JSON, plan, nStreamMinBytes=256 * 1024, nChunkSize=CHUNK_SIZE):
+    found = {}
+    with open(s_JSON, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < nStreamMinBytes:
+            resolve(plan.root, json.load(f), found)
+        else:
+            JSONStream(f, nChunkSize).walk(plan.root, found)
+    values = []
+    missing = []
+    for i, (sTag, sTarget) in enumerate(plan.fields):
+        if i in found:
+            values += [[found[i], sTarget]]
+        else:
+            values += [[None, sTarget]]
+            missing += [sTag]
+    return values, missing
+
+# extract the fields from JSON text with json.load and with the stream parser at each chunk size
+# returns the json.load result, and a list of the chunk sizes where the stream parser gave a different one
+# a result is (values, missing), or 'ValueError' if the text is rejected as invalid
+def compare_extract(data, field_list, chunk_sizes=(1, 2, 3, 5, 7, 64)):
+    plan = get_field_plan(field_list)
+    f = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+    try:
+        f.write(data)
+        f.close()
+        try:
+            expected = extract_fields(f.name, plan, nStreamMinBytes=len(data) + 1)
+        except ValueError:
+            expected = 'ValueError'
+        differ = []
+        for nChunkSize in chunk_sizes:
+            try:
+                result = extract_fields(f.name, plan, nStreamMinBytes=0, nChunkSize=nChunkSize)
+            except ValueError:
+                result = 'ValueError'
+            if result != expected:
+                differ += [nChunkSize]
+    finally:
+        os.remove(f.name)
+    return expected, differ
+
+def unit_tests():
+    # run the unit test process
+    n_pass = 0
+    n_fail = 0
+    print("\nRunning unit tests for " + MODULE_NAME)
+
+    # (title, JSON text, field list, whether json.load accepts it)
+    tests = [
+        ('Strings split across chunks',
+         b'{"photo": "' + b'A' * 100 + b'", "name": "Jane Smith", "note": "\\u00e9t\\u00e9 \\\\ end"}',
+         [('name', 'Name'), ('note', 'Note')], True),
+        ('Escaped quotes and backslashes',
+         b'{"a\\"b": "x\\\\", "skip": "say \\"hi\\" \\\\", "list": ["\\"", {"k\\\\": "\\\\"}],'
+         b' "q": "\\"quoted\\\\\\""}',
+         [('a"b', 'AB'), ('q', 'Q')], True),
+        ('Nested paths',
+         b'{"form": {"sig": {"img": "xyz", "n": [1, {"a": 2}]}, "person": {"name": {"first": "Al", "last": "Bo"}},'
+         b' "age": 42, "tags": ["x", "y"], "empty": {}}, "other": [[], {}, null, true, -1.5e3]}',
+         [('form|person|name|first', 'First'), ('form|person|name|last', 'Last'), ('form|age', 'Age'),
+          ('form|tags', 'Tags'), ('form|empty', 'Empty')], True),
+        ('Missing fields',
+         b'{"form": {"age": 42, "person": "not an object"}}',
+         [('form|age', 'Age'), ('form|person|name', 'Name'), ('form|missing', 'Missing'), ('nothing', 'Nothing')],
+         True),
+        ('UTF-8 byte order mark',
+         b'\xef\xbb\xbf {"name": "Jane"}',
+         [('name', 'Name')], True),
+        ('NaN and Infinity',
+         b'{"skip": [NaN, Infinity, -Infinity], "n": -Infinity}',
+         [('n', 'N')], True),
+        ('Invalid - empty array element',
+         b'{"z": [1,,2], "a": 1}', [('a', 'A')], False),
+        ('Invalid - missing colon in a skipped object',
+         b'{"z": {"q" 1}, "a": 1}', [('a', 'A')], False),
+        ('Invalid - trailing commas',
+         b'{"z": [1, 2,], "a": 1}', [('a', 'A')], False),
+        ('Invalid - trailing comma in a skipped object',
+         b'{"z": {"q": 1,}, "a": 1}', [('a', 'A')], False),
+        ('Invalid - missing comma',
+         b'{"z": "x" "a": 1}', [('a', 'A')], False),
+        ('Invalid - bad constant and number',
+         b'{"z": [tru, 01], "a": 1}', [('a', 'A')], False),
+        ('Invalid - mismatched brackets',
+         b'{"z": [1, 2}, "a": 1}', [('a', 'A')], False),
+        ('Invalid - truncated in a skipped string',
+         b'{"z": "abc', [('a', 'A')], False),
+        ('Invalid - truncated after a wanted value',
+         b'{"a": 1, "z": [1, 2', [('a', 'A')], False),
+        ('Invalid - extra data after the end',
+         b'{"a": 1} {}', [('a', 'A')], False),
+    ]
+    for sTitle, data, field_list, fValid in tests:
+        print("\n" + str(n_pass + n_fail+1) + ": " + sTitle)
+        try:
+            expected, differ = compare_extract(data, field_list)
+            if (expected != 'ValueError') != fValid:
+                print('json.load gave an unexpected result: ', expected)
+                n_fail += 1
+            elif differ:
+                print('Stream parser differs from json.load at chunk sizes: ', differ)
+                n_fail += 1
+            else:
+                print('Test passed')
+                n_pass += 1
+        except:
+            print('Extract fields failed...')
+            n_fail += 1
+
+    print("\n" + str(n_pass + n_fail+1) + ": Only the latest field list is kept for a form type")
+    try:
+        plan = get_field_plan([('a', 'A')], 9001)
+        fSame = get_field_plan([['a', 'A']], 9001) is plan
+        new_plan = get_field_plan([('a', 'A'), ('b', 'B')], 9001)
+        if fSame and new_plan is not plan and compiled_plans[9001] == ((('a', 'A'), ('b', 'B')), new_plan):
+            print('Test passed')
+            n_pass += 1
+        else:
+            print('Plan re-used: %s, compiled plans: %s' % (fSame, compiled_plans.get(9001)))
+            n_fail += 1
+    except:
+        print('Compiled plan test failed...')
+        n_fail += 1
+
+    print('\nTotal tests :', n_pass + n_fail)
+    print('  %d tests passed' % n_pass)
+    print('  %d tests failed' % n_fail)
+    print('  %.2f%% success rate\n' % (100.0 * (n_pass / (n_pass + n_fail))))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'TEST':
+        print('Running in test mode...')
+        unit_tests()
@@ -1,6 +1,7 @@
 # Script to parse Formation forms tool output files and pass to mstore for storage
 
 # This script to be run as a scheduled task on 1-minute intervals
+# Alternatively, run with the WATCH parameter to stay resident and react to new forms (see formation_watcher.py)
 # Should assume that other processes will be attempting to create files in the Formation target directory
 # In practice, demo Formation files will be arriving via FTP to a shared directory structure
 
@@ -8,11 +9,16 @@
 
 import sys                                  # System functions, such as command line arguments
 import os                                   # OS functions, such as directory scanning
-import shutil                               # additional file copy functions
 import stat                                 # needed for CHMOD
 import mstore                               # mstore database functions
 import mstoreenvironment as ENV             # mstore environment parameters for this system
-import json                                 # JSON file parsing library
+import threading                            # worker threads for the processing pipeline
+import queue                                # bounded queues between the pipeline stages
+import concurrent.futures                   # optional process pool for JSON parsing
+import formation_index                      # persistent index of form folder states
+import formation_transfer                   # PDF hand-off to the Sweep location
+import formation_json                       # field extraction from the form JSON files
+import mstoremetrics as M                   # stage timings and counts
 
 MODULE_NAME = 'formation_parser.py'
 FORMATION_BASE = ''
@@ -28,30 +34,53 @@ def connect_to_mstore():
                         password_key=pass_secure, credentials_file=credentials_p)
     return mddatabase
 
+# get the shared pool of mstore connections, creating it on first use
+# used by the pipeline writer threads - each borrows a connection for each batch of forms
+def get_mstore_pool():
+    return mstore.MDatabasePool.get_pool(ENV.server_name, ENV.database_name, ENV.user_secure, ENV.pass_secure,
+                                         credentials_file=ENV.credentials_p, min_size=ENV.DB_POOL_MIN_SIZE,
+                                         max_size=ENV.DB_POOL_MAX_SIZE, idle_timeout=ENV.DB_POOL_IDLE_SECONDS,
+                                         validate_after=ENV.DB_POOL_VALIDATE_SECONDS)
+
 # helper function - prune a directory tree
 # this also removes read-only files, unlike shutil.rmtree()
+@M.timed('prune_directory')
 def prune_directory(sDirectory, fRetainLast=False):
     for root, dirs, files in os.walk(sDirectory, topdown=False):
         for name in files:
-            os.chmod(os.path.join(root, name), stat.S_IWRITE)
-            os.remove(os.path.join(root, name))
+            sFile = os.path.join(root, name)
+            try:
+                os.remove(sFile)
+            except PermissionError:
+                # read-only file (Windows) - make it writable and try again
+                os.chmod(sFile, stat.S_IWRITE)
+                os.remove(sFile)
         for name in dirs:
             os.rmdir(os.path.join(root, name))
     if not fRetainLast:
         os.rmdir(sDirectory)
 
 # helper function - copy a file and optionally delete the source
-def copy_file(sSourceFileWithExtension, sTargetFileWithExtension):
+# the file is renamed or linked where the source and target are on the same file system, otherwise copied
+# (see formation_transfer.py) - the target only appears under its final name once complete
+# fKeepSource = False lets the file be moved rather than copied, the source may then be gone or left in place
+# returns the transfer method used, raises OSError on failure
+@M.timed('copy_file')
+def copy_file(sSourceFileWithExtension, sTargetFileWithExtension, fKeepSource=True):
     if ENV.DEBUG:
         print('Attempting to copy %s to %s.' % (sSourceFileWithExtension, sTargetFileWithExtension))
-    shutil.copy(sSourceFileWithExtension,sTargetFileWithExtension)
-    return True
+    sMethod = formation_transfer.transfer_file(sSourceFileWithExtension, sTargetFileWithExtension, fKeepSource,
+                                               ENV.HANDOFF_METHOD, ENV.HANDOFF_FSYNC)
+    M.METRICS.count('handoff_' + sMethod)
+    if ENV.DEBUG:
+        print('Transferred by %s' % sMethod)
+    return sMethod
 
 # helper function - check that a directory location exists, create if not
 def check_create_dir(sDir):
     try:
         sPath = sDir
-        d = os.path.dirname(sPath + '\\')
+        d = os.path.dirname(os.path.join(sPath, ''))
         if not os.path.exists(d):
             os.mkdir(d)
         return True
@@ -75,18 +104,24 @@ def get_form_type_id(s_form):
 def get_form_types():
     form_types = []
     FORMATION_BASE = ENV.FORMATION_BASE
-    for d in os.listdir(FORMATION_BASE):
-        if os.path.isdir(os.path.join(FORMATION_BASE, d)):
-            # found a directory here
-            # before we assume that this is going to be a form type, we get the trailing numeric values
-            form_type_id = get_form_type_id(d)
-            if form_type_id and form_type_id.isnumeric():
-                form_types += [[d,int(form_type_id),(os.path.join(FORMATION_BASE, d))]]
+    with os.scandir(FORMATION_BASE) as it:
+        for e in it:
+            if e.is_dir():
+                # found a directory here
+                # before we assume that this is going to be a form type, we get the trailing numeric values
+                form_type_id = get_form_type_id(e.name)
+                if form_type_id and form_type_id.isnumeric():
+                    form_types += [[e.name,int(form_type_id),e.path]]
     return form_types
 
 # read the list of forms in a directory
 # we need a directory, with one JSON file and one PDF
-def get_form_list(s_dir):
+# if a scan index is passed in, only folders which have changed since the last scan are opened
+@M.timed('get_form_list')
+def get_form_list(s_dir, index=None):
+    if index is not None:
+        return index.scan_form_type(s_dir)
+
     forms_list = []
 
     for d in os.listdir(s_dir):
@@ -94,17 +129,7 @@ def get_form_list(s_dir):
         if os.path.isdir(form_path):
             # this is a directory, so we can check for JSON and PDF files being present
             #print('Found path',form_path)
-            f_JSON = ''
-            f_PDF = ''
-            for f in os.listdir(form_path):
-                if f.upper().endswith('.JSON'):
-                    # found a JSON file
-                    #print('Found JSON file: ',f)
-                    f_JSON = f
-                if f.upper().endswith('.PDF'):
-                    # found a PDF file
-                    #print('Found PDF file: ', f)
-                    f_PDF = f
+            f_JSON, f_PDF = formation_index.get_form_files(form_path)
             if (f_JSON != '') and (f_PDF != ''):
                 forms_list += [[form_path, f_JSON, f_PDF]]
     return forms_list
@@ -113,133 +138,428 @@ def get_form_list(s_dir):
 def get_form_target_location(md, nFormId):
     sweep_base = ENV.SWEEP_BASE
     s_out_dir = os.path.join(sweep_base, 'new')
-    form_target_list = md.get_MAF_list(ENV.FORM_TARGET_MAF_LIST)
+    form_target_list = get_form_config_items(md, ENV.FORM_TARGET_MAF_LIST, 1, nFormId)
     # First item will be the form Id, the second the path
     for f in form_target_list:
-        if f[0] == str(nFormId):
-            # have found the form we're interested in
-            s_out_dir = os.path.join(sweep_base, f[1])
+        # have found the form we're interested in
+        s_out_dir = os.path.join(sweep_base, f[1])
     return s_out_dir
 
-# get the form data field list
+# get the form data field list, as a compiled extraction plan (see formation_json.py)
+# with the configuration indexed, the plans for all form types are built together and kept with the cached
+# MAF list - so are re-used for every form and run until the list changes
 def get_form_field_list(md, nFormId):
-    form_field_list = []
-    all_field_list = md.get_MAF_list(ENV.FORM_FIELD_MAF_LIST)
-    # will be of the form:
+    if ENV.FORM_CONFIG_INDEX:
+        plans = mstore.MAF_LIST_CACHE.get_derived(md, ENV.FORM_FIELD_MAF_LIST, 'form_field_plans',
+                                                  build_form_field_plans)
+        plan = plans.get(str(nFormId))
+        if plan is None:
+            plan = formation_json.get_field_plan([], nFormId)
+        return plan
+    all_field_list = md.get_MAF_list_items(ENV.FORM_FIELD_MAF_LIST, 2, str(nFormId))
+    return formation_json.get_field_plan([[f[2], f[3]] for f in all_field_list], nFormId)
+
+# build the extraction plans for all form types from the form field MAF list, as form type Id -> plan
+def build_form_field_plans(rsMAF):
+    # rows will be of the form:
     # f[0] = Id (not useful)
     # f[1] = form type Id
     # f[2] = field tag, pipe delimited
     # f[3] = target field name
-    for f in all_field_list:
-        if f[1] == str(nFormId):
-            # correct form
-            form_field_list += [[f[2],f[3]]]
-    return form_field_list
+    form_field_lists = {}
+    for f in rsMAF:
+        form_field_lists.setdefault(str(f[1]), []).append([f[2], f[3]])
+    plans = {}
+    for sFormId, field_list in form_field_lists.items():
+        plans[sFormId] = formation_json.FieldPlan(field_list, sFormId)
+    return plans
+
+# get the items of a form configuration MAF list for one form type - nKeyItem is the item holding the form type Id
+# either from a dictionary index of the whole list, built once per run, or filtered by the database
+def get_form_config_items(md, nMAFListID, nKeyItem, nFormId):
+    if ENV.FORM_CONFIG_INDEX:
+        return md.get_MAF_list_index(nMAFListID, nKeyItem).get(str(nFormId), [])
+    return md.get_MAF_list_items(nMAFListID, nKeyItem, str(nFormId))
 
 # extract fields from a JSON file
 def get_values(s_JSON, field_list):
     # s_JSON = full path to JSON file to import
     # field_list = fields to extract, tuple of (tag, target field) - note that the tag may be a pipe-delimited list
     # returns a list of tuples of (value, target_field)
-    values = []
-    try:
-        with open(s_JSON) as f:
-            data = json.load(f)
-        #print(s_JSON,data)
-        for f in field_list:
-            #print('Tag: %s' % f[0])
-            h =  f[0].split('|')
-            #print('Split :', h)
-            d = data
-            for ref in h[0:len(h) - 1]:
-                d = d[ref]
-                #print(d)
-            val = d[h[len(h)-1]]
-            values += [[val, f[1]]]
-        return values
-    except:
-        # swallow the error and pass up an empty list of values - this will cause the form to be ignored
-        # we want to carry on with other forms, even if the JSON config is wrong...
+    # an empty list if any field is missing - get_form_values() gives the fields which were found
+    values, missing = get_form_values(s_JSON, formation_json.get_field_plan(field_list))
+    if missing:
         return []
+    return values
+
+# extract the fields in a compiled plan (from get_form_field_list()) from a JSON file
+# large files are stream-parsed, pulling out only these fields (see formation_json.py)
+# returns (values, missing) - a list of [value, target field] for every field in the plan, with None for a field
+# not found, and the tags of the fields not found - if the file can't be read as JSON, no fields are found
+@M.timed('get_values')
+def get_form_values(s_JSON, plan):
+    try:
+        return formation_json.extract_fields(s_JSON, plan, ENV.JSON_STREAM_MIN_KB * 1024)
+    except (OSError, ValueError) as e:
+        # carry on with other forms, even if this one is unreadable - the fields are reported as missing
+        print('Failed to read %s: %s' % (s_JSON, e))
+        return [[None, f[1]] for f in plan.fields], [f[0] for f in plan.fields]
+
+# fields not found in forms, as (form type Id, tag) -> number of forms - reported at the end of each run
+field_misses = {}
+field_misses_lock = threading.Lock()
+
+# record the fields missing from a form
+def record_field_misses(job):
+    if not job.missing:
+        return
+    M.METRICS.count('fields_missing', len(job.missing))
+    with field_misses_lock:
+        for sTag in job.missing:
+            key = (str(job.nFormId), sTag)
+            field_misses[key] = field_misses.get(key, 0) + 1
+    if ENV.DEBUG:
+        print('Fields missing from %s: %s' % (job.s_JSON_file, ', '.join(job.missing)))
+
+# print the fields missing from forms since the last report, so misconfigured paths can be spotted
+def report_field_misses():
+    with field_misses_lock:
+        misses = dict(field_misses)
+        field_misses.clear()
+    for (sFormId, sTag), n in sorted(misses.items()):
+        print('Form type %s: field %s not found in %d form(s)' % (sFormId, sTag, n))
+    return misses
 
 # write fields to SQL database, return the unique file name to use
 def write_fields(md, values, s_original_path, s_form_ref='unknown', s_form_id='unknown'):
     # md will be an mstore database object
     # values will be a list of tuples (value, field)
-    #print('Hello!')
-    sSQL = 'insert into ' + ENV.FORMATION_DATA_TABLE
-    sFields = 'originalpath, formtype, formref'
-    sValues = md.quote_string(s_original_path)
-    sValues += ',' + md.quote_string(s_form_ref)
-    sValues += ',' + md.quote_string(s_form_id)
-    #print(sSQL)
-    for fv in values:
-        sFields += ',' + fv[1]
-        sValues += ',' + md.quote_string(str(fv[0]))            # str() because might be a numeric
-    sSQL += '(' + sFields + ') values (' + sValues + ')'
-    try:
-        md.execute(sSQL)
-        sSQL = 'select max(ID) [NewID] from ' + ENV.FORMATION_DATA_TABLE
-        #print(sSQL)
-        rs = md.getRecordSet(sSQL)
-        #print(rs[0])
-        new_id = rs[0].NewID
-        return new_id
-    except:
-        return -1
+    return write_fields_batch(md, [(values, s_original_path, s_form_ref, s_form_id)])[0]
+
+# write fields for a batch of forms to SQL database, return the unique file names to use
+@M.timed('write_fields')
+def write_fields_batch(md, forms, batch_size=100):
+    # forms will be a list of tuples (values, original path, form ref, form id), as for write_fields()
+    # forms with the same set of fields are inserted together, in statements of up to batch_size rows
+    # and committed together - the new Ids come back in the same order as forms, -1 for any that failed
+    # the fields of a form type come in a fixed order (see formation_json.FieldPlan), so all forms of a type are
+    # in the same group and share the few cached insert statements for its columns (see MDatabase.insert_rows())
+    groups = {}
+    for n in range(len(forms)):
+        values, s_original_path, s_form_ref, s_form_id = forms[n]
+        fields = ('originalpath', 'formtype', 'formref') + tuple([fv[1] for fv in values])
+        row = [s_original_path, s_form_ref, s_form_id]
+        for fv in values:
+            # str() because might be a numeric - a field not found in the form is left NULL
+            row += [None if fv[0] is None else str(fv[0])]
+        groups.setdefault(fields, []).append([n, row])
+
+    new_ids = [-1] * len(forms)
+    for fields, group in groups.items():
+        ids = md.insert_rows(ENV.FORMATION_DATA_TABLE, fields, [g[1] for g in group], 'ID', batch_size)
+        if ids is not None:
+            for i in range(len(group)):
+                if ids[i] is not None:
+                    new_ids[group[i][0]] = ids[i]
+    return new_ids
+
+# a single form passing through the processing stages - parse, write to mstore, hand off to Sweep
+class FormJob:
+
+    def __init__(self, form, nFormId, s_output_location, field_list):
+        # form is tuple of (folder, JSON file, PDF file) - files don't have a path appended
+        self.form = form
+        self.nFormId = nFormId
+        self.s_output_location = s_output_location
+        self.field_list = formation_json.get_field_plan(field_list, nFormId)
+        self.s_JSON_file = os.path.join(form[0], form[1])
+        self.s_PDF_file = os.path.join(form[0], form[2])
+        self.values = []
+        self.missing = []                       # tags of the fields not found in the JSON
+        self.new_id = -1
+        self.fProcessed = False
+        self.s_transfer = ''                    # how the PDF was handed off - see formation_transfer.py
+
+# stage 1 - load the JSON and get the values
+def parse_form(job):
+    job.values, job.missing = get_form_values(job.s_JSON_file, job.field_list)
+    record_field_misses(job)
+    return job
+
+# stage 2 - write the JSON data to mstore and get a unique Id - this will be the unique file Id
+# if there are no values, still process this file - likely a new form
+def write_form(md, job):
+    write_forms(md, [job])
+    return job.new_id >= 0
+
+# stage 2, for a batch of forms - a single round-trip and commit for all forms with the same fields
+def write_forms(md, jobs):
+    forms = []
+    for job in jobs:
+        forms += [(job.values, job.s_PDF_file, str(job.nFormId), get_form_type_id(job.form[0]))]
+    new_ids = write_fields_batch(md, forms, ENV.WRITE_BATCH_SIZE)
+    for i in range(len(jobs)):
+        jobs[i].new_id = new_ids[i]
+
+# stage 3 - copy the PDF to the Sweep location for this form type and clean out the form folder
+def hand_off_form(job):
+    s_output_PDF = str(job.new_id) + '.pdf'
+    s_output_PDF = os.path.join(job.s_output_location, s_output_PDF)
+
+    # the PDF is moved rather than copied if the form folder is to be removed anyway
+    job.s_transfer = copy_file(job.s_PDF_file, s_output_PDF, ENV.DEBUG)
+    if job.s_transfer:
+        # clean out the files for this form - remove the files, remove the directory
+        if ENV.DEBUG == False:
+            prune_directory(job.form[0])
+        else:
+            print('\n** In DEBUG mode, no files removed! **')
+            print('Be careful of filling up your disk drives!')
+        job.fProcessed = True
+    return job.fProcessed
+
+# process a single complete form - write the data to mstore, copy the PDF to Sweep and clean up
+# returns True if the form was written and handed off, False otherwise
+def process_form(md, nFormId, s_output_location, field_list, form):
+    # first thing is to check that the output directory is OK for this form type
+    if check_create_dir(s_output_location):
+        job = parse_form(FormJob(form, nFormId, s_output_location, field_list))
+        if not write_form(md, job):
+            # failed to write to mstore - leave the form in place, rather than copying over an earlier -1.pdf
+            return False
+        return hand_off_form(job)
+    return False
+
+# record the outcome of a form in the scan index
+def set_form_state(index, form, fProcessed):
+    if fProcessed:
+        M.METRICS.count('forms_processed')
+    else:
+        M.METRICS.count('forms_failed')
+    if index is not None:
+        if fProcessed:
+            index.set_state(form[0], formation_index.FORM_PROCESSED)
+        else:
+            index.set_state(form[0], formation_index.FORM_FAILED)
+
+# Pipeline to process forms with a pool of threads for each stage
+# Each stage has a bounded queue in front of it, so a slow stage holds back the earlier ones (backpressure)
+# Each form passes through the stages in order - there is no ordering between different forms
+# Each database writer thread borrows its own mstore connection from the pool, as a pyodbc connection can't be shared
+class FormPipeline:
+
+    STOP = None                                 # queue marker to shut down a worker
+
+    def __init__(self, pool, parse_workers=2, write_workers=2, copy_workers=2, queue_size=100,
+                 parse_processes=0, index=None):
+        # pool is the MDatabasePool to borrow connections from for writing
+        # parse_processes > 0 runs the JSON parsing in a process pool, for very large forms
+        self.pool = pool
+        self.index = index
+        self.lock = threading.Condition()
+        self.n_processed = 0
+        self.n_failed = 0
+        self.n_in_flight = 0
+        self.parse_executor = None
+        if parse_processes > 0:
+            self.parse_executor = concurrent.futures.ProcessPoolExecutor(parse_processes)
+        self.parse_queue = queue.Queue(queue_size)
+        self.write_queue = queue.Queue(queue_size)
+        self.copy_queue = queue.Queue(queue_size)
+        self.stages = [
+            (self.parse_queue, self.start_workers(self.parse_worker, parse_workers)),
+            (self.write_queue, self.start_workers(self.write_worker, write_workers)),
+            (self.copy_queue, self.start_workers(self.copy_worker, copy_workers)),
+        ]
+
+    def start_workers(self, target, count):
+        threads = []
+        for i in range(max(count, 1)):
+            t = threading.Thread(target=target, daemon=True)
+            t.start()
+            threads += [t]
+        return threads
+
+    # add a form to the pipeline - blocks if the pipeline is full
+    def submit(self, job):
+        with self.lock:
+            self.n_in_flight += 1
+        self.parse_queue.put(job)
+
+    # wait for all submitted forms to complete, leaving the workers running for more
+    def wait(self):
+        with self.lock:
+            while self.n_in_flight > 0:
+                self.lock.wait()
+
+    # wait for all submitted forms to complete and shut down the workers
+    # returns the number of forms processed and failed
+    def close(self):
+        self.wait()
+        for q, threads in self.stages:
+            for t in threads:
+                q.put(self.STOP)
+            for t in threads:
+                t.join()
+        if self.parse_executor is not None:
+            self.parse_executor.shutdown()
+        return self.n_processed, self.n_failed
+
+    # record the end of a form, successful or not
+    def finish(self, job, fProcessed):
+        with self.lock:
+            if fProcessed:
+                self.n_processed += 1
+            else:
+                self.n_failed += 1
+            set_form_state(self.index, job.form, fProcessed)
+            self.n_in_flight -= 1
+            self.lock.notify_all()
+
+    def parse_worker(self):
+        while True:
+            job = self.parse_queue.get()
+            if job is self.STOP:
+                return
+            try:
+                if self.parse_executor is not None:
+                    # the parse timings come back with the values, as they are recorded in the worker process
+                    job.values, job.missing = M.record_result(self.parse_executor.submit(
+                        M.call_recorded, get_form_values, job.s_JSON_file, job.field_list).result())
+                    record_field_misses(job)
+                else:
+                    parse_form(job)
+                self.write_queue.put(job)
+            except Exception as e:
+                print('Failed to parse %s: %s' % (job.s_JSON_file, e))
+                self.finish(job, False)
+
+    # database writes are batched - take whatever is waiting in the queue, up to the batch size
+    def write_worker(self):
+        fStop = False
+        while not fStop:
+            jobs = [self.write_queue.get()]
+            if jobs[0] is self.STOP:
+                return
+            while len(jobs) < ENV.WRITE_BATCH_SIZE:
+                try:
+                    job = self.write_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is self.STOP:
+                    fStop = True
+                    break
+                jobs += [job]
+            try:
+                with self.pool.connection() as md:
+                    write_forms(md, jobs)
+            except Exception as e:
+                print('Failed to write batch of %d forms: %s' % (len(jobs), e))
+            for job in jobs:
+                if job.new_id >= 0:
+                    self.copy_queue.put(job)
+                else:
+                    self.finish(job, False)
+
+    def copy_worker(self):
+        while True:
+            job = self.copy_queue.get()
+            if job is self.STOP:
+                return
+            try:
+                self.finish(job, hand_off_form(job))
+            except Exception as e:
+                print('Failed to hand off %s: %s' % (job.s_PDF_file, e))
+                self.finish(job, False)
+
+# create a pipeline using the environment settings
+# pool is the connection pool for the writer threads - the shared mstore pool, unless another is passed in
+def create_pipeline(index=None, pool=None):
+    if pool is None:
+        pool = get_mstore_pool()
+    return FormPipeline(pool, ENV.PIPELINE_PARSE_WORKERS, ENV.PIPELINE_WRITE_WORKERS,
+                        ENV.PIPELINE_COPY_WORKERS, ENV.PIPELINE_QUEUE_SIZE, ENV.PIPELINE_PARSE_PROCESSES, index)
+
+# process a list of complete forms for one form type
+# the state of each form is recorded in the scan index, if there is one
+# if a pipeline is passed in, the forms are queued to it rather than processed here
+def process_form_list(md, f_type, form_list, index=None, pipeline=None):
+    # f_type is tuple of (full name, Id, path to forms)
+
+    # load in the mstore configuration, if any - done once, so we have it for all forms of this type
+    nFormId = f_type[1]
+    s_output_location = get_form_target_location(md, nFormId)
+    field_list = get_form_field_list(md, nFormId)
+
+    if pipeline is not None:
+        # first thing is to check that the output directory is OK for this form type
+        if check_create_dir(s_output_location):
+            for form in form_list:
+                pipeline.submit(FormJob(form, nFormId, s_output_location, field_list))
+        else:
+            for form in form_list:
+                set_form_state(index, form, False)
+        return
 
-def run_process():
+    # first thing is to check that the output directory is OK for this form type
+    if not check_create_dir(s_output_location):
+        for form in form_list:
+            set_form_state(index, form, False)
+        return
+
+    # work through the forms in batches - parse each form, write the batch to mstore, then hand off each PDF
+    for nStart in range(0, len(form_list), ENV.WRITE_BATCH_SIZE):
+        jobs = []
+        for form in form_list[nStart:nStart + ENV.WRITE_BATCH_SIZE]:
+            jobs += [parse_form(FormJob(form, nFormId, s_output_location, field_list))]
+        write_forms(md, jobs)
+        for job in jobs:
+            try:
+                # if the write failed, leave the form in place rather than copying over an earlier -1.pdf
+                fProcessed = job.new_id >= 0 and hand_off_form(job)
+            except OSError:
+                fProcessed = False
+            set_form_state(index, job.form, fProcessed)
+
+def run_process(md=None, pool=None):
     # run the parsing process
-    md = connect_to_mstore()
+    # a long-running caller (see formation_watcher.py) can pass in an already connected database object
+    # and a connection pool for the pipeline writers (see formation_benchmark.py)
+    if md is None:
+        md = connect_to_mstore()
 
     if not check_create_dir(ENV.SWEEP_BASE): return            # check that this directory exists, end otherwise
 
+    # load the scan index, so that unchanged form folders are skipped
+    index = None
+    if ENV.SCAN_INDEX_FILE:
+        index = formation_index.FormScanIndex(ENV.SCAN_INDEX_FILE, ENV.SCAN_FAILED_RETRY_SECONDS)
+
+    # forms are processed in parallel, unless the pipeline is switched off
+    pipeline = None
+    if ENV.PIPELINE_WRITE_WORKERS > 0:
+        pipeline = create_pipeline(index, pool)
+
     # read in the list of form types from the Formation base location
     form_types = get_form_types()
 
     # for each form type
     for f_type in form_types:
 
-        # f_type is tuple of (full name, Id, path to forms)
-
-        # load in the mstore configuration, if any - done once, so we have it for all forms of this type
-        nFormId = f_type[1]
-        s_output_location = get_form_target_location(md, nFormId)
-        field_list = get_form_field_list(md, nFormId)
-
         # get the list of forms - must be complete with JSON data and a PDF
-        form_list = get_form_list(f_type[2])
-
-        # for each form
-        for form in form_list:
-
-            # first thing is to check that the output directory is OK for this form type
-            if check_create_dir(s_output_location):
-
-                # form is tuple of (folder, JSON file, PDF file) - files don't have a path appended
-                s_JSON_file = os.path.join(form[0],form[1])
-                s_PDF_file = os.path.join(form[0],form[2])
-                #print(s_JSON_file,s_PDF_file)
-
-                # load the JSON and get the values
-                values = get_values(s_JSON_file,field_list)
+        form_list = get_form_list(f_type[2], index)
 
-                # if there are no values, still process this file - likely a new form
-                # write the JSON data to mstore and get a unique Id - this will be the unique file Id
-                new_id = write_fields(md, values, s_PDF_file, str(nFormId), get_form_type_id(form[0]))
+        if form_list:
+            process_form_list(md, f_type, form_list, index, pipeline)
 
-                s_output_PDF = str(new_id) + '.pdf'
-                s_output_PDF = os.path.join(s_output_location, s_output_PDF)
+    if pipeline is not None:
+        pipeline.close()
 
-                # copy the PDF to the Sweep location for this form type
-                if copy_file(s_PDF_file, s_output_PDF):
-                    # clean out the files for this form - remove the files, remove the directory
-                    if ENV.DEBUG == False:
-                        prune_directory(form[0])
-                    else:
-                        print('\n** In DEBUG mode, no files removed! **')
-                        print('Be careful of filling up your disk drives!')
+    if index is not None:
+        index.save()
 
+    report_field_misses()
+    M.write_metrics()
 
 def unit_tests():
     # run the unit test process
@@ -353,6 +673,11 @@ if __name__ == "__main__":
             print('Running in test mode...')
             # run unit tests
             unit_tests()
+        if sys.argv[1] == 'WATCH':
+            print('Running in watch mode...')
+            # run as a resident process, reacting to changes in the Formation base location
+            import formation_watcher
+            formation_watcher.run_watcher()
     else:
         # run the live program
         run_process()
\ No newline at end of file
@@ -0,0 +1,135 @@
+# File transfer for handing Formation PDFs over to the Sweep location
+# Scanned PDFs can be several MB each, so the file is not copied through Python where the OS can do better:
+#   - same file system: renamed into place (source not kept) or hard linked (source kept) - no data is copied
+#   - different file systems: copied in the kernel with copy_file_range() or sendfile(), falling back to a
+#     plain copy where neither is available (e.g. Windows)
+# A copy is written to a temporary file next to the target and renamed once complete, so the file only ever
+# appears in the Sweep location under its final name, with all of its data
+# Will have minimum dependencies - standard library only
+
+import os                                   # OS functions, for the renames, links and kernel copies
+import sys                                  # for checking the platform
+import shutil                               # plain copy, where the kernel copies are not available
+
+MODULE_NAME = 'formation_transfer.py'
+
+# ways a file can be transferred - returned by transfer_file(), fastest first
+TRANSFER_RENAME = 'rename'                  # moved, same file system - source not kept
+TRANSFER_LINK = 'link'                      # hard link, same file system - source kept
+TRANSFER_COPY_FILE_RANGE = 'copy_file_range'    # kernel copy, Linux
+TRANSFER_SENDFILE = 'sendfile'              # kernel copy, Linux and others
+TRANSFER_COPY = 'copy'                      # read and written by this process
+
+# fsync policies
+FSYNC_NONE = 'none'                         # leave it to the OS - fastest, but a crash can leave an empty file
+FSYNC_FILE = 'file'                         # flush a copied file's data before it is renamed into place
+FSYNC_FULL = 'full'                         # also flush the target directory, so the new name survives a crash
+
+TEMP_SUFFIX = '.part'                       # temporary file name - doesn't end .pdf, so is not picked up early
+
+# check if a file and a directory are on the same file system (so the file can be renamed or linked there)
+def same_device(sFile, sDir):
+    try:
+        return os.stat(sFile).st_dev == os.stat(sDir).st_dev
+    except OSError:
+        return False
+
+# flush a directory to disk, so that a rename or new link within it is durable - not possible on Windows
+def fsync_dir(sDir):
+    if sys.platform.startswith('win'):
+        return
+    fd = os.open(sDir, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# copy nSize bytes from one open file to another, in the kernel if possible
+# returns the method used
+def copy_data(fSource, fTarget, nSize):
+    nSource = fSource.fileno()
+    nTarget = fTarget.fileno()
+    if hasattr(os, 'copy_file_range') and nSize > 0:
+        try:
+            nDone = 0
+            while nDone < nSize:
+                n = os.copy_file_range(nSource, nTarget, nSize - nDone, nDone, nDone)
+                if n == 0:
+                    break
+                nDone += n
+            if nDone == nSize:
+                return TRANSFER_COPY_FILE_RANGE
+        except OSError:
+            # not supported for these files (e.g. older kernels across file systems) - try the next way
+            pass
+        fTarget.truncate(0)
+    if hasattr(os, 'sendfile') and nSize > 0:
+        try:
+            os.lseek(nTarget, 0, os.SEEK_SET)
+            nDone = 0
+            while nDone < nSize:
+                n = os.sendfile(nTarget, nSource, nDone, nSize - nDone)
+                if n == 0:
+                    break
+                nDone += n
+            if nDone == nSize:
+                return TRANSFER_SENDFILE
+        except OSError:
+            pass
+        fTarget.truncate(0)
+    fSource.seek(0)
+    fTarget.seek(0)
+    shutil.copyfileobj(fSource, fTarget, 1024 * 1024)
+    return TRANSFER_COPY
+
+# copy a file to a temporary name next to the target, then rename it into place
+def copy_into_place(sSource, sTarget, sFsync):
+    sTemp = sTarget + TEMP_SUFFIX
+    try:
+        with open(sSource, 'rb') as fSource, open(sTemp, 'wb') as fTarget:
+            sMethod = copy_data(fSource, fTarget, os.fstat(fSource.fileno()).st_size)
+            if sFsync != FSYNC_NONE:
+                fTarget.flush()
+                os.fsync(fTarget.fileno())
+        os.replace(sTemp, sTarget)
+    except OSError:
+        try:
+            os.remove(sTemp)
+        except OSError:
+            pass
+        raise
+    return sMethod
+
+# transfer a file to the target name, returning the method used (one of the TRANSFER_ values above)
+# fKeepSource = False allows the source to be moved rather than copied, where on the same file system
+# sMethod = 'auto' to rename/link where possible, or 'copy' to always copy (the source is then left in place)
+# raises OSError if the transfer fails - the target is then either unchanged or not there
+def transfer_file(sSource, sTarget, fKeepSource=True, sMethod='auto', sFsync=FSYNC_FILE):
+    sTargetDir = os.path.dirname(os.path.abspath(sTarget))
+    sUsed = ''
+    if sMethod == 'auto' and same_device(sSource, sTargetDir):
+        try:
+            if fKeepSource:
+                # link under a temporary name and rename, so an existing target is replaced in one step
+                sTemp = sTarget + TEMP_SUFFIX
+                if os.path.lexists(sTemp):
+                    os.remove(sTemp)
+                os.link(sSource, sTemp)
+                try:
+                    os.replace(sTemp, sTarget)
+                finally:
+                    # a rename onto another link to the same file does nothing, so the temporary link may be left
+                    if os.path.lexists(sTemp):
+                        os.remove(sTemp)
+                sUsed = TRANSFER_LINK
+            else:
+                os.replace(sSource, sTarget)
+                sUsed = TRANSFER_RENAME
+        except OSError:
+            # e.g. no hard links on this file system, or a bind mount across file systems - copy instead
+            sUsed = ''
+    if sUsed == '':
+        sUsed = copy_into_place(sSource, sTarget, sFsync)
+    if sFsync == FSYNC_FULL:
+        fsync_dir(sTargetDir)
+    return sUsed
@@ -0,0 +1,299 @@
+# Resident watcher for the Formation forms drop
+# Alternative to running formation_parser.py as a scheduled task every minute
+# Keeps a single mstore database connection open and only looks at form folders which have changed
+# The outcome of each form is kept in the scan index (see formation_index.py), which is also checked in full every
+# WATCH_RESCAN_SECONDS - so forms whose events were missed are found, and failed forms are tried again
+# On Linux, uses inotify (through ctypes, so no extra libraries needed) - otherwise falls back to polling
+
+# Run with: python formation_parser.py WATCH    (or run this module directly)
+
+import sys                                  # System functions
+import os                                   # OS functions, such as directory scanning
+import time                                 # for the settle delay and polling interval
+import select                               # waiting on the inotify file descriptor
+import struct                               # unpacking inotify events
+import ctypes                               # calling inotify in the C library
+import ctypes.util
+import formation_parser as FP               # the form processing functions
+import formation_index                      # form folder states, for retrying failed forms
+import mstoremetrics as M                   # stage timings and event counts
+import mstoreenvironment as ENV             # mstore environment parameters for this system
+
+MODULE_NAME = 'formation_watcher.py'
+
+# inotify constants, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK if hasattr(os, 'O_NONBLOCK') else 0
+IN_CLOEXEC = 0o2000000
+
+WATCH_DIR_MASK = IN_CREATE | IN_MOVED_TO                        # base and form type directories
+WATCH_FORM_MASK = IN_CREATE | IN_MOVED_TO | IN_MODIFY | IN_CLOSE_WRITE     # form folders - files arriving
+INOTIFY_EVENT = struct.Struct('iIII')                           # wd, mask, cookie, len
+
+# Monitor using inotify - reports the form folders which have seen file system events
+class InotifyMonitor:
+
+    fd = -1
+    libc = None
+
+    def __init__(self, s_base):
+        self.s_base = s_base
+        self.watches = {}               # watch descriptor -> (path, depth), depth 0 = base, 1 = form type, 2 = form
+        self.changed = set()            # form folders with events since the last call to get_changed()
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.rescan()
+
+    # add a watch for a directory, raises OSError if the watch limit has been hit
+    def add_watch(self, s_path, depth):
+        mask = WATCH_FORM_MASK if depth == 2 else WATCH_DIR_MASK
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(s_path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed for ' + s_path)
+        self.watches[wd] = (s_path, depth)
+
+    # watch a new form type directory and everything already in it
+    def add_form_type(self, s_path):
+        self.add_watch(s_path, 1)
+        for e in os.scandir(s_path):
+            if e.is_dir():
+                self.add_form(e.path)
+
+    # watch a new form folder - it is marked as changed, as files may have arrived before the watch was added
+    def add_form(self, s_path):
+        self.add_watch(s_path, 2)
+        self.changed.add(s_path)
+
+    # (re)build all of the watches - used at start-up and if the kernel event queue overflows
+    def rescan(self):
+        for wd in list(self.watches):
+            self.libc.inotify_rm_watch(self.fd, wd)
+        self.watches = {}
+        self.add_watch(self.s_base, 0)
+        for e in os.scandir(self.s_base):
+            if e.is_dir():
+                self.add_form_type(e.path)
+
+    # handle a single event
+    def handle_event(self, wd, mask, s_name):
+        if mask & IN_Q_OVERFLOW:
+            # lost events - have to look at everything again
+            self.rescan()
+            return
+        if mask & IN_IGNORED:
+            # watch removed by the kernel, e.g. form folder pruned after processing
+            self.watches.pop(wd, None)
+            return
+        if wd not in self.watches:
+            return
+        s_dir, depth = self.watches[wd]
+        s_path = os.path.join(s_dir, s_name)
+        try:
+            if depth == 0 and (mask & IN_ISDIR):
+                self.add_form_type(s_path)
+            elif depth == 1 and (mask & IN_ISDIR):
+                self.add_form(s_path)
+            elif depth == 2:
+                self.changed.add(s_dir)
+        except FileNotFoundError:
+            # directory has gone again before we could watch it
+            pass
+
+    # wait for up to timeout seconds for events, return the set of changed form folders
+    def get_changed(self, timeout):
+        if not self.changed:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+            if not readable:
+                return set()
+        while True:
+            try:
+                buffer = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, cookie, name_len = INOTIFY_EVENT.unpack_from(buffer, offset)
+                offset += INOTIFY_EVENT.size
+                s_name = os.fsdecode(buffer[offset:offset + name_len].rstrip(b'\0'))
+                offset += name_len
+                self.handle_event(wd, mask, s_name)
+        changed = self.changed
+        self.changed = set()
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+# Monitor using polling - compares the modification time of each form folder with the previous pass
+# Only the form type directories are listed on each pass, form folders are only opened when changed
+class PollingMonitor:
+
+    def __init__(self, s_base, interval):
+        self.s_base = s_base
+        self.interval = interval
+        self.mtimes = {}                # form folder -> last seen modification time
+        self.first_pass = True
+
+    def get_changed(self, timeout):
+        if not self.first_pass:
+            time.sleep(min(timeout, self.interval))
+        self.first_pass = False
+        changed = set()
+        seen = {}
+        for t in os.scandir(self.s_base):
+            if not t.is_dir():
+                continue
+            try:
+                for e in os.scandir(t.path):
+                    if e.is_dir():
+                        mtime = e.stat().st_mtime_ns
+                        seen[e.path] = mtime
+                        if self.mtimes.get(e.path) != mtime:
+                            changed.add(e.path)
+            except FileNotFoundError:
+                pass
+        self.mtimes = seen
+        return changed
+
+    def close(self):
+        pass
+
+# create the best monitor available on this system
+def create_monitor(s_base):
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyMonitor(s_base)
+        except (OSError, AttributeError) as e:
+            # no inotify, or too many folders for the user watch limit
+            print('inotify not available (%s), polling every %d seconds' % (e, ENV.WATCH_POLL_SECONDS))
+    return PollingMonitor(s_base, ENV.WATCH_POLL_SECONDS)
+
+# get the size and modification time of the JSON and PDF files in a form folder
+def get_form_file_stats(s_form_path, f_JSON, f_PDF):
+    j = os.stat(os.path.join(s_form_path, f_JSON))
+    p = os.stat(os.path.join(s_form_path, f_PDF))
+    return (j.st_size, j.st_mtime_ns, p.st_size, p.st_mtime_ns)
+
+# process the changed form folders which are complete and have settled
+# if there is a pipeline, forms are processed in parallel and this waits for them to finish
+# each form is recorded in the scan index, along with whether it was processed or failed (see rescan_forms())
+def process_changed(md, pending, file_stats, settle, index, pipeline=None):
+    # pending is a dictionary of form folder -> time of the last change
+    # file_stats is a dictionary of form folder -> JSON/PDF sizes and times when the folder last settled
+    # a form is only processed once its files are unchanged across a whole settle window, as a file can
+    # still be growing (e.g. a slow copy from a network share) with no new event for the polling monitor
+    # group the complete forms by form type, so the mstore configuration is read once per type
+    now = time.time()
+    by_type = {}
+    for s_form_path in list(pending):
+        if now - pending[s_form_path] < settle:
+            continue
+        del pending[s_form_path]
+        try:
+            entry = index.update_form(s_form_path)
+            f_JSON, f_PDF = entry[3], entry[4]
+            if (f_JSON == '') or (f_PDF == ''):
+                # not complete yet - will be picked up again on the next change to this folder
+                file_stats.pop(s_form_path, None)
+                continue
+            stats = get_form_file_stats(s_form_path, f_JSON, f_PDF)
+        except FileNotFoundError:
+            # already processed or removed
+            file_stats.pop(s_form_path, None)
+            continue
+        if file_stats.get(s_form_path) != stats:
+            # files are new or have changed since the last look - check again after another settle window
+            file_stats[s_form_path] = stats
+            pending[s_form_path] = now
+            continue
+        del file_stats[s_form_path]
+        s_type_path = os.path.dirname(s_form_path)
+        by_type.setdefault(s_type_path, []).append([s_form_path, f_JSON, f_PDF])
+
+    for s_type_path, form_list in by_type.items():
+        s_type = os.path.basename(s_type_path)
+        form_type_id = FP.get_form_type_id(s_type)
+        if form_type_id and form_type_id.isnumeric():
+            try:
+                FP.process_form_list(md, [s_type, int(form_type_id), s_type_path], form_list, index, pipeline)
+            except Exception as e:
+                # keep the watcher running - the forms are left in place, and tried again by the next rescan
+                print('Failed to process forms in %s: %s' % (s_type_path, e))
+    if pipeline is not None:
+        pipeline.wait()
+    FP.report_field_misses()
+    M.write_metrics()
+
+# look at every form type directory through the scan index, and queue the complete forms found
+# picks up forms whose events were missed (or which failed before they reached the index) straight away, and
+# forms which failed once SCAN_FAILED_RETRY_SECONDS have passed - only changed folders are opened
+def rescan_forms(index, pending):
+    now = time.time()
+    for f_type in FP.get_form_types():
+        try:
+            for form in index.scan_form_type(f_type[2]):
+                pending.setdefault(form[0], now)
+        except FileNotFoundError:
+            # form type directory removed
+            pass
+
+# main loop - does not return
+def run_watcher():
+    md = FP.connect_to_mstore()
+    if not md.isConnected():
+        print('Failed to connect to mstore: ' + md.getLastError())
+        return
+    if not FP.check_create_dir(ENV.SWEEP_BASE): return
+
+    # the scan index is kept in memory if there is no index file
+    index = formation_index.FormScanIndex(ENV.SCAN_INDEX_FILE, ENV.SCAN_FAILED_RETRY_SECONDS)
+
+    # the pipeline workers stay running (with their database connections) between passes
+    pipeline = None
+    if ENV.PIPELINE_WRITE_WORKERS > 0:
+        pipeline = FP.create_pipeline(index)
+
+    monitor = create_monitor(ENV.FORMATION_BASE)
+    print('Watching %s using %s' % (ENV.FORMATION_BASE, monitor.__class__.__name__))
+    pending = {}
+    file_stats = {}
+    next_rescan = 0
+    try:
+        while True:
+            if time.time() >= next_rescan:
+                rescan_forms(index, pending)
+                next_rescan = time.time() + ENV.WATCH_RESCAN_SECONDS
+            # wake up in time to process anything that is waiting to settle
+            timeout = ENV.WATCH_POLL_SECONDS if not pending else ENV.WATCH_SETTLE_SECONDS
+            now = time.time()
+            try:
+                changed = monitor.get_changed(timeout)
+            except OSError as e:
+                # most likely the inotify watch limit has been reached during a burst - carry on by polling
+                print('Monitor failed (%s), polling every %d seconds' % (e, ENV.WATCH_POLL_SECONDS))
+                monitor.close()
+                monitor = PollingMonitor(ENV.FORMATION_BASE, ENV.WATCH_POLL_SECONDS)
+                continue
+            for s_form_path in changed:
+                pending[s_form_path] = now
+            if pending:
+                process_changed(md, pending, file_stats, ENV.WATCH_SETTLE_SECONDS, index, pipeline)
+                if ENV.SCAN_INDEX_FILE:
+                    index.save()
+    finally:
+        monitor.close()
+        if pipeline is not None:
+            pipeline.close()
+
+if __name__ == "__main__":
+    run_watcher()
@@ -9,14 +9,26 @@
 import pyodbc               # pyodbc - for SQL connectivity
 import pickle               # for saving/loading objects and data
 import re                   # regular expressions library, for pattern matching
+import decimal              # for comparing numeric lookup keys
+import time                 # for connection pool idle timeouts
+import threading            # for sharing the connection pool between threads
+import contextlib           # for connection pool checkout with a 'with' block
+import atexit               # for flushing buffered log events at exit
+import concurrent.futures   # for running rule matching in worker processes
+import os                   # for creating the log spill file directory
 
 # Other Arena code
 import mstoresecurity                   # encryption tools for user/password
+import mstorematch                      # compiled rule sets for classification
+import mstoremetrics as M               # stage timings and counts
 import mstoreenvironment as ENV         # Environmental variables for mstore - includes unit test params
 
 # Module constants
 MODULE_NAME = 'mstore.py'
 s_SQL_DRIVER = 'DRIVER={SQL Server Native Client 11.0};'         # database driver to use
+n_STATEMENT_CACHE_SIZE = 50                                     # prepared statements kept per connection
+n_MAX_PARAMETERS = 2000                                         # SQL Server limit is 2100 parameters per statement
+n_INSERT_SQL_CACHE_SIZE = 200                                   # insert_rows() statements kept, for all connections
 
 # Wider mstore constants
 MSTORE_OCR_STATUS_NEW = 0               # MRContentsX record will have MT_Status == 0 when page is new
@@ -35,9 +47,15 @@ class MDatabase:
     s_LastError = ''
     s_User = ''
     s_Password = ''
+    statement_cache = None                  # statement text -> cursor, most recently used last
+    fFastExecuteMany = False                # pyodbc fast_executemany - take care with varchar(max) columns
+    fInTransaction = False                  # True if there is uncommitted work on the connection
+    fnConnect = None                        # function to open a connection - pyodbc.connect, unless replaced
 
     # constructor
-    def __init__(self, server, database, user_key, password_key, encrypted=True, credentials_file='', autoconnect = True):
+    # connect is an optional replacement for pyodbc.connect - e.g. a stand-in driver for testing
+    def __init__(self, server, database, user_key, password_key, encrypted=True, credentials_file='', autoconnect = True,
+                 connect=None):
 
         fExit = False
 
@@ -60,14 +78,80 @@ class MDatabase:
         if not fExit:
             # build the connection string
             self.s_ConnectionString = s_SQL_DRIVER + "SERVER=" + server + ";DATABASE=" + database +";"
+            self.fnConnect = connect
 
             if autoconnect:
+                self.open_connection()
+
+    # open the connection, using the credentials already decrypted
+    def open_connection(self):
+        fnConnect = self.fnConnect
+        if fnConnect is None:
+            fnConnect = pyodbc.connect
+        try:
+            self.dbConn = fnConnect(self.s_ConnectionString + 'UID=' + self.s_User + ';PWD=' + self.s_Password)
+            self.dbConnected = True
+            self.s_LastError = ''
+        except:
+            # failed to connect to the database
+            self.dbConnected = False
+            self.s_LastError = "Error: failed to connect"
+        return self.dbConnected
+
+    # close the connection, along with any prepared statements
+    def close(self):
+        if self.statement_cache:
+            for curData in self.statement_cache.values():
                 try:
-                    self.dbConn = pyodbc.connect(self.s_ConnectionString + 'UID=' + self.s_User + ';PWD=' + self.s_Password)
-                    self.dbConnected = True
+                    curData.close()
                 except:
-                    # failed to connect to the database
-                    self.s_LastError = "Error: failed to connect"
+                    pass
+        self.statement_cache = None
+        if self.dbConnected:
+            try:
+                self.dbConn.close()
+            except:
+                pass
+        self.dbConnected = False
+        self.fInTransaction = False
+
+    # check that the connection is still alive - a dropped connection is marked as not connected
+    def ping(self):
+        if self.dbConnected:
+            try:
+                curData = self.dbConn.cursor()
+                curData.execute('select 1')
+                curData.fetchall()
+                return True
+            except:
+                self.dbConnected = False
+                self.s_LastError = 'Connection to database lost'
+        return False
+
+    # open a second connection to the same database, with the same credentials - e.g. for a background thread
+    def clone(self):
+        md = MDatabase('', '', self.s_User, self.s_Password, encrypted=False, autoconnect=False,
+                       connect=self.fnConnect)
+        md.s_ConnectionString = self.s_ConnectionString
+        md.open_connection()
+        return md
+
+    # drop the connection and open a new one
+    def reconnect(self):
+        self.close()
+        return self.open_connection()
+
+    # commit any pending actions on this connection
+    def commit(self):
+        if self.dbConnected:
+            self.dbConn.commit()
+            self.fInTransaction = False
+
+    # roll back any pending actions on this connection
+    def rollback(self):
+        if self.dbConnected:
+            self.dbConn.rollback()
+            self.fInTransaction = False
 
     # trivially return the connection, for testing purposes
     def getConnectionString(self):
@@ -87,44 +171,211 @@ class MDatabase:
         return self.s_LastError
 
     # Just stick quotes around the string, for SQL building
+    # kept for existing callers - prefer ? parameters with execute()/query(), which don't lose apostrophes
     def quote_string(self, sString):
         if sString.find("'") < 0:
             return "'%s'" % sString
         else:
             return "'%s'" % sString.replace("'", "#")
 
+    # get a cursor to run a parameterised statement
+    # a cursor is kept for each statement text, as pyodbc only prepares a statement again if the text changes
+    # so running the same statement with new parameters re-uses the prepared statement and the server plan
+    def get_cursor(self, sSQL):
+        if self.statement_cache is None:
+            self.statement_cache = {}
+        curData = self.statement_cache.pop(sSQL, None)
+        if curData is None:
+            curData = self.dbConn.cursor()
+            if len(self.statement_cache) >= n_STATEMENT_CACHE_SIZE:
+                # drop the least recently used statement
+                sOldest = next(iter(self.statement_cache))
+                self.statement_cache.pop(sOldest).close()
+        self.statement_cache[sSQL] = curData
+        return curData
+
+    # run a statement and return the cursor, for the results
+    # if the statement fails because the connection has dropped, reconnect and try again - unless there is
+    # uncommitted work on the connection, which would have been lost with it
+    # fNewCursor runs the statement on a cursor of its own, rather than the prepared statement cursor
+    @M.timed('sql_statement')
+    def run_statement(self, sSQL, params=None, fNewCursor=False):
+        try:
+            return self.execute_on_cursor(sSQL, params, fNewCursor)
+        except:
+            if self.fInTransaction or self.ping() or not self.reconnect():
+                raise
+            return self.execute_on_cursor(sSQL, params, fNewCursor)
+
+    # run a statement on a new cursor, or the prepared statement cursor if there are parameters
+    def execute_on_cursor(self, sSQL, params, fNewCursor=False):
+        if params is None:
+            curData = self.dbConn.cursor()
+            curData.execute(sSQL)
+        elif fNewCursor:
+            curData = self.dbConn.cursor()
+            curData.execute(sSQL, params)
+        else:
+            curData = self.get_cursor(sSQL)
+            curData.execute(sSQL, params)
+        return curData
+
     # Execute arbitrary SQL on connection - default to immediate commit
-    def execute(self, sSQL, commit=True):
+    # params is an optional list of values for ? placeholders in the SQL
+    def execute(self, sSQL, commit=True, params=None):
         if self.dbConnected:
-            curData = self.dbConn.cursor()
             try:
-                curData.execute(sSQL)
+                curData = self.run_statement(sSQL, params)
                 if commit:
                     curData.commit()            # take care - this is the same as self.dbConn.commit()
                                                 # I.e. commits all pending actions on this connection object!
+                    self.fInTransaction = False
+                else:
+                    self.fInTransaction = True
                 return True
             except:
                 return False
         else:
             return False
 
+    # Execute a parameterised statement once for each list of values in param_rows - default to immediate commit
+    def executemany(self, sSQL, param_rows, commit=True):
+        if self.dbConnected:
+            try:
+                curData = self.get_cursor(sSQL)
+                if self.fFastExecuteMany:
+                    curData.fast_executemany = True
+                curData.executemany(sSQL, param_rows)
+                if commit:
+                    self.commit()
+                else:
+                    self.fInTransaction = True
+                return True
+            except:
+                return False
+        else:
+            return False
+
+    # insert a batch of rows into a table, returning the new identity values in the same order as the rows
+    # rows are sent in chunks of chunk_size, one statement per chunk, with a single commit at the end
+    # any rows left over are sent in chunks of the largest power of 2 that fits (e.g. 37 rows as 32 + 4 + 1), so
+    # only a few fixed chunk sizes are used, and so only a few statements for each table and set of columns
+    # MERGE is used rather than INSERT, as it can OUTPUT the position of each source row alongside the new Id
+    # (the order of rows from INSERT ... OUTPUT is not guaranteed to match the order of the VALUES list)
+    # returns None if the insert failed - in which case the whole batch is rolled back
+    # a dropped connection is reconnected as for any other statement (see run_statement()), but only before the
+    # first chunk has been sent
+    def insert_rows(self, sTable, columns, rows, sIdentityColumn='ID', chunk_size=100, commit=True):
+        if not self.dbConnected:
+            self.s_LastError = 'Insert requested, but not connected to database'
+            return None
+        new_ids = [None] * len(rows)
+        # keep within the parameter limit for a single statement
+        chunk_size = max(1, min(chunk_size, n_MAX_PARAMETERS // max(len(columns), 1)))
+        try:
+            nStart = 0
+            while nStart < len(rows):
+                nRows = len(rows) - nStart
+                if nRows >= chunk_size:
+                    nRows = chunk_size
+                else:
+                    nRows = 1 << (nRows.bit_length() - 1)
+                chunk = rows[nStart:nStart + nRows]
+                sSQL = self.get_insert_rows_template(sTable, columns, nRows, sIdentityColumn)
+                params = []
+                for row in chunk:
+                    params += row
+                curData = self.run_statement(sSQL, params)
+                for r in curData.fetchall():
+                    new_ids[nStart + r[0]] = r[1]
+                # the earlier chunks would be lost with the connection, so no reconnecting for the later ones
+                self.fInTransaction = True
+                nStart += nRows
+            if commit:
+                self.commit()
+            else:
+                self.fInTransaction = True
+            return new_ids
+        except:
+            self.s_LastError = 'Failed to insert rows into ' + sTable
+            try:
+                self.rollback()
+            except:
+                # most likely the connection has dropped, taking the uncommitted rows with it - with nothing left
+                # to lose, the next statement can reconnect (see run_statement())
+                self.fInTransaction = False
+            return None
+
+    # get the statement for insert_rows() - built once for each table, set of columns and number of rows
+    # and then re-used, with only the parameter values changing - as insert_rows() only uses a few chunk sizes,
+    # each Formation form type has a few statements (and so a few plans on the server), not one per batch size
+    def get_insert_rows_template(self, sTable, columns, nRows, sIdentityColumn):
+        key = (sTable, tuple(columns), nRows, sIdentityColumn)
+        sSQL = INSERT_SQL_CACHE.get(key)
+        if sSQL is None:
+            sSQL = self.get_insert_rows_sql(sTable, columns, nRows, sIdentityColumn)
+            INSERT_SQL_CACHE.put(key, sSQL)
+        return sSQL
+
+    # build the statement for insert_rows() - the row position within the chunk is a literal, so the
+    # statement text only depends on the table, columns and number of rows and can be re-used
+    def get_insert_rows_sql(self, sTable, columns, nRows, sIdentityColumn):
+        sColumns = ', '.join(columns)
+        sSourceColumns = ', '.join(['s.' + c for c in columns])
+        sPlaceholders = ', '.join(['?'] * len(columns))
+        sValues = ', '.join(['(' + str(nRow) + ', ' + sPlaceholders + ')' for nRow in range(nRows)])
+        return 'merge into ' + sTable + ' as t using (values ' + sValues + ') ' \
+               + 'as s (RowSeq, ' + sColumns + ') on 1 = 0 ' \
+               + 'when not matched then insert (' + sColumns + ') values (' + sSourceColumns + ') ' \
+               + 'output s.RowSeq, inserted.' + sIdentityColumn + ';'
+
     # get a recordset
-    def getRecordSet(self, sSQL):
+    # params is an optional list of values for ? placeholders in the SQL
+    def getRecordSet(self, sSQL, params=None):
         if self.dbConnected:
-            curData = self.dbConn.cursor()
-            curData.execute(sSQL)
+            curData = self.run_statement(sSQL, params)
             rsData = curData.fetchall()         # this gets all records into the list, performance on large result sets?
             return rsData
         else:
             self.s_LastError = 'Recordset requested, but not connected to database'
             return []
 
+    # run a parameterised query and return the records
+    def query(self, sSQL, params=None):
+        return self.getRecordSet(sSQL, params)
+
+    # run a query and return the records a chunk at a time, as a generator - for result sets too large to hold
+    # in memory, and so that work can start on the first records straight away
+    # records are fetched arraysize at a time (0 = STREAM_ARRAYSIZE), fTuples gives plain tuples instead of rows
+    # Note that the rest of the results must be read (or the generator closed) before running another statement
+    # on this connection - use clone() for a second connection if other work is needed while streaming
+    def stream(self, sSQL, params=None, arraysize=0, fTuples=False):
+        if not self.dbConnected:
+            self.s_LastError = 'Recordset requested, but not connected to database'
+            return
+        if arraysize <= 0:
+            arraysize = ENV.STREAM_ARRAYSIZE
+        # a cursor of its own, so that it can't be re-used (or closed) by the prepared statement cache
+        curData = self.run_statement(sSQL, params, True)
+        try:
+            while True:
+                rsData = curData.fetchmany(arraysize)
+                if not rsData:
+                    break
+                if fTuples:
+                    for r in rsData:
+                        yield tuple(r)
+                else:
+                    yield from rsData
+        finally:
+            curData.close()
+
     # the following functions are used in page classification actions
 
     # get the page count for a document
     def get_document_page_count(self, sCabinet, nDocID):
-        sSQL = 'select CB_PAGES from MICAB' + sCabinet + ' where CB_DOCID = ' + str(nDocID)
-        rsPage = self.getRecordSet(sSQL)
+        sSQL = 'select CB_PAGES from MICAB' + sCabinet + ' where CB_DOCID = ?'
+        rsPage = self.query(sSQL, [nDocID])
         if len(rsPage) > 0:
             return rsPage[0].CB_PAGES
         else:
@@ -134,74 +385,941 @@ class MDatabase:
     # get the page contents, for a given document/page
     def get_page_contents(self, sCabinet, nDocID, nPage):
         # get the MRContentsXX record for this page of the requested document
-        sSQL = 'select MT_Contents from MRContents' + sCabinet + ' where MT_DocId=' + str(nDocID) \
-               + ' and MT_Page=' + str(nPage)
-        rsPage = self.getRecordSet(sSQL)
+        sSQL = 'select MT_Contents from MRContents' + sCabinet + ' where MT_DocId = ? and MT_Page = ?'
+        rsPage = self.query(sSQL, [nDocID, nPage])
         return rsPage[0].MT_Contents
 
+    # get the page contents for all pages of a document, with a single query
+    # returns a list of the page text, in page order - a page with no MRContents row is left out, so use
+    # get_document_page_rows() where the page numbers are needed
+    def get_document_pages(self, sCabinet, nDocID):
+        pages = []
+        for r in self.get_document_page_rows(sCabinet, nDocID):
+            pages += [r.MT_Contents]
+        return pages
+
+    # get the page number, OCR status and text of all pages of a document, in page order
+    @M.timed('page_load')
+    def get_document_page_rows(self, sCabinet, nDocID):
+        # only pages up to the document page count are used, as for get_document_page_count/get_page_contents
+        sSQL = 'select MT_Page, MT_Status, MT_Contents from MRContents' + sCabinet \
+               + ' inner join MICAB' + sCabinet + ' on CB_DOCID = MT_DocId' \
+               + ' where MT_DocId = ? and MT_Page between 1 and CB_PAGES order by MT_Page'
+        return self.query(sSQL, [nDocID])
+
+    # get the page rows (as get_document_page_rows) for many documents in a cabinet, with one query per
+    # n_MAX_PARAMETERS documents - returns a dictionary of docID -> list of page rows, in page order
+    # the docIDs are keyed as integers, as returned by the database, whether they were passed as numbers or text
+    @M.timed('page_load_batch')
+    def get_documents_page_rows(self, sCabinet, doc_ids):
+        doc_pages = {}
+        for nDocID in doc_ids:
+            doc_pages[int(nDocID)] = []
+        doc_ids = list(doc_pages)
+        for nStart in range(0, len(doc_ids), n_MAX_PARAMETERS):
+            chunk = doc_ids[nStart:nStart + n_MAX_PARAMETERS]
+            sSQL = 'select MT_DocId, MT_Page, MT_Status, MT_Contents from MRContents' + sCabinet \
+                   + ' inner join MICAB' + sCabinet + ' on CB_DOCID = MT_DocId' \
+                   + ' where MT_DocId in (' + ', '.join(['?'] * len(chunk)) + ')' \
+                   + ' and MT_Page between 1 and CB_PAGES order by MT_DocId, MT_Page'
+            for r in self.query(sSQL, chunk):
+                doc_pages.setdefault(int(r.MT_DocId), []).append(r)
+        return doc_pages
+
     # get document OCR status
     def get_document_OCR_status(self, sCabinet, nDocID):
-        nPages = self.get_document_page_count(sCabinet, nDocID)
-        # check if all pages have OCR complete
-        sSQL = 'select count(*) [Complete] from MRContents' + sCabinet + ' where MT_DocId=' + str(nDocID) \
-               + ' and (MT_Status=' + str(MSTORE_OCR_STATUS_COMPLETE) \
-               + ' or MT_Status=' + str(MSTORE_OCR_STATUS_SUCCESS) + ')'
-        rsComplete = self.getRecordSet(sSQL)
-        nRemaining = rsComplete[0].Complete
-        # check for any error pages
-        sSQL = 'select count(*) [Error] from MRContents' + sCabinet + ' where MT_DocId=' + str(nDocID) \
-               + ' and MT_Status<>' + str(MSTORE_OCR_STATUS_COMPLETE) \
-               + ' and MT_Status<>' + str(MSTORE_OCR_STATUS_SUCCESS) \
-               + ' and MT_Status<>' + str(MSTORE_OCR_STATUS_NEW)
-        rsError = self.getRecordSet(sSQL)
-        nError = rsError[0].Error
         # return values are:
         #   0 if all pages OCR'd
         #   >1 if pages await OCR (number of pages)
         #   -1 for error pages - document will need to go down an error route
-        if nError > 0:
-            return -1
-        else:
-            return nPages - nRemaining
+        return self.get_documents_OCR_status(sCabinet, [nDocID])[int(nDocID)]
+
+    # get the OCR status of many documents in a cabinet, as a dictionary of docID -> status (as above)
+    # the page count, complete pages and error pages are found together, in one query per n_MAX_PARAMETERS docs
+    # the docIDs are keyed as integers, as returned by the database, whether they were passed as numbers or text
+    def get_documents_OCR_status(self, sCabinet, doc_ids):
+        statuses = {}
+        doc_ids = list(dict.fromkeys([int(nDocID) for nDocID in doc_ids]))
+        status_params = [MSTORE_OCR_STATUS_COMPLETE, MSTORE_OCR_STATUS_SUCCESS,
+                         MSTORE_OCR_STATUS_COMPLETE, MSTORE_OCR_STATUS_SUCCESS, MSTORE_OCR_STATUS_NEW]
+        nChunk = n_MAX_PARAMETERS - len(status_params)
+        for nStart in range(0, len(doc_ids), nChunk):
+            chunk = doc_ids[nStart:nStart + nChunk]
+            sSQL = 'select CB_DOCID, CB_PAGES,' \
+                   + ' sum(case when MT_Status = ? or MT_Status = ? then 1 else 0 end) [Complete],' \
+                   + ' sum(case when MT_Status <> ? and MT_Status <> ? and MT_Status <> ? then 1 else 0 end) [Error]' \
+                   + ' from MICAB' + sCabinet + ' left join MRContents' + sCabinet + ' on MT_DocId = CB_DOCID' \
+                   + ' where CB_DOCID in (' + ', '.join(['?'] * len(chunk)) + ') group by CB_DOCID, CB_PAGES'
+            for r in self.query(sSQL, status_params + chunk):
+                # no pages in MRContents gives NULL sums
+                if (r.Error or 0) > 0:
+                    statuses[int(r.CB_DOCID)] = -1
+                else:
+                    statuses[int(r.CB_DOCID)] = r.CB_PAGES - (r.Complete or 0)
+        for nDocID in doc_ids:
+            if nDocID not in statuses:
+                # no document record - send down the error route
+                self.s_LastError = 'Finding page count for ' + sCabinet + '/' + str(nDocID) + ' (no record)'
+                statuses[nDocID] = -1
+        return statuses
 
     # get MAF list contents
-    def get_MAF_list(self, nMAFListID):
+    # lists are kept in the process-wide MAF_LIST_CACHE, unless fUseCache is False
+    def get_MAF_list(self, nMAFListID, fUseCache=True):
+        if fUseCache:
+            return MAF_LIST_CACHE.get(self, nMAFListID)
+        return self.load_MAF_list(nMAFListID)
+
+    # read a MAF list from the database
+    def load_MAF_list(self, nMAFListID):
         # read in a MAF list and return the database cursor
-        rsMAF = self.getRecordSet('select LS_Item1, LS_Item2, LS_Item3, LS_Item4, LS_Item5,' \
-                                         'LS_Item6, LS_Item7, LS_Item8, LS_Item9, LS_Item10 ' \
-                                         'from AFListItem where LS_ListID = ' + str(nMAFListID))
+        rsMAF = self.query('select LS_Item1, LS_Item2, LS_Item3, LS_Item4, LS_Item5,' \
+                                  'LS_Item6, LS_Item7, LS_Item8, LS_Item9, LS_Item10 ' \
+                                  'from AFListItem where LS_ListID = ?', [nMAFListID])
         return rsMAF
 
+    # get a cheap signature for a MAF list - the row count and a checksum of the rows
+    # used to check if a cached list has changed without reading the whole list again
+    def get_MAF_list_signature(self, nMAFListID):
+        rsSig = self.query('select count(*) [Items], checksum_agg(binary_checksum(*)) [Checksum] ' \
+                           'from AFListItem where LS_ListID = ?', [nMAFListID])
+        if len(rsSig) > 0:
+            return (rsSig[0].Items, rsSig[0].Checksum)
+        return None
+
+    # get the items of a MAF list where one item column matches a key, filtered on the server
+    # nKeyItem is the item number (1-10) of the key column, e.g. 2 for LS_Item2
+    def get_MAF_list_items(self, nMAFListID, nKeyItem, sKey):
+        sSQL = 'select LS_Item1, LS_Item2, LS_Item3, LS_Item4, LS_Item5,' \
+               'LS_Item6, LS_Item7, LS_Item8, LS_Item9, LS_Item10 ' \
+               'from AFListItem where LS_ListID = ? and ' + get_MAF_item_column(nKeyItem) + ' = ?'
+        return self.query(sSQL, [nMAFListID, str(sKey)])
+
+    # get a MAF list as a dictionary of key -> list of items, keyed on one item column
+    # built once from the cached list, and rebuilt only when the list is read again
+    def get_MAF_list_index(self, nMAFListID, nKeyItem):
+        get_MAF_item_column(nKeyItem)       # check the item number
+        nColumn = int(nKeyItem) - 1
+        return MAF_LIST_CACHE.get_derived(self, nMAFListID, 'index_' + str(nKeyItem),
+                                          lambda rsMAF: build_MAF_list_index(rsMAF, nColumn))
+
     # get the list of available training documents for a given document type
     # REFACTOR - this should be in the classifier module
-    def get_training_doc_list(self, sCabinet, nDTID, fOrderAscending=True, max_records=0):
+    # with fStream, returns a generator over the documents (see stream()) rather than a list
+    def get_training_doc_list(self, sCabinet, nDTID, fOrderAscending=True, max_records=0, fStream=False):
+        sSQL, params = self.get_training_doc_sql(sCabinet, nDTID, fOrderAscending, max_records)
+        if fStream:
+            return self.stream(sSQL, params)
+        rsDocs = self.query(sSQL, params)
+        return rsDocs
+
+    # iterate over the available training documents for a document type, a page of nPageSize documents at a time
+    # (0 = TRAINING_PAGE_SIZE) - each page is a separate query, so other statements can be run between documents
+    # pages follow on by DOCID (keyset pagination), so a run can be resumed after the last DOCID processed,
+    # with nAfterDocID - and documents added while iterating are picked up if they fall in the remaining range
+    # a page is nPageSize candidate documents, of which only the fully OCR'd ones are returned (see
+    # get_training_page_sql()), so the next page follows on from the last candidate
+    def iter_training_docs(self, sCabinet, nDTID, fOrderAscending=True, nPageSize=0, nAfterDocID=None):
+        if nPageSize <= 0:
+            nPageSize = ENV.TRAINING_PAGE_SIZE
+        while True:
+            sSQL, params = self.get_training_page_sql(sCabinet, nDTID, fOrderAscending, nPageSize, nAfterDocID)
+            rsDocs = self.query(sSQL, params)
+            for r in rsDocs:
+                if r.CB_PAGES == r.CompletePages:
+                    yield r
+            if len(rsDocs) < nPageSize:
+                break
+            nAfterDocID = rsDocs[-1].CB_DOCID
+
+    # build the query for training documents - returns the SQL and parameters
+    # documents must be fully OCR'd (all pages with MT_Status = 3), the latest version and not excluded
+    # the complete page counts are aggregated once, in a derived table, rather than counted for each document
+    # max_records > 0 limits the number of documents
+    def get_training_doc_sql(self, sCabinet, nDTID, fOrderAscending=True, max_records=0):
         sCabinetName = 'MICAB' + str(sCabinet)
         sContentsName = 'MRContents' + str(sCabinet)
+        params = []
         if max_records > 0:
-            sSQL = 'select top ' + str(max_records) + ' '
+            sSQL = 'select top (?) '
+            params += [max_records]
         else:
             sSQL = 'select '
-        sSQL = sSQL + 'CB_DOCID, CB_PAGES, CB_FILETYPE from ' + '(' \
-               + sCabinetName + ' Left Join MIVersions on CB_DOCID = DV_DocumentId) ' \
+        sSQL = sSQL + 'CB_DOCID, CB_PAGES, CB_FILETYPE from ' + '((' \
+               + sCabinetName + ' Left Join (select MT_DocId, count(*) [CompletePages] from ' + sContentsName \
+               + ' where MT_Status = 3 group by MT_DocId) cp on CB_DOCID = cp.MT_DocId) ' \
+               + 'Left Join MIVersions on CB_DOCID = DV_DocumentId) ' \
                + 'Left Join AIExcludedDocuments on CB_DOCID = EX_DocId ' \
                + 'where ' \
                + 'IsNull(DV_Unique, -1) = -1 and ' \
                + 'IsNull(EX_DocId, -1) = -1 and ' \
-               + 'CB_PAGES = (select count(*) from ' + sContentsName + ' where MT_DocId = CB_DOCID and MT_Status = 3) ' \
-               + 'and CB_DTID = ' + str(nDTID)
+               + 'CB_PAGES = IsNull(cp.CompletePages, 0) ' \
+               + 'and CB_DTID = ?'
+        params += [nDTID]
         if fOrderAscending:
             sSQL += ' order by CB_DOCID ASC'
         else:
             sSQL += ' order by CB_DOCID DESC'
-        rsDocs = self.getRecordSet(sSQL)
-        return rsDocs
+        return sSQL, params
+
+    # build the query for a page of iter_training_docs() - returns the SQL and parameters
+    # the next nPageSize documents of the type, after nAfterDocID (in the sort order), which are the latest version
+    # and not excluded are picked first, and the complete pages are only counted for those - so each page costs
+    # the same however many documents are left, rather than the count covering every remaining document
+    # each row has CompletePages, for the caller to check against CB_PAGES
+    def get_training_page_sql(self, sCabinet, nDTID, fOrderAscending, nPageSize, nAfterDocID=None):
+        sCabinetName = 'MICAB' + str(sCabinet)
+        sContentsName = 'MRContents' + str(sCabinet)
+        sOrder = ' ASC' if fOrderAscending else ' DESC'
+        params = [nPageSize, nDTID]
+        sSQL = 'with Candidates as (select top (?) CB_DOCID, CB_PAGES, CB_FILETYPE from (' \
+               + sCabinetName + ' Left Join MIVersions on CB_DOCID = DV_DocumentId) ' \
+               + 'Left Join AIExcludedDocuments on CB_DOCID = EX_DocId ' \
+               + 'where ' \
+               + 'IsNull(DV_Unique, -1) = -1 and ' \
+               + 'IsNull(EX_DocId, -1) = -1 and ' \
+               + 'CB_DTID = ?'
+        if nAfterDocID is not None:
+            sSQL += ' and CB_DOCID' + (' > ?' if fOrderAscending else ' < ?')
+            params += [nAfterDocID]
+        sSQL = sSQL + ' order by CB_DOCID' + sOrder + ') ' \
+               + 'select c.CB_DOCID, c.CB_PAGES, c.CB_FILETYPE, IsNull(cp.CompletePages, 0) [CompletePages] ' \
+               + 'from Candidates c Left Join (select MT_DocId, count(*) [CompletePages] from ' + sContentsName \
+               + ' where MT_Status = 3 and MT_DocId in (select CB_DOCID from Candidates) group by MT_DocId) cp ' \
+               + 'on c.CB_DOCID = cp.MT_DocId ' \
+               + 'order by c.CB_DOCID' + sOrder
+        return sSQL, params
+
+# normalise a lookup value for matching against the rows returned by the database
+# SQL Server compares strings ignoring trailing spaces and (with the default collation) case
+def normalise_key(value):
+    return str(value).rstrip().upper()
+
+# normalise a lookup value for matching against a numeric key column - SQL Server converts the value to the
+# column's type, so e.g. '00123' and ' 123' both match 123 - returns None if the value isn't a number
+def normalise_number_key(value):
+    try:
+        return decimal.Decimal(str(value).strip()).normalize()
+    except decimal.InvalidOperation:
+        return None
+
+# get the column name for a MAF list item number, 1-10 - checked, as it is used to build SQL
+def get_MAF_item_column(nItem):
+    if int(nItem) < 1 or int(nItem) > 10:
+        raise ValueError('MAF list item number must be 1-10, not ' + str(nItem))
+    return 'LS_Item' + str(int(nItem))
+
+# build a dictionary of key -> list of items from MAF list rows, keyed on column nColumn (0 = LS_Item1)
+def build_MAF_list_index(rsMAF, nColumn):
+    index = {}
+    for r in rsMAF:
+        index.setdefault(r[nColumn], []).append(r)
+    return index
+
+# Cache of MAF lists, shared by all database objects and jobs in a process
+# MAF lists hold configuration (rules, form targets etc) which very rarely changes, so there is no need to
+# read them for every job - a list is read again once it is older than the time-to-live (ttl, seconds)
+# If fCheckChanges is set, an expired list is only read again if its row count/checksum has changed
+# Objects built from a list (e.g. compiled rule sets) can be cached alongside it, with get_derived()
+# Use invalidate() after changing a list, to pick up the changes straight away
+class MAFListCache:
+
+    def __init__(self, ttl=300, fCheckChanges=False):
+        self.ttl = ttl
+        self.fCheckChanges = fCheckChanges
+        self.entries = {}                   # (connection string, list ID) -> [rows, time loaded, signature, derived]
+        self.lock = threading.Lock()
+
+    # get the cache entry for a list, loading or refreshing it if needed
+    def get_entry(self, md, nMAFListID):
+        key = (md.getConnectionString(), int(nMAFListID))
+        with self.lock:
+            entry = self.entries.get(key)
+        now = time.time()
+        if entry is not None and now - entry[1] < self.ttl:
+            return entry
+
+        if entry is not None and self.fCheckChanges:
+            # expired - but only read the list again if it has changed
+            signature = md.get_MAF_list_signature(nMAFListID)
+            if signature is not None and signature == entry[2]:
+                entry[1] = now
+                return entry
+        else:
+            signature = None
+            if self.fCheckChanges:
+                signature = md.get_MAF_list_signature(nMAFListID)
+
+        rows = md.load_MAF_list(nMAFListID)
+        entry = [rows, now, signature, {}]
+        if md.isConnected() and self.ttl > 0:
+            # don't cache the empty list from a failed connection
+            with self.lock:
+                self.entries[key] = entry
+        return entry
+
+    # get the rows of a MAF list
+    def get(self, md, nMAFListID):
+        return self.get_entry(md, nMAFListID)[0]
+
+    # get an object built from a MAF list by fnBuild(rows) - built once and kept until the list is reloaded
+    # sKind names the type of object, so several can be kept for the same list
+    def get_derived(self, md, nMAFListID, sKind, fnBuild):
+        entry = self.get_entry(md, nMAFListID)
+        derived = entry[3]
+        if sKind not in derived:
+            derived[sKind] = fnBuild(entry[0])
+        return derived[sKind]
+
+    # forget a cached list, or all lists if no ID is given
+    def invalidate(self, nMAFListID=None):
+        with self.lock:
+            if nMAFListID is None:
+                self.entries = {}
+            else:
+                for key in list(self.entries):
+                    if key[1] == int(nMAFListID):
+                        del self.entries[key]
+
+MAF_LIST_CACHE = MAFListCache(ENV.MAF_CACHE_SECONDS, ENV.MAF_CACHE_CHECK_CHANGES)
+
+# Buffered writer for the AILog table - one per database, shared by all MAutoIndex objects in a process
+# Log events are queued in memory and written by a background thread, on its own connection, in multi-row
+# inserts - when batch_size events are waiting, or flush_seconds after the first event was queued
+# Use flush() to wait for everything queued so far to be written, e.g. at the end of a job
+# Everything is flushed when the process exits
+# At most max_buffer events are held - if the database can't keep up (or is down) further events are either
+# appended to spill_file as tab separated lines ('spill'), or dropped ('drop'), and counted in n_overflow
+class AILogWriter:
+
+    writers = {}                            # all writers in this process, keyed by connection string
+    writers_lock = threading.Lock()
+    s_SQL_COLUMNS = 'AL_JobID, AL_Source, AL_Description, AL_CabinetID, AL_DocID'
+    n_COLUMNS = 5
+
+    def __init__(self, md, batch_size=50, flush_seconds=2, max_buffer=10000, overflow='spill', spill_file='',
+                 max_retries=3):
+        self.md_source = md
+        self.md_database = None             # opened by the writer thread
+        self.batch_size = max(1, min(batch_size, n_MAX_PARAMETERS // self.n_COLUMNS))
+        self.flush_seconds = flush_seconds
+        self.max_buffer = max_buffer
+        self.overflow = overflow
+        self.spill_file = spill_file
+        self.max_retries = max_retries
+        self.n_failures = 0                 # batch inserts failed in a row
+        self.events = []                    # (JobID, source, description, cabinet, docID) waiting to be written
+        self.n_writing = 0                  # events taken by the writer thread, not yet written
+        self.n_written = 0
+        self.n_overflow = 0
+        self.first_event_time = 0           # when the oldest waiting event was queued (roughly)
+        self.fFlush = False
+        self.fClosed = False
+        self.cond = threading.Condition()
+        self.spill_lock = threading.Lock()  # one thread at a time appending to the spill file
+        self.thread = threading.Thread(target=self.run, name='AILogWriter', daemon=True)
+        self.thread.start()
+
+    # get the writer for a database, creating it on first use
+    @classmethod
+    def get_writer(cls, md):
+        with cls.writers_lock:
+            writer = cls.writers.get(md.getConnectionString())
+            if writer is None or writer.fClosed:
+                writer = cls(md, ENV.AILOG_BATCH_SIZE, ENV.AILOG_FLUSH_SECONDS, ENV.AILOG_MAX_BUFFER,
+                             ENV.AILOG_OVERFLOW, ENV.AILOG_SPILL_FILE, ENV.AILOG_MAX_RETRIES)
+                cls.writers[md.getConnectionString()] = writer
+        return writer
+
+    # flush and stop all writers - registered to run at exit
+    @classmethod
+    def close_all(cls):
+        with cls.writers_lock:
+            writers = list(cls.writers.values())
+            cls.writers = {}
+        for writer in writers:
+            writer.close()
+
+    # queue an event - does not wait for the database
+    def write(self, nJobID, sDescription, sSource='', sCabinetID='', nDocID=0):
+        event = (nJobID, sSource, sDescription, sCabinetID, nDocID)
+        with self.cond:
+            if not self.fClosed and len(self.events) < self.max_buffer:
+                self.events += [event]
+                if len(self.events) == 1:
+                    self.first_event_time = time.time()
+                if len(self.events) == 1 or len(self.events) >= self.batch_size:
+                    # start the flush delay, or write a full batch
+                    self.cond.notify_all()
+                return True
+        self.overflow_events([event])
+        return False
+
+    # deal with events which can't be queued, or written when closing
+    # the spill file has a lock of its own, so writing to it doesn't hold up write() or the writer thread
+    def overflow_events(self, events):
+        with self.cond:
+            self.n_overflow += len(events)
+        M.METRICS.count('log_events_overflow', len(events))
+        if self.overflow == 'spill' and self.spill_file != '':
+            lines = []
+            for e in events:
+                lines += ['\t'.join([str(v).replace('\t', ' ').replace('\n', ' ') for v in e]) + '\n']
+            try:
+                with self.spill_lock:
+                    s_dir = os.path.dirname(self.spill_file)
+                    if s_dir:
+                        os.makedirs(s_dir, exist_ok=True)
+                    with open(self.spill_file, 'a', encoding='utf-8') as f:
+                        f.writelines(lines)
+            except OSError:
+                pass
+
+    # wait for all events queued so far to be written, for up to timeout seconds (None = no limit)
+    # returns True if everything was written
+    def flush(self, timeout=None):
+        with self.cond:
+            self.fFlush = True
+            self.cond.notify_all()
+            return self.cond.wait_for(lambda: len(self.events) == 0 and self.n_writing == 0, timeout)
+
+    # flush and stop the writer thread - anything which can't be written goes to the overflow policy
+    def close(self, timeout=10):
+        with self.cond:
+            if self.fClosed:
+                return
+            self.fClosed = True
+            self.cond.notify_all()
+        self.thread.join(timeout)
+
+    # get the multi-row insert statement for a number of events
+    def get_insert_sql(self, nRows):
+        sValues = ', '.join(['(' + ', '.join(['?'] * self.n_COLUMNS) + ')'] * nRows)
+        return 'insert into AILog (' + self.s_SQL_COLUMNS + ') values ' + sValues
+
+    # write a batch of events, returns True if written
+    @M.timed('log_write')
+    def write_batch(self, events):
+        if self.md_database is None or not self.md_database.isConnected():
+            self.md_database = self.md_source.clone()
+        params = []
+        for e in events:
+            params += list(e)
+        return self.md_database.execute(self.get_insert_sql(len(events)), params=params)
+
+    # write a batch of events one at a time, after it has failed as a whole - e.g. because one of the
+    # descriptions is too long for the column - returns the events which could not be written
+    def write_events(self, events):
+        failed = []
+        for e in events:
+            try:
+                fWritten = self.write_batch([e])
+            except Exception:
+                fWritten = False
+            if not fWritten:
+                failed += [e]
+        return failed
+
+    # writer thread
+    def run(self):
+        while True:
+            with self.cond:
+                # wait for a full batch, the flush delay, a flush request or close
+                while not (len(self.events) >= self.batch_size or self.fFlush or self.fClosed):
+                    if not self.events:
+                        self.cond.wait()
+                        continue
+                    remaining = self.first_event_time + self.flush_seconds - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                if not self.events:
+                    self.fFlush = False
+                    self.cond.notify_all()
+                    if self.fClosed:
+                        break
+                    continue
+                batch = self.events[:self.batch_size]
+                del self.events[:self.batch_size]
+                self.first_event_time = time.time()
+                self.n_writing = len(batch)
+            try:
+                fWritten = self.write_batch(batch)
+            except Exception:
+                fWritten = False
+            failed = []
+            if not fWritten:
+                self.n_failures += 1
+                if self.n_failures >= self.max_retries or (self.md_database is not None and self.md_database.ping()):
+                    # the connection is fine, so something in the batch can't be written (or the database has been
+                    # unavailable for too long) - write what can be, and overflow the rest rather than holding up
+                    # all the later events
+                    failed = self.write_events(batch)
+                    fWritten = True
+            if fWritten:
+                self.n_failures = 0
+            overflow = []
+            with self.cond:
+                self.n_writing = 0
+                if fWritten:
+                    self.n_written += len(batch) - len(failed)
+                    overflow = failed
+                elif not self.fClosed:
+                    # database unavailable - put the events back and try again after the flush delay
+                    self.events[:0] = batch
+                    overflow = self.events[self.max_buffer:]
+                    del self.events[self.max_buffer:]
+                    self.cond.wait(self.flush_seconds)
+                else:
+                    # closing - nothing more can be done with these
+                    overflow = batch + self.events
+                    self.events = []
+                self.cond.notify_all()
+            if overflow:
+                self.overflow_events(overflow)
+        if self.md_database is not None:
+            self.md_database.close()
+
+atexit.register(AILogWriter.close_all)
+
+# Least recently used cache, shared by all jobs (and threads) in a process
+# Least recently used entries are dropped once there are more than nSize, 0 disables the cache
+# If ttl (seconds) is given, entries also expire - e.g. so that new rows in lookup tables are picked up
+class LRUCache:
+
+    def __init__(self, nSize=1000, ttl=0):
+        self.nSize = nSize
+        self.ttl = ttl
+        self.entries = {}                   # key -> (time added, value)
+        self.lock = threading.Lock()
+
+    # get a cached value, None if not cached
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or (self.ttl > 0 and time.time() - entry[0] >= self.ttl):
+                return None
+            self.entries[key] = entry
+            return entry[1]
+
+    def put(self, key, value):
+        if self.nSize <= 0:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            while len(self.entries) >= self.nSize:
+                # drop the least recently used entry
+                del self.entries[next(iter(self.entries))]
+            self.entries[key] = (time.time(), value)
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+
+# Recently looked up reference values - references which were not found are cached too
+REF_CACHE = LRUCache(ENV.REF_CACHE_SIZE, ENV.REF_CACHE_SECONDS)
+
+# Normalised page text, keyed by (connection, cabinet, docID, page, OCR status) - so a page which is
+# OCR'd again is normalised again - shared by the classifier and reference extract stages of a job
+PAGE_NORMALISER = mstorematch.TextNormaliser(ENV.PAGE_TEXT_FOLD, ENV.PAGE_TEXT_UPPER, ENV.PAGE_TEXT_COLLAPSE_SPACE)
+PAGE_TEXT_CACHE = LRUCache(ENV.PAGE_TEXT_CACHE_PAGES)
+
+# Statements for insert_rows(), keyed by (table, columns, number of rows, identity column)
+# with a chunk size of 100, each table and set of columns has up to 8 statements - for 100, 64, 32, ... 1 rows
+INSERT_SQL_CACHE = LRUCache(n_INSERT_SQL_CACHE_SIZE)
+
+# Pool of mstore database connections, shared by all threads in a process
+# Saves decrypting the credentials and the connection handshake each time a MDatabase is needed
+# Use get_pool() to find (or create) the pool for a server/database, then borrow a connection with:
+#     with pool.connection() as md:
+#         AI = MAutoIndex(md)
+class MDatabasePool:
+
+    pools = {}                              # all pools in this process, keyed by connection string and user
+    pools_lock = threading.Lock()
+
+    # constructor - takes plain (decrypted) credentials, get_pool() deals with encrypted ones
+    # min_size connections are opened straight away and kept open, up to max_size are opened when busy
+    # idle_timeout is how long (seconds) an unused connection above min_size is kept
+    # validate_after is how long (seconds) a connection can be idle before it is checked with a ping on borrow
+    def __init__(self, server, database, user, password, min_size=1, max_size=10, idle_timeout=300,
+                 validate_after=30, connect=None):
+        self.server = server
+        self.database = database
+        self.s_User = user
+        self.s_Password = password
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.idle_timeout = idle_timeout
+        self.validate_after = validate_after
+        self.fnConnect = connect
+        self.idle = []                      # [MDatabase, time returned to the pool], most recently used last
+        self.n_open = 0                     # connections open, idle or borrowed
+        self.fClosed = False
+        self.cond = threading.Condition()
+        for i in range(min_size):
+            md = self.new_connection()
+            if md.isConnected():
+                self.idle += [[md, time.time()]]
+                self.n_open += 1
+
+    # get the pool for a server/database/user, creating it on first use
+    @classmethod
+    def get_pool(cls, server, database, user_key, password_key, encrypted=True, credentials_file='', min_size=1,
+                 max_size=10, idle_timeout=300, validate_after=30, connect=None):
+        sKey = s_SQL_DRIVER + "SERVER=" + server + ";DATABASE=" + database + ";" + '|' + user_key
+        with cls.pools_lock:
+            pool = cls.pools.get(sKey)
+            if pool is None:
+                if encrypted:
+                    decrypt_success, user, password = mstoresecurity.get_account_details(user_key, password_key,
+                                                                                         credentials_file)
+                    if not decrypt_success:
+                        raise ValueError('Failed to decrypt credentials for connection pool')
+                else:
+                    user = user_key
+                    password = password_key
+                pool = cls(server, database, user, password, min_size, max_size, idle_timeout, validate_after,
+                           connect)
+                cls.pools[sKey] = pool
+        return pool
+
+    # open a new connection for the pool
+    def new_connection(self):
+        return MDatabase(self.server, self.database, self.s_User, self.s_Password, encrypted=False,
+                         connect=self.fnConnect)
+
+    # borrow a connection - waits for up to timeout seconds (None = no limit) if all connections are in use
+    # the connection must be given back with release() - or use connection(), which does this automatically
+    def borrow(self, timeout=None):
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            md = None
+            with self.cond:
+                if self.fClosed:
+                    raise ValueError('Connection pool has been closed')
+                while not self.idle and self.n_open >= self.max_size:
+                    if timeout is None:
+                        self.cond.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise TimeoutError('No database connection available in pool')
+                        self.cond.wait(remaining)
+                if self.idle:
+                    md, last_used = self.idle.pop()
+                else:
+                    self.n_open += 1
+
+            if md is None:
+                # room for a new connection
+                md = self.new_connection()
+                if not md.isConnected():
+                    self.discard(md)
+                    raise ConnectionError(md.getLastError())
+                return md
+
+            if time.time() - last_used >= self.validate_after and not md.ping():
+                # connection dropped while idle (e.g. server restart) - replace it
+                if not md.reconnect():
+                    self.discard(md)
+                    raise ConnectionError(md.getLastError())
+            return md
+
+    # give a borrowed connection back to the pool - any uncommitted work is rolled back
+    def release(self, md):
+        if md.fInTransaction:
+            try:
+                md.rollback()
+            except:
+                md.close()
+        expired = []
+        with self.cond:
+            if md.isConnected() and not self.fClosed:
+                self.idle += [[md, time.time()]]
+            else:
+                self.n_open -= 1
+                expired += [md]
+            # close connections that have not been used for a while, keeping the minimum number open
+            now = time.time()
+            while self.idle and self.n_open > self.min_size and now - self.idle[0][1] > self.idle_timeout:
+                expired += [self.idle.pop(0)[0]]
+                self.n_open -= 1
+            self.cond.notify()
+        for e in expired:
+            e.close()
+
+    # throw away a borrowed connection, rather than returning it to the pool
+    def discard(self, md):
+        md.close()
+        with self.cond:
+            self.n_open -= 1
+            self.cond.notify()
+
+    # borrow a connection for a 'with' block, giving it back at the end
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        md = self.borrow(timeout)
+        try:
+            yield md
+        finally:
+            self.release(md)
+
+    # close all idle connections - borrowed connections are closed as they are released
+    def close(self):
+        with self.cond:
+            self.fClosed = True
+            idle = self.idle
+            self.idle = []
+            self.n_open -= len(idle)
+            self.cond.notify_all()
+        for i in idle:
+            i[0].close()
+
+# The CPU bound part of auto-indexing - matching rules against page text, with no database access
+# These are plain functions, so they can be run in worker processes by MatchExecutor
+
+# classify a document from its (normalised) pages - returns the DTID for a unique match, 0 for no match,
+# -1 for a multiple match
+@M.timed('classify_pages')
+def classify_pages(rule_set, pages):
+    nTargetDTID = 0
+    fUnique     = True
+
+    # loop over pages
+    for page in pages:
+
+        # CAUTION - reversed the decision to work only in upper case...
+        # we are going to work only in upper case
+        #page = page.upper()
+
+        # get the DTIDs with a matching rule on this page - once two different DTIDs have matched,
+        # the result can only be a multiple match, so no need to look for any more
+        for nDTID in rule_set.matching_dtids(page, 2):
+            # update DTID if we have a match, update the unique flag if multiple DTID matches
+            if (nTargetDTID == 0) or (nDTID == nTargetDTID):
+                # either first match or same DTID
+                nTargetDTID = nDTID
+            elif (nTargetDTID != 0) and (nDTID != nTargetDTID):
+                # match, but not the same DTID as previous matches
+                fUnique = False
+
+        if not fUnique:
+            break
+
+    # have now tested all rules over all pages - can return the DTID, if any...
+    if fUnique:
+        # either a unique match or no match
+        return nTargetDTID
+    else:
+        #non-unique match to rules
+        return -1
+
+# find the regex matches for each rule on the (normalised) pages of a document - may be multiples
+# page_numbers is the MT_Page of each page, as a page may be missing from MRContents (default 1, 2, 3...)
+# returns a list with an entry for each rule, of a list of (page number, match)
+@M.timed('find_reference_matches')
+def find_reference_matches(ref_rules, pages, page_numbers=None):
+    if page_numbers is None:
+        page_numbers = range(1, len(pages) + 1)
+    rule_matches = []
+    for rule in ref_rules:
+        regex = rule[2]                         # 3rd value in rule tuple is the actual regex
+        page_matches = []
+        for nPage, page in zip(page_numbers, pages):
+            for match in re.findall(regex, page):
+                page_matches += [(nPage, match)]
+        rule_matches += [page_matches]
+    return rule_matches
+
+# check which matches are validated, by one of their cross-reference values being found in the document
+# Will be a list of tuples:
+#   [(RuleId, Ref Value, Cross-Ref Value, Page Found)]
+@M.timed('validate_reference_matches')
+def validate_reference_matches(ref_rules, pages, rule_matches, cross_checks):
+    validated_matches = []
+
+    # Loop over the reference rules
+    for i, rule in enumerate(ref_rules):
+        page_matches = rule_matches[i]
+        if len(page_matches) == 0:
+            continue
+        cross_check = cross_checks[i]
+
+        # find which of the cross-reference values are on each page - plain text, not regexes
+        # the matcher is built once for all of the values, then used for each page (see LiteralMatcher for how)
+        # values are normalised in the same way as the page text, so e.g. accented names can match
+        normalised = {}
+        for m in page_matches:
+            for cv in cross_check[m[1]]:
+                normalised[cv] = PAGE_NORMALISER.normalise(cv)
+        matcher = mstorematch.LiteralMatcher(normalised.values())
+        page_values = [matcher.find_values(check_page) for check_page in pages]
+
+        # Loop over matches
+        for nPage, match in page_matches:
+
+            cross_check_values = cross_check[match]
+
+            # Loop over the document pages
+            for found_values in page_values:
+
+                for cv in cross_check_values:
+
+                    # a value with nothing left once normalised can't validate anything - it is skipped
+                    # (and logged by MAutoIndex.log_empty_cross_checks)
+                    if normalised[cv] == '':
+                        continue
+
+                    # do we have this value in the text? Record if validated
+                    if normalised[cv] in found_values:
+
+                        validated_matches += [(rule[0], match, cv, nPage)]
+
+    return validated_matches
+
+# classify a document and find its reference matches - the reference matches are only looked for if the
+# document is classified, or if there is no rule set (i.e. the classification is already known)
+# returns (target DTID, reference matches), with None for reference matches if not looked for
+def match_document(rule_set, ref_rules, pages, page_numbers=None):
+    nTargetDTID = 0
+    if rule_set is not None:
+        nTargetDTID = classify_pages(rule_set, pages)
+    rule_matches = None
+    if ref_rules is not None and (rule_set is None or int(nTargetDTID) > 0):
+        rule_matches = find_reference_matches(ref_rules, pages, page_numbers)
+    return nTargetDTID, rule_matches
+
+# rules held by each worker process - compiled once, when the process starts, and kept for every task
+worker_rule_set = None
+worker_ref_rules = None
+
+# worker process initialiser - takes the fixed text classifier rules as (DTID, RegEx) tuples, and the
+# reference rules, either of which can be None
+def init_match_worker(fixed_rules, ref_rules):
+    global worker_rule_set, worker_ref_rules
+    if fixed_rules is not None:
+        worker_rule_set = mstorematch.CompiledRuleSet(fixed_rules)
+    worker_ref_rules = ref_rules
+
+# the stage timings recorded in a worker are sent back with each result (see mstoremetrics.call_recorded())
+def match_worker(task):
+    pages, page_numbers = task
+    return M.call_recorded(match_document, worker_rule_set, worker_ref_rules, pages, page_numbers)
+
+def validate_worker(task):
+    pages, rule_matches, cross_checks = task
+    return M.call_recorded(validate_reference_matches, worker_ref_rules, pages, rule_matches, cross_checks)
+
+# Runs the rule matching for a batch of documents, either in this process or spread over worker processes
+# Database work stays with the caller - the workers are sent page text and return the matches
+# Each worker compiles the rules once, when it starts, so they stay warm for all of the documents it is sent
+# With nProcesses = 0 everything is run in this process
+class MatchExecutor:
+
+    executor = None
+
+    def __init__(self, nProcesses, fixed_rules, ref_rules):
+        self.nProcesses = nProcesses
+        self.ref_rules = ref_rules
+        self.rule_set = None
+        if nProcesses > 0:
+            self.executor = concurrent.futures.ProcessPoolExecutor(nProcesses, initializer=init_match_worker,
+                                                                   initargs=(fixed_rules, ref_rules))
+        elif fixed_rules is not None:
+            self.rule_set = mstorematch.CompiledRuleSet(fixed_rules)
+
+    # number of documents sent to a worker at a time - enough to keep the workers busy without much overhead
+    def get_chunk_size(self, nItems):
+        return max(1, nItems // (self.nProcesses * 4))
+
+    # classify and find reference matches for a list of documents, each a list of page text along with a list
+    # of the page numbers - returns a list of (target DTID, reference matches), as match_document()
+    def match(self, doc_pages, doc_page_numbers):
+        tasks = list(zip(doc_pages, doc_page_numbers))
+        if self.executor is None:
+            return [match_document(self.rule_set, self.ref_rules, t[0], t[1]) for t in tasks]
+        return [M.record_result(r) for r in self.executor.map(match_worker, tasks,
+                                                                chunksize=self.get_chunk_size(len(tasks)))]
+
+    # validate the reference matches for a list of (pages, reference matches, cross-reference values)
+    # returns a list of validated matches, as validate_reference_matches()
+    def validate(self, tasks):
+        if self.executor is None:
+            return [validate_reference_matches(self.ref_rules, t[0], t[1], t[2]) for t in tasks]
+        return [M.record_result(r) for r in self.executor.map(validate_worker, tasks,
+                                                                chunksize=self.get_chunk_size(len(tasks)))]
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
 
 class MAutoIndex:
 
     md_database = None      # Will hold an mstore database connection object
+    page_cache = None       # Pages of recently used documents, (cabinet, docID) -> list of page rows
+    n_PAGE_CACHE_DOCS = 8   # Number of documents to keep in the page cache
+    nPageCacheJobID = None  # Job the page cache belongs to (see start_job())
+    log_writer = None       # AILogWriter for buffered logging, None to write log events straight away
 
     def __init__(self, mDatabase):
         self.set_database(mDatabase)
+        self.page_cache = {}
+        if ENV.AILOG_BUFFERED:
+            self.log_writer = AILogWriter.get_writer(self.md_database)
+
+    # get the text of all pages of a document - loaded with one query, then kept for the rest of the job
+    # so the classifier and reference extract (and each rule within them) share a single load of the pages
+    # a page with no MRContents row is left out - the page numbers are MT_Page in get_document_page_rows()
+    def get_document_pages(self, sCabinetID, nDocID):
+        return [r.MT_Contents for r in self.get_document_page_rows(sCabinetID, nDocID)]
+
+    # get the normalised text of all pages of a document (see PAGE_NORMALISER) - each page is normalised once
+    # and kept in PAGE_TEXT_CACHE until its OCR status changes
+    def get_clean_pages(self, sCabinetID, nDocID):
+        return self.normalise_page_rows(sCabinetID, nDocID, self.get_document_page_rows(sCabinetID, nDocID))
+
+    # get the normalised text for a document's page rows, from PAGE_TEXT_CACHE where possible
+    def normalise_page_rows(self, sCabinetID, nDocID, rows):
+        sConnection = self.md_database.getConnectionString()
+        pages = []
+        for r in rows:
+            key = (sConnection, str(sCabinetID), nDocID, r.MT_Page, r.MT_Status)
+            page = PAGE_TEXT_CACHE.get(key)
+            if page is None:
+                M.METRICS.count('page_text_cache_miss')
+                page = PAGE_NORMALISER.normalise(r.MT_Contents)
+                PAGE_TEXT_CACHE.put(key, page)
+            pages += [page]
+        return pages
+
+    # get the page rows of a document, from the page cache if recently used
+    def get_document_page_rows(self, sCabinetID, nDocID):
+        key = (str(sCabinetID), nDocID)
+        rows = self.page_cache.pop(key, None)
+        if rows is None:
+            rows = self.md_database.get_document_page_rows(sCabinetID, nDocID)
+            if len(self.page_cache) >= self.n_PAGE_CACHE_DOCS:
+                # drop the least recently used document
+                del self.page_cache[next(iter(self.page_cache))]
+        self.page_cache[key] = rows
+        return rows
+
+    # forget cached pages - e.g. if a document is re-OCR'd while this object is in use
+    def clear_page_cache(self):
+        self.page_cache = {}
+        self.nPageCacheJobID = None
+
+    # called by each job entry point - the page cache only lasts for a single job, so the classifier and reference
+    # extract for a job share one load of the pages, but a later job for the document (e.g. after it has been
+    # OCR'd again and re-queued) sees the current pages and OCR status
+    # fNewJob starts again even for the same job, as when the job's OCR status is checked
+    def start_job(self, nJobID, fNewJob=False):
+        if fNewJob or nJobID != self.nPageCacheJobID:
+            self.page_cache = {}
+            self.nPageCacheJobID = nJobID
 
     # set and get the database object
     def set_database(self, mDatabase):
@@ -219,26 +1337,30 @@ class MAutoIndex:
     def write_log_event(self, nJobID, sDescription, sSource='', sCabinetID='', nDocID=0):
         # note that the source, cabinet and docId are optional values
 
+        if self.log_writer is not None:
+            self.log_writer.write(nJobID, sDescription, sSource, sCabinetID, nDocID)
+            return
         sTmpSQL = 'insert into AILog (' \
                     + 'AL_JobID, AL_Source, AL_Description, AL_CabinetID, AL_DocID' \
-                    + ') values (' \
-                    + str(nJobID) + ', ' \
-                    + self.md_database.quote_string(sSource) + ', ' \
-                    + self.md_database.quote_string(sDescription) + ', ' \
-                    + self.md_database.quote_string(sCabinetID) + ', ' \
-                    + str(nDocID) \
-                    + ')'
-        self.md_database.execute(sTmpSQL)
+                    + ') values (?, ?, ?, ?, ?)'
+        with M.METRICS.timer('log_write'):
+            self.md_database.execute(sTmpSQL, params=[nJobID, sSource, sDescription, sCabinetID, nDocID])
+
+    # wait for buffered log events to be written - e.g. at the end of a job
+    def flush_log(self, timeout=10):
+        if self.log_writer is not None:
+            return self.log_writer.flush(timeout)
+        return True
 
     # check for a record in AIJobs for this JobId and create one if not there
     def check_create_job_record(self, nJobID):
 
-        sTmpSQL = 'select count(*) RecCount from AIJobs where AJ_JobId = ' + str(nJobID)
-        rs = self.md_database.getRecordSet(sTmpSQL)
+        sTmpSQL = 'select count(*) RecCount from AIJobs where AJ_JobId = ?'
+        rs = self.md_database.query(sTmpSQL, [nJobID])
         if rs[0].RecCount <= 0:
             # No record in AIJobs - create one..
-            sTmpSQL = 'insert into AIJobs (AJ_JobID) Values (' + str(nJobID) + ')'
-            result = self.md_database.execute(sTmpSQL)
+            sTmpSQL = 'insert into AIJobs (AJ_JobID) Values (?)'
+            result = self.md_database.execute(sTmpSQL, params=[nJobID])
             if not result:
                 self.write_log_event(nJobID,'Failed to create AIJobs record','check_create_job_record')
                 raise('Could not create AIJobs record')
@@ -247,23 +1369,62 @@ class MAutoIndex:
 
     # Set the OCR status for a job, in the case of complete or an error
     def set_job_OCR_status(self, nJobID, sCabinetID, nDocID):
+        self.start_job(nJobID, True)
         # get the status
         nStatus = self.md_database.get_document_OCR_status(sCabinetID, nDocID)
         # write the status to the database, if there is an update
         sTmpSQL = ''
         if nStatus == 0:
             # All pages are complete, no errors
-            sTmpSQL = 'update AIJobs set AJ_OCRComplete = 1 where AJ_JobID = ' + str(nJobID)
+            sTmpSQL = 'update AIJobs set AJ_OCRComplete = 1 where AJ_JobID = ?'
             self.write_log_event(nJobID, 'OCR complete for all pages', 'set_job_OCR_status', sCabinetID, nDocID)
         else:
             if nStatus < 0:
                 # permanent error case, set the error field
-                sTmpSQL = 'update AIJobs set AJ_OCRComplete = 0, AJ_OCRError = 1 where AJ_JobID = ' + str(nJobID)
+                sTmpSQL = 'update AIJobs set AJ_OCRComplete = 0, AJ_OCRError = 1 where AJ_JobID = ?'
                 self.write_log_event(nJobID, 'Permanent error in OCR process', 'set_job_OCR_status', sCabinetID, nDocID)
-        if sTmpSQL != '':
-            result = self.md_database.execute(sTmpSQL)
-            if not result:
-                raise ('Could not update AIJobs record')
+        try:
+            if sTmpSQL != '':
+                result = self.md_database.execute(sTmpSQL, params=[nJobID])
+                if not result:
+                    raise ('Could not update AIJobs record')
+        finally:
+            # end of the job - make sure the log is written
+            self.flush_log()
+
+    # Set the OCR status for a batch of jobs - e.g. for a workflow poller checking its whole queue at once
+    # jobs is as for run_batch - a list of (JobID, CabinetID, DocID) tuples, or SQL returning those columns
+    # The status of all documents in a cabinet is read with one query, and AIJobs updated with set-based statements
+    # returns a dictionary of JobID -> OCR status (as get_document_OCR_status)
+    def set_jobs_OCR_status(self, jobs):
+        self.clear_page_cache()
+        jobs = self.get_batch_jobs(jobs)
+        by_cabinet = {}
+        for nJobID, sCabinetID, nDocID in jobs:
+            by_cabinet.setdefault(sCabinetID, []).append(nDocID)
+        cabinet_statuses = {}
+        for sCabinetID, doc_ids in by_cabinet.items():
+            cabinet_statuses[sCabinetID] = self.md_database.get_documents_OCR_status(sCabinetID, doc_ids)
+
+        job_statuses = {}
+        complete_jobs = []
+        error_jobs = []
+        for nJobID, sCabinetID, nDocID in jobs:
+            nStatus = cabinet_statuses[sCabinetID][nDocID]
+            job_statuses[nJobID] = nStatus
+            if nStatus == 0:
+                # All pages are complete, no errors
+                complete_jobs += [nJobID]
+                self.write_log_event(nJobID, 'OCR complete for all pages', 'set_job_OCR_status', sCabinetID, nDocID)
+            elif nStatus < 0:
+                # permanent error case, set the error field
+                error_jobs += [nJobID]
+                self.write_log_event(nJobID, 'Permanent error in OCR process', 'set_job_OCR_status', sCabinetID, nDocID)
+        self.update_jobs('AJ_OCRComplete = 1', [], complete_jobs)
+        self.update_jobs('AJ_OCRComplete = 0, AJ_OCRError = 1', [], error_jobs)
+        # end of the batch - make sure the log is written
+        self.flush_log()
+        return job_statuses
 
     # internal helper function - get the rules for a fixed text classifier, from a MAF list
     def get_fixed_text_classifier_rules(self, nMAFListID):
@@ -276,12 +1437,22 @@ class MAutoIndex:
         #   LS_Item2 - the DTID for this rule
         #   LS_Item3 - the Regular Expression for searching
 
+        return MAF_LIST_CACHE.get_derived(self.md_database, nMAFListID, 'fixed_text_rules',
+                                          self.build_fixed_text_classifier_rules)
+
+    # build the fixed text classifier rules from the MAF list rows
+    def build_fixed_text_classifier_rules(self, rsMAF):
         rules = []
-        rsMAF = self.md_database.get_MAF_list(nMAFListID)
         for r in rsMAF:
             rules += [(r.LS_Item2, r.LS_Item3)]
         return rules
 
+    # get the fixed text classifier rules as a compiled rule set - built once per MAF list and shared by all jobs
+    def get_fixed_text_rule_set(self, nMAFListID):
+        return MAF_LIST_CACHE.get_derived(self.md_database, nMAFListID, 'fixed_text_rule_set',
+                                          lambda rsMAF: mstorematch.CompiledRuleSet(
+                                              self.build_fixed_text_classifier_rules(rsMAF)))
+
     # function to run a fixed text classification, returns the DTID for the doc (if uniquely matched)
     def fixed_text_classifier(self, nJobID, sCabinetID, nDocID, nRulesList=0):
         # takes in the job/cabinet/docid
@@ -296,75 +1467,47 @@ class MAutoIndex:
         # Note that the page content is converted to UPPER CASE for processing, but the RegEx values are not
         # Therefore fixed text values in the RegEx should be set up as upper text in the parameters / MAF list
 
-        nTargetDTID = 0
-        fUnique     = True
-        nDocPages   = 0
-
-        # load the rules - will be a list of tuples of (DTID, RegEx)
+        # load the rules - from a list of tuples of (DTID, RegEx), compiled for matching
         # [(1, 'Purchase Invoice'), (2, 'Some other document type marker text)]
         if nRulesList == 0:
             nMAFList = ENV.MAF_ListID_FixedTextClassifier
         else:
             nMAFList = nRulesList
-        rules = self.get_fixed_text_classifier_rules(nMAFList)
-
-        # load the page count for this document
-        nDocPages = self.md_database.get_document_page_count(sCabinetID, nDocID)
-
-        # loop over pages
-        for nPage in range(1,nDocPages+1):
-            # load the page text
-            page = self.md_database.get_page_contents(sCabinetID, nDocID, nPage)
-            # clean out any unicode chars in the page text
-            page = re.sub(r'[^\x00-\x7f]', r'', page)
-
-            # CAUTION - reversed the decision to work only in upper case...
-            # we are going to work only in upper case
-            #page = page.upper()
-
-            # loop over rules
-            for r in rules:
-                regex = r[1]
-                matches = re.findall(regex, page)
-                # update DTID if we have a match, update the unique flag if multiple DTID matches
-                if matches:
-                    # have at least one match to this expression
-                    if (nTargetDTID == 0) or (r[0] == nTargetDTID):
-                        # either first match or same DTID
-                        nTargetDTID = r[0]
-                    elif (nTargetDTID != 0) and (r[0] != nTargetDTID):
-                        # match, but not the same DTID as previous matches
-                        fUnique = False
-
-        # have now tested all rules over all pages - can return the DTID, if any...
-        if fUnique:
-            # either a unique match or no match
-            if nTargetDTID != 0:
-                self.write_log_event(nJobID, 'Fixed text classifier match = ' + str(nTargetDTID), 'fixed_text_classifier',
-                                     sCabinetID, nDocID)
-            else:
-                self.write_log_event(nJobID, 'No match in fixed text classifier', 'fixed_text_classifier',
-                                     sCabinetID, nDocID)
-            return nTargetDTID
-        else:
-            #non-unique match to rules
+        rule_set = self.get_fixed_text_rule_set(nMAFList)
+
+        # load the pages for this document - all in one go, with any unicode chars cleaned out of the text
+        pages = self.get_clean_pages(sCabinetID, nDocID)
+
+        nTargetDTID = classify_pages(rule_set, pages)
+        self.log_classification(nJobID, nTargetDTID, sCabinetID, nDocID)
+        return nTargetDTID
+
+    # log the result of the fixed text classifier
+    def log_classification(self, nJobID, nTargetDTID, sCabinetID, nDocID):
+        if nTargetDTID == -1:
             self.write_log_event(nJobID, 'Multiple document type matches in fixed text classifier',
                                  'fixed_text_classifier', sCabinetID, nDocID)
-            return -1
+        elif nTargetDTID != 0:
+            self.write_log_event(nJobID, 'Fixed text classifier match = ' + str(nTargetDTID), 'fixed_text_classifier',
+                                 sCabinetID, nDocID)
+        else:
+            self.write_log_event(nJobID, 'No match in fixed text classifier', 'fixed_text_classifier',
+                                 sCabinetID, nDocID)
 
     # update the classification status
     def update_job_classification(self, nJobID, nTargetID, fFound):
-        sTmpSQL = ''
         if fFound == False:
-            sTmpSQL = 'update AIJobs set AJ_ClassFound = 0, AJ_TargetDTID = 0 where AJ_JobID = ' + str(nJobID)
+            sTmpSQL = 'update AIJobs set AJ_ClassFound = 0, AJ_TargetDTID = 0 where AJ_JobID = ?'
+            params = [nJobID]
         else:
-            sTmpSQL = 'update AIJobs set AJ_ClassFound = 1, AJ_TargetDTID = ' + str(nTargetID) \
-                        + ' where AJ_JobID = ' + str(nJobID)
-        self.md_database.execute(sTmpSQL)
+            sTmpSQL = 'update AIJobs set AJ_ClassFound = 1, AJ_TargetDTID = ? where AJ_JobID = ?'
+            params = [nTargetID, nJobID]
+        self.md_database.execute(sTmpSQL, params=params)
 
     # Run the fixed text classification process
     # This is the externally callable function, for use in workflow scripts
     def run_fixed_text_classifier(self, nJobID, sCabinetID, nDocID, nRulesList=0):
+        self.start_job(nJobID)
         self.write_log_event(nJobID, 'Running fixed text classifier', 'run_fixed_text_classifier', sCabinetID, nDocID)
         nTargetDTID = self.fixed_text_classifier(nJobID, sCabinetID, nDocID, nRulesList)
         if int(nTargetDTID) >= 1:
@@ -374,11 +1517,14 @@ class MAutoIndex:
             # did not classify at this stage
             self.update_job_classification(nJobID, 0, False)
 
+        # end of the job - make sure the log is written
+        self.flush_log()
+
     # Get the target DTID for a job where the document has been identified already
     def get_targetDTID_for_classified_doc(self, nJobID):
         # read from AIJobs
-        sTmpSQL = 'select AJ_TargetDTID, AJ_ClassFound from AIJobs where AJ_JobID = ' + str(nJobID)
-        rsDTID = self.md_database.getRecordSet(sTmpSQL)
+        sTmpSQL = 'select AJ_TargetDTID, AJ_ClassFound from AIJobs where AJ_JobID = ?'
+        rsDTID = self.md_database.query(sTmpSQL, [nJobID])
         if len(rsDTID) > 0:
             # we have a record
             if rsDTID[0].AJ_ClassFound == 1:
@@ -406,8 +1552,12 @@ class MAutoIndex:
         #   LS_Item5 - the master column in the validation table
         #   LS_Item6-10 - the cross reference fields in the validation table
 
+        return MAF_LIST_CACHE.get_derived(self.md_database, nMAFListID, 'ref_lookup_rules',
+                                          self.build_ref_lookup_rules)
+
+    # build the reference lookup rules from the MAF list rows
+    def build_ref_lookup_rules(self, rsMAF):
         rules = []
-        rsMAF = self.md_database.get_MAF_list(nMAFListID)
         for r in rsMAF:
             # create a list of lookup fields - this is useful for later, as deals with NULLs
             lookup_fields = []
@@ -420,31 +1570,84 @@ class MAutoIndex:
 
     # internal helper function - get the values for cross-checking of a candidate reference value
     def get_cross_ref_values(self, sLookupTable, sLookupColumn, sLookupValue, lCrossRefCols):
-        #print(lCrossRefCols)
-        cr_values = []
-        for c in lCrossRefCols:
-            sTmpSQL = 'select top 1 ' + c + ' as cr_value from ' + sLookupTable
-            sTmpSQL += ' where ' + sLookupColumn + ' = ' + self.md_database.quote_string(sLookupValue)
-            rsCR = self.md_database.getRecordSet(sTmpSQL)
-            # Check if empty or None (NULL)
-            if (len(str(rsCR[0].cr_value)) > 0) and (rsCR[0].cr_value != None):
-                cr_values += [rsCR[0].cr_value]
-        return cr_values
+        return self.get_cross_ref_values_batch(sLookupTable, sLookupColumn, [sLookupValue], lCrossRefCols)[sLookupValue]
+
+    # get the cross reference values for many reference values at once
+    # returns a dictionary of reference value -> list of cross reference values, [] if the reference is not found
+    # values not in the reference cache are looked up together, one query per n_MAX_PARAMETERS values
+    @M.timed('cross_ref_lookup')
+    def get_cross_ref_values_batch(self, sLookupTable, sLookupColumn, lookup_values, lCrossRefCols):
+        results = {}
+        found = set()
+        sCacheBase = (self.md_database.getConnectionString(), sLookupTable, sLookupColumn, tuple(lCrossRefCols))
+        to_find = {}                        # normalised value -> reference values to look up
+        number_keys = None                  # number -> normalised values, if the key column is numeric
+        for v in lookup_values:
+            if v in results:
+                continue
+            cr_values = REF_CACHE.get(sCacheBase + (normalise_key(v),))
+            if cr_values is not None:
+                M.METRICS.count('ref_cache_hit')
+                results[v] = cr_values
+            else:
+                M.METRICS.count('ref_cache_miss')
+                to_find.setdefault(normalise_key(v), []).append(v)
+                results[v] = []
+
+        if len(to_find) > 0 and len(lCrossRefCols) > 0:
+            # table and column names come from the MAF list configuration - only the values can be parameters
+            sColumns = ''
+            for i, c in enumerate(lCrossRefCols):
+                sColumns += ', ' + c + ' as cr_value' + str(i)
+            find_values = [v for values in to_find.values() for v in values]
+            for nStart in range(0, len(find_values), n_MAX_PARAMETERS):
+                chunk = find_values[nStart:nStart + n_MAX_PARAMETERS]
+                sTmpSQL = 'select ' + sLookupColumn + ' as cr_key' + sColumns + ' from ' + sLookupTable
+                sTmpSQL += ' where ' + sLookupColumn + ' in (' + ', '.join(['?'] * len(chunk)) + ')'
+                rsCR = self.md_database.query(sTmpSQL, chunk)
+                for r in rsCR:
+                    if isinstance(r.cr_key, (int, float, decimal.Decimal)) and not isinstance(r.cr_key, bool):
+                        # numeric key column - match the values by number, not by their text
+                        if number_keys is None:
+                            number_keys = {}
+                            for sKey in to_find:
+                                nKey = normalise_number_key(sKey)
+                                if nKey is not None:
+                                    number_keys.setdefault(nKey, []).append(sKey)
+                        keys = number_keys.get(normalise_number_key(r.cr_key), [])
+                    else:
+                        keys = [normalise_key(r.cr_key)]
+                    cr_values = []
+                    for i in range(len(lCrossRefCols)):
+                        # Check if empty or None (NULL)
+                        cr = r[i + 1]
+                        if (cr != None) and (len(str(cr)) > 0):
+                            cr_values += [cr]
+                    for sKey in keys:
+                        if sKey in found or sKey not in to_find:
+                            # only the first row for a reference is used, as with select top 1
+                            continue
+                        found.add(sKey)
+                        for v in to_find[sKey]:
+                            results[v] = cr_values
+        for sKey, values in to_find.items():
+            REF_CACHE.put(sCacheBase + (sKey,), results[values[0]])
+        return results
 
     # update the reference capture status
     def update_reference_status(self, nJobID, sRefValue, fFound):
-        sTmpSQL = ''
         if fFound == False:
-            sTmpSQL = 'update AIJobs set AJ_KeyRefFound = 0 where AJ_JobID = ' + str(nJobID)
+            sTmpSQL = 'update AIJobs set AJ_KeyRefFound = 0 where AJ_JobID = ?'
+            params = [nJobID]
         else:
-            sTmpSQL = 'update AIJobs set AJ_KeyRefFound = 1, AJ_KeyRefValue = '
-            sTmpSQL += self.md_database.quote_string(sRefValue)
-            sTmpSQL += ' where AJ_JobID = ' + str(nJobID)
-        self.md_database.execute(sTmpSQL)
+            sTmpSQL = 'update AIJobs set AJ_KeyRefFound = 1, AJ_KeyRefValue = ? where AJ_JobID = ?'
+            params = [sRefValue, nJobID]
+        self.md_database.execute(sTmpSQL, params=params)
 
     # Run the reference extract process, with validation
     # This is the externally callable function, for us in workflow scripts
     def run_reference_extract(self, nJobID, sCabinetID, nDocID, nRefRulesList=0):
+        self.start_job(nJobID)
         # This function will loop over all of the possible rules for the particular document
         # If the data is captured and validated, the captured references table will be updated
         # Finally, the AIJobs table will be updated to signal that reference extract was successful or not
@@ -454,116 +1657,24 @@ class MAutoIndex:
         if int(nTargetDTID) > 0:
 
             # Load in the reference rules for this DTID
+            ref_rules = self.get_ref_rules(nRefRulesList)
 
-            # load the rules - will be a list of tuples of:
-            #    (RuleID, DTID, RegEx, Validation Table, Master Field Name,
-            #       [Cross Ref Field1, 2, 3, 4, 5])
-            # Not all 5 cross ref fields may be used
-            # The RuleID is included for logging purposes
-
-            if nRefRulesList == 0:
-                nMAFList = ENV.MAF_ListID_ReferenceExtractDefinitions
-            else:
-                nMAFList = nRefRulesList
-            ref_rules = self.get_ref_lookup_rules(nMAFList)
-
-            # list to retain validated matches
-            # Will be a list of tuples:
-            #   [(RuleId, Ref Value, Cross-Ref Value, Page Found)]
-            validated_matches = []
-
-            # Loop over the reference rules
-            for rule in ref_rules:
-
-                # Loop over the document pages
-                nDocPages = self.md_database.get_document_page_count(sCabinetID, nDocID)
+            # load the pages for this document - all in one go, shared by every rule and match below
+            # the page text is cleaned of any unicode chars, once per page
+            rows = self.get_document_page_rows(sCabinetID, nDocID)
+            pages = self.normalise_page_rows(sCabinetID, nDocID, rows)
 
-                for nPage in range(1, nDocPages + 1):
-                    # load the page text
-                    page = self.md_database.get_page_contents(sCabinetID, nDocID, nPage)
-                    # clean out any unicode chars in the page text
-                    page = re.sub(r'[^\x00-\x7f]', r'', page)
+            # Find regex matches for each rule, then load in the potential cross-reference values for all of
+            # the matches of each rule, then check which are validated by the cross-reference values
+            rule_matches = find_reference_matches(ref_rules, pages, [r.MT_Page for r in rows])
+            cross_checks = self.get_reference_cross_checks(ref_rules, [rule_matches])
+            self.log_empty_cross_checks(nJobID, ref_rules, rule_matches, cross_checks, 'run_reference_extract',
+                                        sCabinetID, nDocID)
+            validated_matches = validate_reference_matches(ref_rules, pages, rule_matches, cross_checks)
 
-                    # Find regex matches - may be multiples
-                    regex = rule[2]                         # 3rd value in rule tuple is the actual regex
-                    matches = re.findall(regex, page)
-
-                    #print(matches)
-
-                    # Loop over matches
-                    if len(matches) > 0:
-
-                        for match in matches:
-
-                            #print(match)
-
-                            # Load in the potential cross-reference values for this match
-                            cross_check_values = self.get_cross_ref_values(rule[3], rule[4], match, rule[5])
-
-                            #print(cross_check_values)
-
-                            # Loop over the document pages
-                            for nCheckPage in range(1, nDocPages + 1):
-
-                                # load the page
-                                check_page = self.md_database.get_page_contents(sCabinetID, nDocID, nCheckPage)
-
-                                for cv in cross_check_values:
-
-                                    #print (cv)
-
-                                    # do we have this value in the text?
-                                    check_matches = re.findall(cv, check_page)
-
-                                    #print('Check matches: ', check_matches)
-
-                                    # Record if validated
-                                    if len(check_matches) > 0:
-
-                                        validated_matches += [(rule[0], match, cv, nPage)]
-
-            #print(validated_matches)
-
-            # check if we have duplicated matches for the same reference value only
-            # it is OK to match the same reference multiple times
-            # it is not OK to match to multiple references, as we won't know how to index the document
-            sFirstMatch = ''
-            fUniqueMatch = False
-            for m in validated_matches:
-                if sFirstMatch == '':
-                    sFirstMatch = m[1]
-                    fUniqueMatch = True
-                else:
-                    if m[1] != sFirstMatch:
-                        fUniqueMatch = False
-
-            #print(fUniqueMatch, len(validated_matches))
-
-            if len(validated_matches) > 0:
-                # we have some matched items
-                if fUniqueMatch:
-                    # unique match found
-                    sMessage = 'Unique reference match found for rule #' + str(validated_matches[0][0])
-                    sMessage += ', value = ' + self.md_database.quote_string(validated_matches[0][1])
-                    sMessage += ', with ' + str(len(validated_matches)) + ' total matches'
-                    self.write_log_event(nJobID, sMessage, 'run_reference_extract', sCabinetID, nDocID)
-                    # update database to indicate new status
-                    self.update_reference_status(nJobID, validated_matches[0][1], True)
-                else:
-                    # not a unique match
-                    sMessage = 'Multiple reference matches found'
-                    sMessage += ', ' + str(len(validated_matches)) + ' total matches, for rules: '
-                    for v in validated_matches:
-                        sMessage += str(v[0]) + ' '
-                    self.write_log_event(nJobID, sMessage, 'run_reference_extract', sCabinetID, nDocID)
-                    # update database to indicate new status
-                    self.update_reference_status(nJobID, '', False)
-            else:
-                # no matches
-                self.write_log_event(nJobID, 'No reference matches found for target DTID = ' + str(nTargetDTID),
-                                     'run_reference_extract', sCabinetID, nDocID)
-                # update the database to reflect the new status for this document
-                self.update_reference_status(nJobID, '', False)
+            sRefValue, fFound = self.log_reference_matches(nJobID, validated_matches, nTargetDTID, sCabinetID, nDocID)
+            # update database to indicate new status
+            self.update_reference_status(nJobID, sRefValue, fFound)
 
         else:
             # failed to get target DTID
@@ -571,6 +1682,266 @@ class MAutoIndex:
             # just update the status - this will avoid jobs being locked in workflow
             self.update_reference_status(nJobID, '', False)
 
+        # end of the job - make sure the log is written
+        self.flush_log()
+
+    # load the reference rules - will be a list of tuples of:
+    #    (RuleID, DTID, RegEx, Validation Table, Master Field Name,
+    #       [Cross Ref Field1, 2, 3, 4, 5])
+    # Not all 5 cross ref fields may be used
+    # The RuleID is included for logging purposes
+    def get_ref_rules(self, nRefRulesList=0):
+        if nRefRulesList == 0:
+            nMAFList = ENV.MAF_ListID_ReferenceExtractDefinitions
+        else:
+            nMAFList = nRefRulesList
+        return self.get_ref_lookup_rules(nMAFList)
+
+    # load the potential cross-reference values for the matches of one or more documents
+    # doc_matches is a list of find_reference_matches() results - all matches for a rule are looked up together
+    # returns a list with an entry for each rule, of a dictionary of match -> cross-reference values
+    def get_reference_cross_checks(self, ref_rules, doc_matches):
+        cross_checks = []
+        for i, rule in enumerate(ref_rules):
+            values = [m[1] for rule_matches in doc_matches for m in rule_matches[i]]
+            if len(values) == 0:
+                cross_checks += [{}]
+            else:
+                cross_checks += [self.get_cross_ref_values_batch(rule[3], rule[4], values, rule[5])]
+        return cross_checks
+
+    # log the cross-reference values for a document's matches which are empty once normalised (e.g. only spaces
+    # or characters which can't be reduced to ASCII) - they are skipped when validating, so can't validate a match
+    def log_empty_cross_checks(self, nJobID, ref_rules, rule_matches, cross_checks, sSource, sCabinetID, nDocID):
+        for i, rule in enumerate(ref_rules):
+            logged = set()
+            for nPage, match in rule_matches[i]:
+                if match in logged:
+                    continue
+                logged.add(match)
+                for cv in cross_checks[i].get(match, []):
+                    if PAGE_NORMALISER.normalise(cv) == '':
+                        sMessage = "Skipped cross-check value '" + str(cv) + "' for rule #" + str(rule[0])
+                        sMessage += ", value = '" + str(match) + "' - nothing left once normalised"
+                        self.write_log_event(nJobID, sMessage, sSource, sCabinetID, nDocID)
+
+    # log the outcome of reference extract for a document, returns (reference value, True) for a unique match,
+    # otherwise ('', False)
+    def log_reference_matches(self, nJobID, validated_matches, nTargetDTID, sCabinetID, nDocID):
+        # check if we have duplicated matches for the same reference value only
+        # it is OK to match the same reference multiple times
+        # it is not OK to match to multiple references, as we won't know how to index the document
+        sFirstMatch = ''
+        fUniqueMatch = False
+        for m in validated_matches:
+            if sFirstMatch == '':
+                sFirstMatch = m[1]
+                fUniqueMatch = True
+            else:
+                if m[1] != sFirstMatch:
+                    fUniqueMatch = False
+
+        if len(validated_matches) > 0:
+            # we have some matched items
+            if fUniqueMatch:
+                # unique match found
+                sMessage = 'Unique reference match found for rule #' + str(validated_matches[0][0])
+                sMessage += ", value = '" + str(validated_matches[0][1]) + "'"
+                sMessage += ', with ' + str(len(validated_matches)) + ' total matches'
+                self.write_log_event(nJobID, sMessage, 'run_reference_extract', sCabinetID, nDocID)
+                return validated_matches[0][1], True
+            else:
+                # not a unique match
+                sMessage = 'Multiple reference matches found'
+                sMessage += ', ' + str(len(validated_matches)) + ' total matches, for rules: '
+                for v in validated_matches:
+                    sMessage += str(v[0]) + ' '
+                self.write_log_event(nJobID, sMessage, 'run_reference_extract', sCabinetID, nDocID)
+                return '', False
+        else:
+            # no matches
+            self.write_log_event(nJobID, 'No reference matches found for target DTID = ' + str(nTargetDTID),
+                                 'run_reference_extract', sCabinetID, nDocID)
+            return '', False
+
+    # get the jobs for a batch - either a list of (JobID, CabinetID, DocID), or SQL returning those columns
+    # the cabinet is made text and the docID a number, to match the keys of the batch page and status lookups
+    def get_batch_jobs(self, jobs):
+        if isinstance(jobs, str):
+            return [(r[0], str(r[1]), int(r[2])) for r in self.md_database.query(jobs)]
+        return [(j[0], str(j[1]), int(j[2])) for j in jobs]
+
+    # run an update on AIJobs for a set of jobs, with one statement per n_MAX_PARAMETERS jobs
+    # sSet is the set clause, with ? placeholders for set_params
+    def update_jobs(self, sSet, set_params, job_ids):
+        nChunk = n_MAX_PARAMETERS - len(set_params)
+        for nStart in range(0, len(job_ids), nChunk):
+            chunk = job_ids[nStart:nStart + nChunk]
+            sTmpSQL = 'update AIJobs set ' + sSet + ' where AJ_JobID in (' + ', '.join(['?'] * len(chunk)) + ')'
+            self.md_database.execute(sTmpSQL, params=list(set_params) + chunk)
+
+    # write the classification status for a batch of jobs - job_results is a list of (JobID, target DTID)
+    def update_batch_classification(self, job_results):
+        by_dtid = {}
+        for nJobID, nTargetDTID in job_results:
+            if int(nTargetDTID) < 1:
+                nTargetDTID = 0
+            by_dtid.setdefault(nTargetDTID, []).append(nJobID)
+        for nTargetDTID, job_ids in by_dtid.items():
+            if nTargetDTID == 0:
+                self.update_jobs('AJ_ClassFound = 0, AJ_TargetDTID = 0', [], job_ids)
+            else:
+                self.update_jobs('AJ_ClassFound = 1, AJ_TargetDTID = ?', [nTargetDTID], job_ids)
+
+    # write the reference status for a batch of jobs - job_results is a list of (JobID, reference value, found)
+    def update_batch_references(self, job_results):
+        not_found = [j[0] for j in job_results if not j[2]]
+        found = [(j[0], j[1]) for j in job_results if j[2]]
+        self.update_jobs('AJ_KeyRefFound = 0', [], not_found)
+        nChunk = n_MAX_PARAMETERS // 3
+        for nStart in range(0, len(found), nChunk):
+            chunk = found[nStart:nStart + nChunk]
+            # one statement for the chunk, with the value for each job picked out by a case expression
+            sTmpSQL = 'update AIJobs set AJ_KeyRefFound = 1, AJ_KeyRefValue = case AJ_JobID' \
+                      + ' when ? then ?' * len(chunk) + ' end where AJ_JobID in (' \
+                      + ', '.join(['?'] * len(chunk)) + ')'
+            params = []
+            for nJobID, sRefValue in chunk:
+                params += [nJobID, sRefValue]
+            params += [j[0] for j in chunk]
+            self.md_database.execute(sTmpSQL, params=params)
+
+    # get the target DTIDs of classified jobs, as a dictionary of JobID -> DTID (-1 if not classified)
+    def get_batch_targetDTIDs(self, job_ids):
+        targets = {}
+        for nJobID in job_ids:
+            targets[nJobID] = -1
+        for nStart in range(0, len(job_ids), n_MAX_PARAMETERS):
+            chunk = job_ids[nStart:nStart + n_MAX_PARAMETERS]
+            sTmpSQL = 'select AJ_JobID, AJ_TargetDTID, AJ_ClassFound from AIJobs where AJ_JobID in (' \
+                      + ', '.join(['?'] * len(chunk)) + ')'
+            for r in self.md_database.query(sTmpSQL, chunk):
+                if r.AJ_ClassFound == 1:
+                    targets[r.AJ_JobID] = r.AJ_TargetDTID
+        return targets
+
+    # Run the fixed text classifier and/or reference extract for a batch of jobs - e.g. to work off a backlog
+    # This is an externally callable function, for use in workflow scripts
+    # jobs is a list of (JobID, CabinetID, DocID) tuples, or SQL returning those three columns - AIJobs doesn't
+    # record the document, so this would be a query joining the pending AIJobs rows to the workflow tables
+    # The rules are loaded once, then batch_size documents at a time have their pages read with one query per
+    # cabinet, are classified and checked for references in memory, and AIJobs is updated with set-based
+    # statements. Without fClassify, reference extract uses the classification already recorded in AIJobs
+    # With nProcesses > 0 the rule matching is spread over that many worker processes (see MatchExecutor) -
+    # when using this, the calling script must have the usual "if __name__ == '__main__':" guard
+    # returns the number of jobs processed
+    def run_batch(self, jobs, fClassify=True, fExtract=True, nRulesList=0, nRefRulesList=0, batch_size=0,
+                  nProcesses=-1):
+        # the batch reads its own pages - anything cached by earlier single jobs is dropped
+        self.clear_page_cache()
+        jobs = self.get_batch_jobs(jobs)
+        if batch_size <= 0:
+            batch_size = ENV.BATCH_SIZE_DOCS
+        if nProcesses < 0:
+            nProcesses = ENV.BATCH_PROCESSES
+
+        # load the rules - once for the whole batch
+        fixed_rules = None
+        ref_rules = None
+        if fClassify:
+            if nRulesList == 0:
+                nRulesList = ENV.MAF_ListID_FixedTextClassifier
+            fixed_rules = self.get_fixed_text_classifier_rules(nRulesList)
+        if fExtract:
+            ref_rules = self.get_ref_rules(nRefRulesList)
+        executor = MatchExecutor(nProcesses, fixed_rules, ref_rules)
+
+        nProcessed = 0
+        try:
+            for nStart in range(0, len(jobs), batch_size):
+                batch = jobs[nStart:nStart + batch_size]
+                self.run_batch_part(batch, executor, fClassify, fExtract, ref_rules)
+                nProcessed += len(batch)
+        finally:
+            executor.close()
+            # end of the batch - make sure the log is written
+            self.flush_log()
+            M.write_metrics()
+        return nProcessed
+
+    # run one part of a batch, of up to batch_size jobs
+    def run_batch_part(self, batch, executor, fClassify, fExtract, ref_rules):
+        # read the pages for all documents in the batch, one query per cabinet
+        by_cabinet = {}
+        for nJobID, sCabinetID, nDocID in batch:
+            by_cabinet.setdefault(sCabinetID, []).append(nDocID)
+        cabinet_pages = {}
+        for sCabinetID, doc_ids in by_cabinet.items():
+            cabinet_pages[sCabinetID] = self.md_database.get_documents_page_rows(sCabinetID, doc_ids)
+        doc_pages = {}
+        doc_page_numbers = {}
+        for nJobID, sCabinetID, nDocID in batch:
+            rows = cabinet_pages[sCabinetID].get(nDocID, [])
+            doc_pages[nJobID] = self.normalise_page_rows(sCabinetID, nDocID, rows)
+            doc_page_numbers[nJobID] = [r.MT_Page for r in rows]
+
+        # without classification here, only the documents already classified need to be looked at
+        if not fClassify:
+            targets = self.get_batch_targetDTIDs([j[0] for j in batch])
+            for nJobID in doc_pages:
+                if int(targets[nJobID]) <= 0:
+                    doc_pages[nJobID] = []
+                    doc_page_numbers[nJobID] = []
+
+        # the regex work - classify, and find the reference matches
+        # (match_batch is the wall time for the batch - the stages within it are timed in the worker processes)
+        with M.METRICS.timer('match_batch'):
+            results = executor.match([doc_pages[j[0]] for j in batch], [doc_page_numbers[j[0]] for j in batch])
+
+        # classify
+        if fClassify:
+            class_results = []
+            targets = {}
+            for i, (nJobID, sCabinetID, nDocID) in enumerate(batch):
+                nTargetDTID = results[i][0]
+                self.write_log_event(nJobID, 'Running fixed text classifier', 'run_batch', sCabinetID, nDocID)
+                self.log_classification(nJobID, nTargetDTID, sCabinetID, nDocID)
+                class_results += [(nJobID, nTargetDTID)]
+                targets[nJobID] = nTargetDTID
+            self.update_batch_classification(class_results)
+
+        # reference extract - the cross-reference values for all documents are loaded together
+        if fExtract:
+            ref_results = []
+            extract_jobs = []
+            doc_matches = []
+            for i, (nJobID, sCabinetID, nDocID) in enumerate(batch):
+                if int(targets[nJobID]) <= 0:
+                    self.write_log_event(nJobID, 'Cannot process references - job not classified', 'run_batch')
+                    ref_results += [(nJobID, '', False)]
+                else:
+                    extract_jobs += [batch[i]]
+                    doc_matches += [results[i][1]]
+            cross_checks = self.get_reference_cross_checks(ref_rules, doc_matches)
+
+            # validate - each document is sent the cross-reference values for its own matches only
+            tasks = []
+            for i, (nJobID, sCabinetID, nDocID) in enumerate(extract_jobs):
+                doc_checks = []
+                for r, cross_check in enumerate(cross_checks):
+                    doc_checks += [{m[1]: cross_check[m[1]] for m in doc_matches[i][r]}]
+                self.log_empty_cross_checks(nJobID, ref_rules, doc_matches[i], doc_checks, 'run_batch', sCabinetID,
+                                            nDocID)
+                tasks += [(doc_pages[nJobID], doc_matches[i], doc_checks)]
+            with M.METRICS.timer('validate_batch'):
+                validated = executor.validate(tasks)
+
+            for i, (nJobID, sCabinetID, nDocID) in enumerate(extract_jobs):
+                sRefValue, fFound = self.log_reference_matches(nJobID, validated[i], targets[nJobID],
+                                                               sCabinetID, nDocID)
+                ref_results += [(nJobID, sRefValue, fFound)]
+            self.update_batch_references(ref_results)
+
 def unit_test():
     # Run unit tests for this module
     # Will require an mstore system to test against, which will require some standard setup (user, password etc)
@@ -868,9 +2239,344 @@ def unit_test():
         print('Reference extract test failed...')
         n_fail += 1
 
+    # tests which don't need the test mstore system
+    n_offline_pass, n_offline_fail = unit_test_offline()
+    n_pass += n_offline_pass
+    n_fail += n_offline_fail
+
     print("\nCompleted unit tests for " + MODULE_NAME)
     print(str(n_pass + n_fail) + " total tests")
     print(str(n_pass) + " tests passed")
     print(str(n_fail) + " tests failed\n")
 
-    return n_pass, n_fail
\ No newline at end of file
+    return n_pass, n_fail
+
+def unit_test_offline():
+    # Run the unit tests for this module which don't need an mstore system
+    # These use the SQLite stand-in for mstore from formation_benchmark.py, through the connect hook
+    # (connections are opened here, not with bench.open(), so that they are this module's classes when it is
+    # run as a script)
+
+    import tempfile
+    import shutil
+    import formation_benchmark as FB
+
+    n_pass = 0
+    n_fail = 0
+    print("\nRunning offline unit tests for " + MODULE_NAME)
+    s_dir = tempfile.mkdtemp()
+    bench = FB.BenchDatabase(os.path.join(s_dir, 'unit_test.db'))
+    bench.create_tables()
+
+    # connect function which fails when asked to - e.g. while the server restarts
+    connect_calls = [0, 0]                  # connections attempted, failures still to give
+    def flaky_connect(sConnectionString):
+        connect_calls[0] += 1
+        if connect_calls[1] > 0:
+            connect_calls[1] -= 1
+            raise ConnectionError('Server unavailable')
+        return bench.connect(sConnectionString)
+
+    print("\n" + str(n_pass + n_fail + 1) + ": Pool replaces a dropped connection when validated on borrow")
+    try:
+        pool = MDatabasePool('test', 'test', 'test', '', min_size=1, max_size=2, idle_timeout=300,
+                             validate_after=0, connect=flaky_connect)
+        md = pool.borrow()
+        pool.release(md)
+        md.getConnection().close()          # connection drops while idle in the pool
+        connect_calls[1] = 1                # and the first attempt to reconnect fails
+        try:
+            pool.borrow()
+            fHandedOut = True
+        except ConnectionError:
+            fHandedOut = False
+        md = pool.borrow()                  # server back again
+        fWorking = md.query('select count(*) n from AIJobs')[0].n == 0
+        pool.release(md)
+        if not fHandedOut and fWorking and pool.n_open == 1 and connect_calls[0] == 3:
+            print('Broken connection not handed out, replaced on the next borrow')
+            print('Test passed')
+            n_pass += 1
+        else:
+            print('Handed out: %s, working: %s, open: %d, connects: %d' % (fHandedOut, fWorking, pool.n_open,
+                                                                           connect_calls[0]))
+            print('Test failed')
+            n_fail += 1
+        pool.close()
+    except:
+        print('Pool validate on borrow test failed...')
+        n_fail += 1
+
+    print("\n" + str(n_pass + n_fail + 1) + ": Statement reconnects once when the connection has dropped")
+    try:
+        md = MDatabase('test', 'test', 'test', '', encrypted=False, connect=flaky_connect)
+        md.getConnection().close()
+        rs = md.query('select count(*) n from AIJobs where AJ_JobID = ?', [1])
+        if rs[0].n == 0 and md.isConnected():
+            print('Reconnected and ran the statement')
+            print('Test passed')
+            n_pass += 1
+        else:
+            print('Test failed')
+            n_fail += 1
+        md.close()
+    except:
+        print('Reconnect test failed...')
+        n_fail += 1
+
+    print("\n" + str(n_pass + n_fail + 1) + ": Pool closes idle connections above the minimum")
+    try:
+        pool = MDatabasePool('test', 'test', 'test', '', min_size=0, max_size=2, idle_timeout=0.05,
+                             validate_after=30, connect=flaky_connect)
+        md1 = pool.borrow()
+        md2 = pool.borrow()
+        pool.release(md1)
+        time.sleep(0.1)
+        pool.release(md2)                   # md1 has been idle for longer than idle_timeout
+        if pool.n_open == 1 and not md1.isConnected() and len(pool.idle) == 1:
+            print('Idle connection closed')
+            print('Test passed')
+            n_pass += 1
+        else:
+            print('Open: %d, idle: %d' % (pool.n_open, len(pool.idle)))
+            print('Test failed')
+            n_fail += 1
+        pool.close()
+    except:
+        print('Pool idle eviction test failed...')
+        n_fail += 1
+
+    print("\n" + str(n_pass + n_fail + 1) + ": Bulk cross-reference lookup on a numeric key column")
+    try:
+        bench.run_script("create table zNumLookup (Account int primary key, Name text);"
+                         "insert into zNumLookup values (123, 'ACME LTD');")
+        md = MDatabase('test', 'test', 'test', '', encrypted=False, connect=bench.connect)
+        AI = MAutoIndex(md)
+        REF_CACHE.clear()
+        cr_values = AI.get_cross_ref_values_batch('zNumLookup', 'Account', ['00123', '123', '999'], ['Name'])
+        if cr_values == {'00123': ['ACME LTD'], '123': ['ACME LTD'], '999': []}:
+            print('Values matched by number')
+            print('Test passed')
+            n_pass += 1
+        else:
+            print('Cross-reference values: ', cr_values)
+            print('Test failed')
+            n_fail += 1
+        AI.flush_log()
+        md.close()
+    except:
+        print('Numeric key lookup test failed...')
+        n_fail += 1
+
+    print("\n" + str(n_pass + n_fail + 1) + ": Cross-check value which is empty once normalised is logged")
+    try:
+        MAF_LIST_CACHE.fCheckChanges = False    # binary_checksum() is SQL Server only
+        bench.add_MAF_list(902, [[1, 1, r'ACC\d{6}', FB.LOOKUP_TABLE, 'Account', 'Name', 'Town']])
+        # the company name is all non-ASCII, so nothing is left of it once normalised
+        bench.run_script("insert into " + FB.LOOKUP_TABLE + " values ('ACC000001', '\u682a\u5f0f', 'LEEDS');"
+                         "insert into MICAB1 values (1, 1, 1, 'pdf');"
+                         "insert into MRContents1 values (1, 1, 'Account ACC000001 LEEDS', 3);"
+                         "insert into AIJobs (AJ_JobID, AJ_ClassFound, AJ_TargetDTID) values (1, 1, 1);")
+        md = MDatabase('test', 'test', 'test', '', encrypted=False, connect=bench.connect)
+        AI = MAutoIndex(md)
+        AI.run_reference_extract(1, '1', 1, 902)
+        AI.flush_log()
+        rs = md.query("select count(*) n from AILog where AL_JobID = 1 and AL_Description like 'Skipped%'")
+        rsJob = md.query('select AJ_KeyRefFound, AJ_KeyRefValue from AIJobs where AJ_JobID = 1')
+        if rs[0].n == 1 and rsJob[0].AJ_KeyRefFound == 1 and rsJob[0].AJ_KeyRefValue == 'ACC000001':
+            print('Empty value logged, reference validated by the other value')
+            print('Test passed')
+            n_pass += 1
+        else:
+            print('Log events: %d, reference found: %s' % (rs[0].n, rsJob[0].AJ_KeyRefFound))
+            print('Test failed')
+            n_fail += 1
+        md.close()
+    except:
+        print('Empty cross-check value test failed...')
+        n_fail += 1
+
+    print("\n" + str(n_pass + n_fail + 1) + ": Batch reference extract with the docID given as text")
+    try:
+        md = MDatabase('test', 'test', 'test', '', encrypted=False, connect=bench.connect)
+        AI = MAutoIndex(md)
+        md.execute('update AIJobs set AJ_KeyRefFound = 0, AJ_KeyRefValue = null where AJ_JobID = 1')
+        doc_pages = md.get_documents_page_rows('1', ['1'])
+        AI.run_batch([(1, 1, '1')], fClassify=False, nRefRulesList=902, nProcesses=0)
+        rsJob = md.query('select AJ_KeyRefFound, AJ_KeyRefValue from AIJobs where AJ_JobID = 1')
+        if list(doc_pages) == [1] and len(doc_pages[1]) == 1 and rsJob[0].AJ_KeyRefFound == 1:
+            print('Pages found and reference validated')
+            print('Test passed')
+            n_pass += 1
+        else:
+            print('Page rows: %s, reference found: %s' % (doc_pages, rsJob[0].AJ_KeyRefFound))
+            print('Test failed')
+            n_fail += 1
+        md.close()
+    except:
+        print('Batch with text docID test failed...')
+        n_fail += 1
+
+    print("\n" + str(n_pass + n_fail + 1) + ": OCR status with the docID given as text")
+    try:
+        md = MDatabase('test', 'test', 'test', '', encrypted=False, connect=bench.connect)
+        AI = MAutoIndex(md)
+        md.execute('update AIJobs set AJ_OCRComplete = 0, AJ_OCRError = 0 where AJ_JobID = 1')
+        nStatus = md.get_document_OCR_status('1', '1')
+        statuses = md.get_documents_OCR_status('1', ['1', 1, '999'])
+        AI.set_job_OCR_status(1, '1', '1')
+        rsJob = md.query('select AJ_OCRComplete, AJ_OCRError from AIJobs where AJ_JobID = 1')
+        if nStatus == 0 and statuses == {1: 0, 999: -1} and rsJob[0].AJ_OCRComplete == 1 \
+                and rsJob[0].AJ_OCRError == 0:
+            print('Document found, OCR complete')
+            print('Test passed')
+            n_pass += 1
+        else:
+            print('Status: %d, statuses: %s, AIJobs: %s' % (nStatus, statuses, rsJob[0]))
+            print('Test failed')
+            n_fail += 1
+        md.close()
+    except:
+        print('OCR status with text docID test failed...')
+        n_fail += 1
+
+    print("\n" + str(n_pass + n_fail + 1) + ": Insert rows uses a few fixed chunk sizes")
+    try:
+        md = MDatabase('test', 'test', 'test', '', encrypted=False, connect=bench.connect)
+        chunk_sizes = []
+        get_template = md.get_insert_rows_template
+        def recording_template(sTable, columns, nRows, sIdentityColumn):
+            chunk_sizes.append(nRows)
+            return get_template(sTable, columns, nRows, sIdentityColumn)
+        md.get_insert_rows_template = recording_template
+        rows = [['path' + str(n), 'type', 'ref' + str(n)] for n in range(237)]
+        new_ids = md.insert_rows(ENV.FORMATION_DATA_TABLE, ('originalpath', 'formtype', 'formref'), rows)
+        rsRows = md.query('select ID, originalpath from ' + ENV.FORMATION_DATA_TABLE + " where formtype = 'type'")
+        paths = dict([(r.ID, r.originalpath) for r in rsRows])
+        if chunk_sizes == [100, 100, 32, 4, 1] and new_ids is not None \
+                and [paths.get(nID) for nID in new_ids] == [r[0] for r in rows]:
+            print('237 rows inserted as 100 + 100 + 32 + 4 + 1, Ids in row order')
+            print('Test passed')
+            n_pass += 1
+        else:
+            print('Chunk sizes: %s, Ids: %s' % (chunk_sizes, new_ids))
+            print('Test failed')
+            n_fail += 1
+        md.close()
+    except:
+        print('Insert rows chunk sizes test failed...')
+        n_fail += 1
+
+    print("\n" + str(n_pass + n_fail + 1) + ": Page cache is not carried over to a later job for the document")
+    try:
+        bench.add_MAF_list(903, [[1, 1, 'INVOICE REF']])
+        bench.run_script("insert into MICAB1 values (7, 1, 0, 'pdf');"
+                         "insert into MRContents1 values (7, 1, 'NOT YET OCRD', 1);"
+                         "insert into AIJobs (AJ_JobID, AJ_OCRComplete) values (7, 0);"
+                         "insert into AIJobs (AJ_JobID, AJ_OCRComplete) values (8, 0);")
+        md = MDatabase('test', 'test', 'test', '', encrypted=False, connect=bench.connect)
+        AI = MAutoIndex(md)
+        AI.run_fixed_text_classifier(7, '1', 7, 903)
+        # the document is OCR'd again and re-queued as a new job
+        bench.run_script("update MRContents1 set MT_Contents = 'INVOICE REF 1234', MT_Status = 3 where MT_DocId = 7")
+        AI.run_fixed_text_classifier(8, '1', 7, 903)
+        rsJobs = md.query('select AJ_TargetDTID from AIJobs where AJ_JobID in (7, 8) order by AJ_JobID')
+        nFirst, nSecond = [int(r.AJ_TargetDTID) for r in rsJobs]
+        if nFirst == 0 and nSecond == 1:
+            print('Re-queued job classified from the new page text')
+            print('Test passed')
+            n_pass += 1
+        else:
+            print('Classified as %s, then %s' % (nFirst, nSecond))
+            print('Test failed')
+            n_fail += 1
+        md.close()
+    except:
+        print('Page cache between jobs test failed...')
+        n_fail += 1
+
+    print("\n" + str(n_pass + n_fail + 1) + ": Insert rows when the connection fails on execute and on rollback")
+    try:
+        md = MDatabase('test', 'test', 'test', '', encrypted=False, connect=bench.connect)
+        columns = ('originalpath', 'formtype', 'formref')
+        # connection dropped before the insert - reconnects and inserts
+        md.getConnection().close()
+        ids_reconnect = md.insert_rows(ENV.FORMATION_DATA_TABLE, columns, [['p1', 'drop', 'r1'], ['p2', 'drop', 'r2']])
+        # connection dropped after the first chunk - the statement and the rollback both fail
+        get_template = md.get_insert_rows_template
+        def dropping_template(sTable, columns, nRows, sIdentityColumn):
+            if md.fInTransaction:
+                md.getConnection().close()
+            return get_template(sTable, columns, nRows, sIdentityColumn)
+        md.get_insert_rows_template = dropping_template
+        ids_dropped = md.insert_rows(ENV.FORMATION_DATA_TABLE, columns, [['p3', 'drop', 'r3'], ['p4', 'drop', 'r4']],
+                                     chunk_size=1)
+        md.get_insert_rows_template = get_template
+        # and the next insert reconnects
+        ids_after = md.insert_rows(ENV.FORMATION_DATA_TABLE, columns, [['p5', 'drop', 'r5']])
+        rsRows = md.query('select originalpath from ' + ENV.FORMATION_DATA_TABLE + " where formtype = 'drop' "
+                          'order by ID')
+        paths = [r.originalpath for r in rsRows]
+        if ids_reconnect is not None and ids_dropped is None and ids_after is not None \
+                and paths == ['p1', 'p2', 'p5']:
+            print('Reconnected before the insert, None returned for the dropped insert, reconnected after')
+            print('Test passed')
+            n_pass += 1
+        else:
+            print('Ids: %s, %s, %s, rows: %s' % (ids_reconnect, ids_dropped, ids_after, paths))
+            print('Test failed')
+            n_fail += 1
+        md.close()
+    except:
+        print('Insert rows with a dropped connection test failed...')
+        n_fail += 1
+
+    print("\n" + str(n_pass + n_fail + 1) + ": Log event which can't be written doesn't hold up the others")
+    try:
+        # a database of its own, where AILog has a size limit on the description - as the mstore column does
+        bench_log = FB.BenchDatabase(os.path.join(s_dir, 'unit_test_log.db'))
+        bench_log.create_tables()
+        bench_log.run_script('drop table AILog;'
+                             'create table AILog (AL_JobID, AL_Source, AL_Description check (length(AL_Description) '
+                             '<= 255), AL_CabinetID, AL_DocID);')
+        md = MDatabase('test', 'test', 'test', '', encrypted=False, connect=bench_log.connect)
+        s_spill = os.path.join(s_dir, 'ailog_spill.txt')
+        writer = AILogWriter(md, batch_size=10, flush_seconds=0.1, overflow='spill', spill_file=s_spill)
+        for n in range(5):
+            writer.write(n, 'Multiple reference matches: ' + ('ACC000001, ' * 30 if n == 2 else 'none'), 'Test')
+        fFlushed = writer.flush(5)
+        writer.write(5, 'Written after the failed batch', 'Test')
+        fFlushed = writer.flush(5) and fFlushed
+        writer.close()
+        rs = md.query('select AL_JobID from AILog order by AL_JobID')
+        with open(s_spill, encoding='utf-8') as f:
+            spilled = f.readlines()
+        if fFlushed and [r.AL_JobID for r in rs] == [0, 1, 3, 4, 5] and len(spilled) == 1 \
+                and spilled[0].startswith('2\t'):
+            print('Long description spilled, all other events written')
+            print('Test passed')
+            n_pass += 1
+        else:
+            print('Flushed: %s, written: %s, spilled: %s' % (fFlushed, [r.AL_JobID for r in rs], spilled))
+            print('Test failed')
+            n_fail += 1
+        md.close()
+    except:
+        print('Log event too long test failed...')
+        n_fail += 1
+
+    shutil.rmtree(s_dir, ignore_errors=True)
+
+    print("\nCompleted offline unit tests for " + MODULE_NAME)
+    print(str(n_pass + n_fail) + " total tests")
+    print(str(n_pass) + " tests passed")
+    print(str(n_fail) + " tests failed\n")
+
+    return n_pass, n_fail
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1].upper() == 'OFFLINE':
+        unit_test_offline()
+    else:
+        unit_test()
\ No newline at end of file
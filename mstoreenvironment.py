@@ -13,13 +13,81 @@ credentials_p = 'credentials.p'             # must exist
 server_name = '169.254.5.23\SQLEXPRESS'     # SQL-Server instance
 database_name = 'MSTOREAF_mstoreDemo'       # database
 
+# Database connection pool (mstore.MDatabasePool)
+DB_POOL_MIN_SIZE = 1                        # connections kept open
+DB_POOL_MAX_SIZE = 8                        # most connections open at once - threads wait for a free one
+DB_POOL_IDLE_SECONDS = 300                  # close unused connections above the minimum after this long
+DB_POOL_VALIDATE_SECONDS = 30               # ping a connection on borrow if it has been idle this long
+
+# Streaming queries (mstore.MDatabase.stream)
+STREAM_ARRAYSIZE = 1000                     # records fetched from the database at a time
+TRAINING_PAGE_SIZE = 1000                   # documents per query for MDatabase.iter_training_docs
+
+# Stage timings and counts (mstoremetrics.METRICS)
+METRICS_ENABLED = True                      # record stage timings and event counts
+METRICS_FILE = ''                           # file to write the metrics to at exit (and after each pass), '' for none
+METRICS_FORMAT = 'prometheus'               # 'prometheus', 'json' or 'text'
+
+# MAF list cache (mstore.MAFListCache) - configuration lists are re-read at most this often
+MAF_CACHE_SECONDS = 300                     # time-to-live for a cached MAF list, 0 to read every time
+MAF_CACHE_CHECK_CHANGES = True              # on expiry, only re-read a list if its row count/checksum changed
+
+# Reference lookup cache (mstore.REF_CACHE) - recently validated reference values
+REF_CACHE_SIZE = 5000                       # number of reference values to keep, 0 to disable
+REF_CACHE_SECONDS = 300                     # time to keep a cached reference value, 0 for no expiry
+
+# Page text normalisation (mstore.PAGE_NORMALISER) - as used by the classifier and reference extract
+PAGE_TEXT_FOLD = False                      # True = accented chars to plain ASCII, False = remove non-ASCII chars
+PAGE_TEXT_UPPER = False                     # convert page text to upper case (rules must then be upper case)
+PAGE_TEXT_COLLAPSE_SPACE = False            # collapse runs of white space to a single space
+PAGE_TEXT_CACHE_PAGES = 2000                # number of normalised pages to keep, 0 to disable
+
+# Buffered AILog writer (mstore.AILogWriter)
+AILOG_BUFFERED = True                       # True = write log events in the background, False = straight away
+AILOG_BATCH_SIZE = 50                       # log events per insert
+AILOG_FLUSH_SECONDS = 2                     # longest time an event waits to be written
+AILOG_MAX_BUFFER = 10000                    # most events held in memory, e.g. while the database is unavailable
+AILOG_MAX_RETRIES = 3                       # failed batch inserts before the events are written one at a time
+AILOG_OVERFLOW = 'spill'                    # when the buffer is full: 'spill' to AILOG_SPILL_FILE, or 'drop'
+# spill file for log events - tab separated JobID, source, description, cabinet, docID, appended to as events
+# overflow - give a full path, as a relative one would be in whatever directory the process was started from
+# (the directory is created if needed)
+AILOG_SPILL_FILE = r'D:\Temp\mstore\ailog_spill.txt'
+
+# Batch job runner (mstore.MAutoIndex.run_batch)
+BATCH_SIZE_DOCS = 200                       # documents read and processed together
+BATCH_PROCESSES = 0                         # worker processes for rule matching, 0 = run in the calling process
+
 #Formation specific parameters
 FORMATION_BASE = 'D:\Git\Python\Formation\FTP'      # Base location for incoming files
 SWEEP_BASE = 'D:\Temp\Formation-Sweep'              # Output location for Sweep files
 
 FORM_TARGET_MAF_LIST = 3                            # MAF list with Formation output targets
 FORM_FIELD_MAF_LIST = 4                             # MAF list with Formation required fields
+FORM_CONFIG_INDEX = True                            # True = index the lists above in memory, False = filter in SQL
 
 FORMATION_DATA_TABLE = 'zFormationData'             # Data table to load - expected to exist already
 
+# PDF hand-off to the Sweep location
+HANDOFF_METHOD = 'auto'                             # 'auto' = rename or hard link if possible, 'copy' = always copy
+HANDOFF_FSYNC = 'file'                              # 'none', 'file' = flush copied data, 'full' = and the directory
+
+# Formation JSON field extraction
+JSON_STREAM_MIN_KB = 256                            # Stream-parse JSON files of this size and over, json.load smaller
+
+# Formation watcher parameters - used when formation_parser.py is run with the WATCH parameter
+WATCH_POLL_SECONDS = 5                              # Rescan interval, where inotify is not available
+WATCH_SETTLE_SECONDS = 2                            # Wait after the last change to a form folder before processing
+WATCH_RESCAN_SECONDS = 60                           # Full pass through the scan index, for missed events and retries
+
+# Formation scan index parameters - skips unchanged form folders between runs
+SCAN_INDEX_FILE = 'formation_scan_index.p'          # Local index of form folder states - '' to rescan everything
+SCAN_FAILED_RETRY_SECONDS = 600                     # Retry failed forms after this long, even if not changed
 
+# Formation processing pipeline - number of worker threads per stage, set PIPELINE_WRITE_WORKERS = 0 to run serially
+PIPELINE_PARSE_WORKERS = 2                          # JSON parsing
+PIPELINE_PARSE_PROCESSES = 0                        # > 0 to parse JSON in a process pool of this size
+PIPELINE_WRITE_WORKERS = 4                          # mstore writes - each has its own database connection
+PIPELINE_COPY_WORKERS = 4                           # PDF copy to Sweep and clean up
+PIPELINE_QUEUE_SIZE = 100                           # Forms waiting between stages, before earlier stages block
+WRITE_BATCH_SIZE = 100                              # Forms written to zFormationData per statement and commit
@@ -0,0 +1,207 @@
+# Pattern matching helpers for mstore auto-indexing
+# Rules are compiled once and then applied to many pages, rather than handing pattern strings to re each time
+# Will have minimum dependencies - standard library only
+
+import re                   # regular expressions library, for pattern matching
+import unicodedata          # for folding accented characters to plain ASCII
+
+# Module constants
+MODULE_NAME = 'mstorematch.py'
+REGEX_SPECIAL = set('.^$*+?{}[]\\|()')          # a pattern without these characters is a plain literal
+BACK_REFERENCE = re.compile(r'\\[1-9]|\(\?P=')     # group numbers would change if merged with other patterns
+n_AUTOMATON_MIN_VALUES = 300                    # LiteralMatcher values needed before the automaton is used
+
+# check whether a pattern is plain text, with no regular expression syntax
+def is_literal(sPattern):
+    for c in sPattern:
+        if c in REGEX_SPECIAL:
+            return False
+    return True
+
+# A set of classification rules, compiled once for use against many pages
+# Rules are a list of (DTID, RegEx) tuples, as read from the fixed text classifier MAF list
+# The rules for each DTID are merged into a single alternation, so each page is scanned once per DTID
+# rather than once per rule - the question for a DTID is only whether any of its rules match
+# Plain text rules are checked with a substring search, without the regular expression engine
+class CompiledRuleSet:
+
+    def __init__(self, rules, fCombine=True):
+        self.rules = list(rules)
+        self.dtids = []                         # DTIDs in the order they first appear in the rules
+        self.literals = {}                      # DTID -> list of plain text rules
+        self.patterns = {}                      # DTID -> list of compiled patterns
+        by_dtid = {}
+        for dtid, sRegEx in self.rules:
+            if dtid not in by_dtid:
+                by_dtid[dtid] = []
+                self.dtids += [dtid]
+            by_dtid[dtid] += [sRegEx]
+
+        for dtid in self.dtids:
+            self.literals[dtid] = []
+            regexes = []
+            for sRegEx in by_dtid[dtid]:
+                if is_literal(sRegEx):
+                    self.literals[dtid] += [sRegEx]
+                else:
+                    regexes += [sRegEx]
+            self.patterns[dtid] = self.compile_patterns(regexes, fCombine)
+
+    # compile the patterns for one DTID - merged into one alternation where possible
+    def compile_patterns(self, regexes, fCombine):
+        compiled = []
+        merge = []
+        for r in regexes:
+            if fCombine and not BACK_REFERENCE.search(r):
+                merge += [r]
+            else:
+                compiled += [re.compile(r)]
+        if len(merge) > 1:
+            try:
+                # each rule is wrapped in a non-capturing group, so its own alternations stay separate
+                # a rule with inline flags (e.g. (?i)) can't be merged - these fail to compile here
+                return [re.compile('|'.join(['(?:' + r + ')' for r in merge]))] + compiled
+            except re.error:
+                pass
+        return [re.compile(r) for r in merge] + compiled
+
+    def __len__(self):
+        return len(self.rules)
+
+    # check if any rule for a DTID matches the page
+    def dtid_matches(self, dtid, page):
+        for sLiteral in self.literals[dtid]:
+            if sLiteral in page:
+                return True
+        for pattern in self.patterns[dtid]:
+            if pattern.search(page):
+                return True
+        return False
+
+    # get the DTIDs with at least one matching rule on the page, in rule order
+    # nStopAfter > 0 stops checking once that many DTIDs have matched
+    def matching_dtids(self, page, nStopAfter=0):
+        matched = []
+        for dtid in self.dtids:
+            if self.dtid_matches(dtid, page):
+                matched += [dtid]
+                if nStopAfter > 0 and len(matched) >= nStopAfter:
+                    break
+        return matched
+
+# Literal multi-pattern matcher, built once for a set of plain text values - used to find which reference
+# cross-check values (names, postcodes, account numbers) appear on a page, without treating them as regexes
+# A substring search per value is fastest for a few values, as it runs in C - above nAutomatonMin values
+# an Aho-Corasick automaton is used instead, which scans each text a single time whatever the number of values
+# (the Python automaton costs about as much as 300 substring searches of a page, see formation_benchmark.py)
+class LiteralMatcher:
+
+    fAutomaton = False                          # True if the values are found with the automaton
+
+    def __init__(self, values, nAutomatonMin=n_AUTOMATON_MIN_VALUES):
+        self.values = []                        # the distinct, non-empty values, in the order first seen
+        self.goto = [{}]                        # state -> {character -> next state}, state 0 is the root
+        self.fail = [0]                         # state -> state to fall back to when a character doesn't match
+        self.output = [frozenset()]             # state -> indexes of the values which end at this state
+        seen = set()
+        for v in values:
+            s = str(v)
+            if len(s) > 0 and s not in seen:
+                seen.add(s)
+                self.values += [s]
+        if len(self.values) >= nAutomatonMin:
+            self.fAutomaton = True
+            for i, s in enumerate(self.values):
+                self.add_value(s, i)
+            self.build_links()
+
+    # add a value to the trie of values, i is its index in self.values
+    def add_value(self, s, i):
+        state = 0
+        for ch in s:
+            next_state = self.goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][ch] = next_state
+                self.goto += [{}]
+                self.fail += [0]
+                self.output += [frozenset()]
+            state = next_state
+        self.output[state] = self.output[state] | {i}
+
+    # set the failure links, breadth first, and merge in the outputs of the failure states
+    def build_links(self):
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for ch, next_state in self.goto[state].items():
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[next_state] = self.goto[f].get(ch, 0)
+                self.output[next_state] = self.output[next_state] | self.output[self.fail[next_state]]
+                queue += [next_state]
+
+    def __len__(self):
+        return len(self.values)
+
+    # get the set of values which appear in the text
+    def find_values(self, text):
+        if not self.fAutomaton:
+            return {v for v in self.values if v in text}
+        found = set()
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                found |= output[state]
+                if len(found) == len(self.values):
+                    # everything found, no need to look further
+                    break
+        return {self.values[i] for i in found}
+
+# Translation table for str.translate, to reduce text to ASCII
+# Non-ASCII characters are looked up the first time they are seen, then kept in the table
+# With fFold, accented characters become their plain letter (e.g. e-acute to e), otherwise they are removed
+class AsciiTable(dict):
+
+    def __init__(self, fFold=False):
+        super().__init__()
+        self.fFold = fFold
+
+    def __missing__(self, nCode):
+        if nCode < 128:
+            sMapped = chr(nCode)
+        elif self.fFold:
+            sMapped = unicodedata.normalize('NFKD', chr(nCode)).encode('ascii', 'ignore').decode('ascii')
+        else:
+            sMapped = ''
+        self[nCode] = sMapped
+        return sMapped
+
+# Page text normalisation, as used by the classifier and reference extract
+# The text is reduced to ASCII - the same as removing anything outside \x00-\x7f, unless fFold is set
+# Optionally converted to upper case and runs of white space collapsed to a single space
+class TextNormaliser:
+
+    def __init__(self, fFold=False, fUpper=False, fCollapseSpace=False):
+        self.fFold = fFold
+        self.fUpper = fUpper
+        self.fCollapseSpace = fCollapseSpace
+        self.table = AsciiTable(fFold)
+
+    def normalise(self, text):
+        if text is None:
+            return ''
+        text = str(text)
+        if not text.isascii():
+            text = text.translate(self.table)
+        if self.fUpper:
+            text = text.upper()
+        if self.fCollapseSpace:
+            text = ' '.join(text.split())
+        return text
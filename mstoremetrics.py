@@ -0,0 +1,261 @@
+# Timing and counting of processing stages, for the Formation parser and mstore auto-indexing
+# Stages are timed into histograms, events are counted - all kept in memory, in the process-wide METRICS
+# The figures can be dumped as text, JSON or Prometheus text format (e.g. for the node exporter textfile
+# collector) - and are written to METRICS_FILE at exit, if set in the environment
+# Recording is a clock read, a lock and a few additions, so can be left on in production
+# Will have minimum dependencies - standard library only
+
+import time                                 # for the stage timers
+import threading                            # metrics are shared by all threads in a process
+import bisect                               # finding the histogram bucket
+import json                                 # for the JSON dump
+import atexit                               # for writing the metrics file at exit
+import os                                   # for replacing the metrics file
+import functools                            # for the timed() decorator
+import multiprocessing                      # worker processes don't write the metrics file
+import mstoreenvironment as ENV             # mstore environment parameters for this system
+
+MODULE_NAME = 'mstoremetrics.py'
+
+# histogram bucket upper bounds, in seconds - from a fast SQL round-trip or regex scan up to a slow copy
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Histogram of times for one stage
+class Histogram:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)      # the last count is for times over the largest bucket
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    # add in the times from another histogram with the same buckets, e.g. from a worker process
+    def merge(self, counts, nCount, nSum, nMax):
+        for i, n in enumerate(counts):
+            self.counts[i] += n
+        self.count += nCount
+        self.sum += nSum
+        if nMax > self.max:
+            self.max = nMax
+
+    # estimate a quantile (e.g. 0.95) from the buckets - the upper bound of the bucket it falls in
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        nTarget = q * self.count
+        nTotal = 0
+        for i, n in enumerate(self.counts):
+            nTotal += n
+            if nTotal >= nTarget:
+                if i < len(self.buckets):
+                    return min(self.buckets[i], self.max)
+                return self.max
+        return self.max
+
+# Timer for a stage, used as a context manager - see Metrics.timer()
+class StageTimer:
+
+    def __init__(self, metrics, sStage):
+        self.metrics = metrics
+        self.sStage = sStage
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.sStage, time.perf_counter() - self.start)
+        return False
+
+# Timer which does nothing, for when metrics are turned off
+class NullTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NULL_TIMER = NullTimer()
+
+# All of the stage histograms and event counters for a process
+class Metrics:
+
+    def __init__(self, fEnabled=True):
+        self.fEnabled = fEnabled
+        self.stages = {}                    # stage name -> Histogram
+        self.counters = {}                  # event name -> count
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+
+    # time a block of code as a stage:
+    #     with METRICS.timer('get_values'):
+    def timer(self, sStage):
+        if not self.fEnabled:
+            return NULL_TIMER
+        return StageTimer(self, sStage)
+
+    # record the time for a stage
+    def observe(self, sStage, seconds):
+        if not self.fEnabled:
+            return
+        with self.lock:
+            histogram = self.stages.get(sStage)
+            if histogram is None:
+                histogram = Histogram()
+                self.stages[sStage] = histogram
+            histogram.observe(seconds)
+
+    # count an event
+    def count(self, sEvent, n=1):
+        if not self.fEnabled:
+            return
+        with self.lock:
+            self.counters[sEvent] = self.counters.get(sEvent, 0) + n
+
+    # take everything recorded so far, as plain data which can be sent back from a worker process, and forget it
+    def take(self):
+        with self.lock:
+            stages = {}
+            for sStage, h in self.stages.items():
+                stages[sStage] = (h.counts, h.count, h.sum, h.max)
+            data = (stages, self.counters)
+            self.stages = {}
+            self.counters = {}
+        return data
+
+    # add in metrics taken (with take()) from another process
+    def merge(self, data):
+        if not self.fEnabled:
+            return
+        stages, counters = data
+        with self.lock:
+            for sStage, (counts, nCount, nSum, nMax) in stages.items():
+                histogram = self.stages.get(sStage)
+                if histogram is None:
+                    histogram = Histogram()
+                    self.stages[sStage] = histogram
+                histogram.merge(counts, nCount, nSum, nMax)
+            for sEvent, n in counters.items():
+                self.counters[sEvent] = self.counters.get(sEvent, 0) + n
+
+    # forget everything recorded so far
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.counters = {}
+            self.start_time = time.time()
+
+    # get a snapshot of the metrics, as a dictionary
+    def snapshot(self):
+        with self.lock:
+            stages = {}
+            for sStage, h in sorted(self.stages.items()):
+                stages[sStage] = {'count': h.count, 'sum': h.sum, 'max': h.max,
+                                  'p50': h.quantile(0.5), 'p95': h.quantile(0.95), 'p99': h.quantile(0.99),
+                                  'buckets': list(zip(list(h.buckets) + ['+Inf'], h.counts))}
+            return {'start_time': self.start_time, 'time': time.time(), 'stages': stages,
+                    'counters': dict(sorted(self.counters.items()))}
+
+    # dump as a plain text table
+    def dump_text(self):
+        data = self.snapshot()
+        lines = ['%-32s %10s %12s %10s %10s %10s %10s' % ('stage', 'count', 'total (s)', 'mean (ms)', 'p95 (ms)',
+                                                          'p99 (ms)', 'max (ms)')]
+        for sStage, h in data['stages'].items():
+            mean = h['sum'] / h['count'] if h['count'] else 0.0
+            lines += ['%-32s %10d %12.3f %10.2f %10.2f %10.2f %10.2f' % (sStage, h['count'], h['sum'], mean * 1000,
+                                                                         h['p95'] * 1000, h['p99'] * 1000,
+                                                                         h['max'] * 1000)]
+        lines += ['']
+        for sEvent, n in data['counters'].items():
+            lines += ['%-32s %10d' % (sEvent, n)]
+        return '\n'.join(lines) + '\n'
+
+    def dump_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    # dump in the Prometheus text exposition format
+    def dump_prometheus(self, sPrefix='mstore'):
+        data = self.snapshot()
+        lines = ['# HELP ' + sPrefix + '_stage_seconds Time spent in each processing stage',
+                 '# TYPE ' + sPrefix + '_stage_seconds histogram']
+        for sStage, h in data['stages'].items():
+            nTotal = 0
+            for le, n in h['buckets']:
+                nTotal += n
+                lines += [sPrefix + '_stage_seconds_bucket{stage="%s",le="%s"} %d' % (sStage, le, nTotal)]
+            lines += [sPrefix + '_stage_seconds_sum{stage="%s"} %f' % (sStage, h['sum'])]
+            lines += [sPrefix + '_stage_seconds_count{stage="%s"} %d' % (sStage, h['count'])]
+        lines += ['# HELP ' + sPrefix + '_events_total Number of times each event has happened',
+                  '# TYPE ' + sPrefix + '_events_total counter']
+        for sEvent, n in data['counters'].items():
+            lines += [sPrefix + '_events_total{event="%s"} %d' % (sEvent, n)]
+        return '\n'.join(lines) + '\n'
+
+    # write the metrics to a file, in 'text', 'json' or 'prometheus' format
+    # written to a temporary file and swapped in, so a reader never sees a partial file
+    def write(self, sFile, sFormat='prometheus'):
+        if sFormat == 'json':
+            sData = self.dump_json()
+        elif sFormat == 'text':
+            sData = self.dump_text()
+        else:
+            sData = self.dump_prometheus()
+        s_tmp = sFile + '.tmp'
+        try:
+            with open(s_tmp, 'w') as f:
+                f.write(sData)
+            os.replace(s_tmp, sFile)
+            return True
+        except OSError:
+            return False
+
+METRICS = Metrics(ENV.METRICS_ENABLED)
+
+# decorator to time every call of a function as a stage
+def timed(sStage):
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with METRICS.timer(sStage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+# Metrics recorded in a worker process (e.g. by a ProcessPoolExecutor) stay in that process's METRICS
+# Run the work with call_recorded() in the worker, which returns the metrics along with the result, and
+# add them in with record_result() in the calling process:
+#     result = M.record_result(executor.submit(M.call_recorded, fn, arg).result())
+def call_recorded(fn, *args):
+    result = fn(*args)
+    return result, METRICS.take()
+
+# add in the metrics returned by call_recorded() and return the result
+def record_result(recorded):
+    result, data = recorded
+    METRICS.merge(data)
+    return result
+
+# write the metrics to the file set in the environment, if any
+def write_metrics():
+    if ENV.METRICS_ENABLED and ENV.METRICS_FILE != '':
+        return METRICS.write(ENV.METRICS_FILE, ENV.METRICS_FORMAT)
+    return False
+
+# write the metrics at exit - only from the main process, as a worker process (which has sent its metrics back
+# with call_recorded()) would otherwise replace the file with its own
+def write_metrics_at_exit():
+    if multiprocessing.parent_process() is None:
+        write_metrics()
+
+atexit.register(write_metrics_at_exit)